@@ -1,6 +1,7 @@
-import json
 import asyncio
 import logging
+import time
+from contextlib import contextmanager
 import warnings
 import coloredlogs
 import pytz
@@ -9,12 +10,20 @@ from aiogram import Bot, Dispatcher
 from aiogram.types import PreCheckoutQuery
 from handlers import setup_handlers, set_main_menu
 from datetime import datetime, timedelta, timezone
-from functions import delete_client_by_email
+from functions import delete_clients, close_xui_api
 from stats_notifier import stats_distribution_task
+from traffic_sampler import traffic_sampler_task
+from reconcile import reconcile_task
+from subscription_server import start_subscription_server
 from database import (
-    Session, User, init_db, get_all_users, delete_user_profile,
-    update_user_profile, cleanup_expired_users, get_admin_users
+    init_db, close_db, get_users_expiring_before, get_users_by_ids, clear_user_profiles, cleanup_expired_users,
+    get_admin_users, sync_admins, set_notification_flags, profile_ref, as_utc,
+    add_subscription_listener, remove_subscription_listener,
+    reset_notification_flags as db_reset_notification_flags
 )
+from migrations import run_migrations, online_migrations_task
+from deadline_scheduler import DeadlineScheduler
+from checker_metrics import checker_metrics
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 
@@ -48,53 +57,179 @@ logger = setup_logging()
 MSK = pytz.timezone("Europe/Moscow")
 
 # =========================
-# Конвертация всех naive дат в MSK
+# Замер фаз запуска
 # =========================
-async def migrate_subscription_end_to_msk():
-    with Session() as session:
-        users = session.query(User).all()
-        updated_count = 0
-        for user in users:
-            if user.subscription_end and user.subscription_end.tzinfo is None:
-                user.subscription_end = MSK.localize(user.subscription_end)
-                updated_count += 1
-        if updated_count > 0:
-            session.commit()
-            logger.info(f"✅ Migrated {updated_count} subscription_end to MSK")
-        return updated_count
+class StartupTimer:
+    """Длительность каждой фазы старта до начала polling"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, (time.perf_counter() - start) * 1000))
+
+    def report(self):
+        total = (time.perf_counter() - self.started) * 1000
+        phases = ", ".join(f"{name}={ms:.0f}ms" for name, ms in self.phases)
+        logger.info(f"ℹ️ Startup phases: {phases}, total={total:.0f}ms")
 
 # =========================
 # Класс проверки подписок
 # =========================
+# Моменты проверки относительно конца подписки: уведомления за 24 и 2 часа, истечение
+EXPIRY_DEADLINES = (timedelta(hours=24), timedelta(hours=2), timedelta(0))
+# Повтор, если проверка не удалась (Telegram/панель недоступны) и дедлайн остался наступившим
+EXPIRY_RETRY_DELAY = 60
+
+
+def next_check_at(subscription_end, notified_24h=False, notified_2h=False, now: float = None) -> float:
+    """Когда проверить пользователя в следующий раз (unix-время).
+
+    Уже открытое окно с неотправленным уведомлением или истекшая подписка — сейчас,
+    иначе ближайший из T-24h, T-2h, T-0.
+    """
+    now = time.time() if now is None else now
+    end = as_utc(subscription_end).timestamp()
+    if end <= now \
+            or (end - 2 * 3600 <= now and not notified_2h) \
+            or (end - 24 * 3600 <= now and not notified_24h):
+        return now
+    return min(point for point in (end - offset.total_seconds() for offset in EXPIRY_DEADLINES) if point > now)
+
+
 class SubscriptionChecker:
+    """Уведомления и отключение по дедлайнам подписок.
+
+    Вместо полного прохода раз в 5 минут держит мин-кучу ближайших дедлайнов
+    (DeadlineScheduler) и спит до ближайшего. Куча заполняется одним запросом по
+    индексу и раз в EXPIRY_RESEED_INTERVAL пересобирается; продления, сокращения
+    и новые профили приходят сразу через слушатель записей database.py.
+    """
+
     def __init__(self, bot: Bot):
         self.bot = bot
         self.running = False
+        self.scheduler = DeadlineScheduler()
+        self._task = None
+        # Изменения, пришедшие во время чтения дедлайнов из БД: применяются поверх него
+        self._changed_while_seeding = None
+        # Флаги уведомлений за проход: пишутся в БД одной транзакцией в конце
+        self._pending_flags = {}
+        # Админы читаются один раз за проход, а не на каждое уведомление
+        self._admins = None
+        self._admins_lock = asyncio.Lock()
+        # Пользователи прохода обрабатываются параллельно, каждая стадия — со своим лимитом
+        self._xui_limit = asyncio.Semaphore(config.CHECKER_XUI_CONCURRENCY)
+        self._db_limit = asyncio.Semaphore(config.CHECKER_DB_CONCURRENCY)
+        self._telegram_limit = asyncio.Semaphore(config.CHECKER_TELEGRAM_CONCURRENCY)
+
+    def _on_subscription_changed(self, telegram_id: int, subscription_end):
+        """Слушатель database.py: срок или профиль пользователя изменились"""
+        if self._changed_while_seeding is not None:
+            self._changed_while_seeding[telegram_id] = subscription_end
+        if subscription_end is None:
+            self.scheduler.discard(telegram_id)
+        else:
+            # Флаги после записи неизвестны — открытое окно проверяется сразу, лишнего не отправится
+            self.scheduler.schedule(telegram_id, next_check_at(subscription_end))
+
+    async def _seed(self):
+        """Дедлайны всех, у кого что-то наступит до следующего пересева"""
+        horizon = datetime.utcnow() + EXPIRY_DEADLINES[0] + timedelta(seconds=2 * config.EXPIRY_RESEED_INTERVAL)
+        self._changed_while_seeding = {}
+        try:
+            users = await get_users_expiring_before(horizon)
+            deadlines = {
+                user.telegram_id: next_check_at(user.subscription_end, user.notified_24h, user.notified_2h)
+                for user in users if user.subscription_end
+            }
+            for telegram_id, subscription_end in self._changed_while_seeding.items():
+                if subscription_end is None:
+                    deadlines.pop(telegram_id, None)
+                else:
+                    deadlines[telegram_id] = next_check_at(subscription_end)
+            self.scheduler.replace(deadlines)
+        finally:
+            self._changed_while_seeding = None
+        logger.debug(f"🔍 Expiry scheduler seeded with {len(deadlines)} users")
 
     async def check_subscriptions(self):
+        next_seed = 0.0
         while self.running:
             try:
-                now = datetime.now(MSK)
-                users = await get_all_users()
-                logger.debug(f"🔍 Checking {len(users)} users...")
-                for user in users:
-                    await self._check_user_subscription(user, now)
+                if time.monotonic() >= next_seed:
+                    if checker_metrics.passes:
+                        histogram = ", ".join(f"{label}={count}" for label, count in checker_metrics.histogram())
+                        logger.info(f"ℹ️ Checker pass durations: {histogram}")
+                    await self._seed()
+                    next_seed = time.monotonic() + config.EXPIRY_RESEED_INTERVAL
+                due = await self.scheduler.wait_due(timeout=max(0.0, next_seed - time.monotonic()))
+                if due:
+                    await self._process_due(due)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 logger.error(f"❌ Subscription check error: {e}", exc_info=True)
-            await asyncio.sleep(300)  # Проверяем каждые 5 минут
+                await asyncio.sleep(EXPIRY_RETRY_DELAY)
+
+    async def _process_due(self, telegram_ids: list):
+        """Проверить пользователей с наступившим дедлайном и назначить им следующий"""
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        async with checker_metrics.stage("db", self._db_limit):
+            users = await get_users_by_ids(telegram_ids)
+        logger.debug(f"🔍 Checking {len(users)} users with due deadlines...")
+        self._admins = None
+        try:
+            results = await asyncio.gather(*(self._check_user_subscription(user, now) for user in users))
+            expired = [result for result in results if result is not None]
+            if expired:
+                await self._deprovision_expired(expired)
+        finally:
+            async with checker_metrics.stage("db", self._db_limit):
+                await self._flush_notification_flags()
+
+        # Следующий дедлайн — по состоянию после проверки (флаги, удаленный профиль)
+        checked_at = time.time()
+        async with checker_metrics.stage("db", self._db_limit):
+            users = await get_users_by_ids(telegram_ids)
+        for user in users:
+            if not user.subscription_end or not user.vless_profile_data:
+                continue
+            when = next_check_at(user.subscription_end, user.notified_24h, user.notified_2h, checked_at)
+            if when <= checked_at:
+                when = checked_at + EXPIRY_RETRY_DELAY
+            self.scheduler.schedule(user.telegram_id, when)
+
+        duration = time.perf_counter() - started
+        checker_metrics.record_pass(duration, len(telegram_ids))
+        if len(telegram_ids) > 1:
+            logger.info(f"ℹ️ Checked {len(telegram_ids)} due users in {duration:.2f}s")
 
     async def _check_user_subscription(self, user, now):
+        """Уведомления за 24 и 2 часа; для истекшей подписки — (user, email, profile_data).
+
+        Истекшие не отключаются по одному: их собирает _deprovision_expired за весь проход.
+        """
         if not user.subscription_end or not user.vless_profile_data:
             return
 
-        # Приводим subscription_end к aware datetime в MSK
-        subscription_end = user.subscription_end
-        if subscription_end.tzinfo is None:
-            subscription_end = MSK.localize(subscription_end)
+        subscription_end = as_utc(user.subscription_end)
+
+        # Поля профиля из колонок — без разбора JSON на каждого пользователя
+        profile_data = profile_ref(user)
+        if not profile_data:
+            logger.warning(f"⚠️ Invalid profile data for user {user.telegram_id}")
+            return
 
         try:
-            profile_data = json.loads(user.vless_profile_data)
-            email = profile_data.get("email", "N/A")
+            email = profile_data.get("email") or "N/A"
 
             time_to_expire = subscription_end - now
 
@@ -110,12 +245,11 @@ class SubscriptionChecker:
 
             # Подписка истекла
             if subscription_end <= now:
-                await self._handle_expired_subscription(user, email)
+                return user, email, profile_data
 
-        except json.JSONDecodeError:
-            logger.warning(f"⚠️ Invalid profile data for user {user.telegram_id}")
         except Exception as e:
             logger.error(f"❌ Error checking user {user.telegram_id}: {e}")
+        return None
 
     async def _send_24h_notification(self, user, email):
         try:
@@ -124,7 +258,7 @@ class SubscriptionChecker:
                 [InlineKeyboardButton(text="🔄 Продлить подписку", callback_data="renew")]
             ])
             
-            await self.bot.send_message(
+            await self._send(
                 user.telegram_id,
                 "⚠️ *Ваша подписка истекает через 24 часа!*\n\n"
                 "Продлите подписку, чтобы сохранить доступ к VPN.\n"
@@ -132,7 +266,7 @@ class SubscriptionChecker:
                 parse_mode="Markdown",
                 reply_markup=keyboard
             )
-            await self._update_notification_flag(user.telegram_id, 'notified_24h', True)
+            self._queue_notification_flag(user.telegram_id, 'notified_24h')
             logger.info(f"✅ 24h notification sent to {user.telegram_id}")
         except Exception as e:
             logger.warning(f"⚠️ Failed to send 24h notification to {user.telegram_id}: {e}")
@@ -146,7 +280,7 @@ class SubscriptionChecker:
             ])
             
             # Уведомление пользователю
-            await self.bot.send_message(
+            await self._send(
                 user.telegram_id,
                 "⏰ *Внимание! Подписка истекает через 2 часа!*\n\n"
                 "Сейчас самое время продлить подписку, "
@@ -157,7 +291,7 @@ class SubscriptionChecker:
             )
             
             # Уведомление администраторам
-            admins = await get_admin_users()
+            admins = await self._get_admins()
             admin_message = (
                 "⏳ *СКОРО ИСТЕКАЕТ ПОДПИСКА*\n\n"
                 f"👤 Пользователь: `{user.telegram_id}`\n"
@@ -167,37 +301,48 @@ class SubscriptionChecker:
                 f"Была отправлена кнопка продления"
             )
             
-            for admin in admins:
-                try:
-                    await self.bot.send_message(
-                        admin.telegram_id,
-                        admin_message,
-                        parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    logger.warning(f"⚠️ Failed to notify admin {admin.telegram_id}: {e}")
+            await self._notify_admins(admins, admin_message)
             
             # Обновляем флаг в БД
-            await self._update_notification_flag(user.telegram_id, 'notified_2h', True)
+            self._queue_notification_flag(user.telegram_id, 'notified_2h')
             logger.info(f"✅ 2h notifications sent for {user.telegram_id}")
             
         except Exception as e:
             logger.error(f"❌ Failed to send 2h notification to {user.telegram_id}: {e}")
     
-    async def _handle_expired_subscription(self, user, email):
-        """Обработка истекшей подписки"""
+    async def _deprovision_expired(self, expired: list):
+        """Отключить все истекшие подписки прохода: (user, email, profile_data).
+
+        Клиенты удаляются из панели пачкой — одна запись на инбаунд. Профиль в БД
+        очищается одним UPDATE и только у тех, чье удаление панель подтвердила;
+        остальные остаются с профилем и проверяются повторно через EXPIRY_RETRY_DELAY.
+        """
+        in_panel = [(user, email, profile_data) for user, email, profile_data in expired if email != "N/A"]
+        deleted = {}
+        if in_panel:
+            async with checker_metrics.stage("xui", self._xui_limit):
+                deleted = await delete_clients([profile_data for _, _, profile_data in in_panel])
+
+        done = []
+        for user, email, _ in expired:
+            if email == "N/A" or deleted.get(email):
+                done.append((user, email))
+            else:
+                logger.warning(f"⚠️ Failed to delete client {email} from XUI, will retry")
+        if not done:
+            return
+
+        async with checker_metrics.stage("db", self._db_limit):
+            await clear_user_profiles([user.id for user, _ in done])
+        logger.info(f"🧹 Deprovisioned {len(done)} of {len(expired)} expired subscriptions")
+
+        await asyncio.gather(*(self._send_expired_notification(user, email) for user, email in done))
+
+    async def _send_expired_notification(self, user, email):
+        """Сообщить пользователю и админам, что подписка истекла и клиент отключен"""
         try:
-            # Удаляем клиента из XUI
-            if email != "N/A":
-                success = await delete_client_by_email(email)
-                if not success:
-                    logger.warning(f"⚠️ Failed to delete client {email} from XUI")
-            
-            # Удаляем профиль из БД
-            await delete_user_profile(user.telegram_id)
-            
             # Уведомление пользователю
-            await self.bot.send_message(
+            await self._send(
                 user.telegram_id,
                 "❌ *Ваша подписка истекла*\n\n"
                 "VPN-профиль был отключён.\n"
@@ -206,7 +351,7 @@ class SubscriptionChecker:
             )
             
             # Уведомление администраторам
-            admins = await get_admin_users()
+            admins = await self._get_admins()
             admin_message = (
                 "📉 *ПОДПИСКА ЗАВЕРШЕНА*\n\n"
                 f"👤 Пользователь: `{user.telegram_id}`\n"
@@ -216,35 +361,55 @@ class SubscriptionChecker:
                 "🧹 Клиент удалён из XUI"
             )
             
-            for admin in admins:
-                try:
-                    await self.bot.send_message(
-                        admin.telegram_id,
-                        admin_message,
-                        parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    logger.warning(f"⚠️ Failed to notify admin about expired sub: {e}")
+            await self._notify_admins(admins, admin_message)
             
             logger.info(f"✅ Subscription ended for {user.telegram_id} ({email})")
             
         except Exception as e:
             logger.error(f"❌ Error handling expired subscription for {user.telegram_id}: {e}")
 
-    async def _update_notification_flag(self, telegram_id: int, flag_name: str, value: bool):
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=telegram_id).first()
-            if user:
-                setattr(user, flag_name, value)
-                session.commit()
+    async def _get_admins(self):
+        async with self._admins_lock:
+            if self._admins is None:
+                async with checker_metrics.stage("db", self._db_limit):
+                    self._admins = await get_admin_users()
+        return self._admins
+
+    async def _send(self, chat_id: int, text: str, **kwargs):
+        """Сообщение из проверки подписок под семафором Telegram"""
+        async with checker_metrics.stage("telegram", self._telegram_limit):
+            return await self.bot.send_message(chat_id, text, **kwargs)
+
+    async def _notify_admins(self, admins, text: str):
+        async def notify(admin):
+            try:
+                await self._send(admin.telegram_id, text, parse_mode="Markdown")
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to notify admin {admin.telegram_id}: {e}")
+        await asyncio.gather(*(notify(admin) for admin in admins))
+
+    def _queue_notification_flag(self, telegram_id: int, flag_name: str):
+        self._pending_flags.setdefault(flag_name, []).append(telegram_id)
+
+    async def _flush_notification_flags(self):
+        """Записать флаги всех отправленных за проход уведомлений"""
+        if not self._pending_flags:
+            return
+        pending, self._pending_flags = self._pending_flags, {}
+        updated = await set_notification_flags(pending)
+        logger.debug(f"🔍 Saved {updated} notification flags")
 
     async def start(self):
         self.running = True
-        asyncio.create_task(self.check_subscriptions())
+        add_subscription_listener(self._on_subscription_changed)
+        self._task = asyncio.create_task(self.check_subscriptions())
         logger.info("✅ Subscription checker started")
 
     async def stop(self):
         self.running = False
+        remove_subscription_listener(self._on_subscription_changed)
+        if self._task:
+            self._task.cancel()
         logger.info("🛑 Subscription checker stopped")
 
 
@@ -255,25 +420,15 @@ async def reset_notification_flags():
     while True:
         try:
             now = datetime.now(MSK)
-            with Session() as session:
-                users_to_reset = session.query(User).filter(
-                    User.subscription_end > now + timedelta(hours=24),
-                    (User.notified_24h == True) | (User.notified_2h == True)
-                ).all()
-                reset_count = 0
-                for user in users_to_reset:
-                    user.notified_24h = False
-                    user.notified_2h = False
-                    reset_count += 1
-                if reset_count > 0:
-                    session.commit()
-                    logger.info(f"✅ Reset notification flags for {reset_count} users")
-
-                # Очистка старых пользователей в 3:00 МСК
-                if now.hour == 3:
-                    cleaned = await cleanup_expired_users()
-                    if cleaned > 0:
-                        logger.info(f"🧹 Cleaned up {cleaned} expired users")
+            reset_count = await db_reset_notification_flags(datetime.utcnow() + timedelta(hours=24))
+            if reset_count > 0:
+                logger.info(f"✅ Reset notification flags for {reset_count} users")
+
+            # Очистка старых пользователей в 3:00 МСК
+            if now.hour == 3:
+                cleaned = await cleanup_expired_users()
+                if cleaned > 0:
+                    logger.info(f"🧹 Cleaned up {cleaned} expired users")
 
         except Exception as e:
             logger.error(f"❌ Reset notification flags error: {e}")
@@ -285,22 +440,8 @@ async def reset_notification_flags():
 # =========================
 async def update_admins_from_config():
     try:
-        with Session() as session:
-            session.query(User).update({User.is_admin: False})
-            for admin_id in config.ADMINS:
-                user = session.query(User).filter_by(telegram_id=admin_id).first()
-                if user:
-                    user.is_admin = True
-                else:
-                    new_admin = User(
-                        telegram_id=admin_id,
-                        full_name=f"Admin {admin_id}",
-                        is_admin=True,
-                        subscription_end=datetime.now(MSK) + timedelta(days=365*10)
-                    )
-                    session.add(new_admin)
-            session.commit()
-            logger.info(f"✅ Updated {len(config.ADMINS)} admins from config")
+        changed = await sync_admins(config.ADMINS, datetime.utcnow() + timedelta(days=365*10))
+        logger.info(f"✅ Synced {len(config.ADMINS)} admins from config ({changed} rows changed)")
     except Exception as e:
         logger.error(f"❌ Failed to update admins: {e}")
 
@@ -320,11 +461,17 @@ async def main():
 
     # Инициализация
     subscription_checker = SubscriptionChecker(bot)
-    await init_db()
-    await migrate_subscription_end_to_msk()
-    await update_admins_from_config()
-    setup_handlers(dp)
-    await set_main_menu(bot)
+    startup = StartupTimer()
+    with startup.phase("init_db"):
+        await init_db()
+    with startup.phase("migrations"):
+        await run_migrations()
+    with startup.phase("admins"):
+        await update_admins_from_config()
+    with startup.phase("handlers"):
+        setup_handlers(dp)
+    with startup.phase("bot_menu"):
+        await set_main_menu(bot)
 
     # Предварительная проверка платежа
     @dp.pre_checkout_query()
@@ -335,9 +482,22 @@ async def main():
     await subscription_checker.start()
     asyncio.create_task(reset_notification_flags())
     asyncio.create_task(stats_distribution_task(bot))
+    asyncio.create_task(traffic_sampler_task())
+    asyncio.create_task(reconcile_task())
+    asyncio.create_task(online_migrations_task())
+    with startup.phase("subscription_server"):
+        subscription_runner = await start_subscription_server()
 
+    startup.report()
     logger.info("🤖 Bot started")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await subscription_checker.stop()
+        if subscription_runner:
+            await subscription_runner.cleanup()
+        await close_xui_api()
+        await close_db()
 
 
 if __name__ == "__main__":
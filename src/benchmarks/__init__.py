@@ -0,0 +1 @@
+# Микробенчмарки и нагрузочные сценарии. Запуск из src: python -m benchmarks.<имя>
@@ -0,0 +1,84 @@
+# bench_serialization.py
+"""Сравнение кодирования settings инбаунда: json.dumps(indent=2) против компактного JSON.
+
+Запуск из src:  python -m benchmarks.bench_serialization [--repeat 5] [--sizes 1000,10000,50000]
+"""
+import argparse
+import json
+import time
+import uuid
+
+import serialization
+
+
+def make_settings(count: int) -> dict:
+    """settings инбаунда с count клиентами в том виде, в каком их пишет бот"""
+    clients = [
+        {
+            "id": str(uuid.uuid4()),
+            "flow": "",
+            "email": f"user_{100000 + i}_{i % 10000:04d}",
+            "limitIp": 0,
+            "totalGB": 0,
+            "expiryTime": 1760000000000 + i,
+            "enable": True,
+            "tgId": "",
+            "subId": "",
+            "reset": 0,
+            "fingerprint": "chrome",
+            "publicKey": "Z84J2IelR9ch3k8VtlVhhs5ycBUlXA7wHBWcBrjqnAw",
+            "shortId": "1234567890",
+            "spiderX": "/"
+        }
+        for i in range(count)
+    ]
+    return {"clients": clients, "decryption": "none", "fallbacks": []}
+
+
+def best_of(repeat: int, func, *args):
+    """Лучшее время из repeat прогонов, мс"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--sizes", default="1000,10000,50000")
+    args = parser.parse_args()
+
+    codecs = [
+        ("json indent=2", lambda obj: json.dumps(obj, indent=2), json.loads),
+        ("json compact", serialization._dumps_stdlib, json.loads),
+    ]
+    if serialization.orjson is not None:
+        codecs.append(("orjson", serialization.dumps, serialization.loads))
+    else:
+        print("orjson не установлен — сравниваются только варианты стандартного json\n")
+
+    header = f"{'clients':>8}  {'codec':<14} {'size, KB':>10} {'encode, ms':>11} {'decode, ms':>11}"
+    print(header)
+    print("-" * len(header))
+    for count in (int(size) for size in args.sizes.split(",")):
+        settings = make_settings(count)
+        baseline = None
+        for name, dumps, loads in codecs:
+            encoded = dumps(settings)
+            assert loads(encoded) == settings
+            size = len(encoded.encode())
+            baseline = baseline or size
+            encode_ms = best_of(args.repeat, dumps, settings)
+            decode_ms = best_of(args.repeat, loads, encoded)
+            line = f"{count:>8}  {name:<14} {size / 1024:>10.1f} {encode_ms:>11.2f} {decode_ms:>11.2f}"
+            if size != baseline:
+                line += f"  ({100 * (1 - size / baseline):.0f}% меньше)"
+            print(line)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# bench_sqlite.py
+"""Конкурентные чтения/записи SQLite: журнал по умолчанию против профиля из config (WAL и PRAGMA).
+
+Запуск из src:  python -m benchmarks.bench_sqlite [--users 20000] [--readers 8] [--writers 4] [--duration 10]
+
+База создается во временном каталоге, рабочая users.db не трогается.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import database
+from database import Base, User
+
+
+async def populate(db_engine, users: int):
+    """users пользователей: половина с активной подпиской и профилем"""
+    now = datetime.utcnow()
+    async with db_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(User.__table__.insert(), [
+            {
+                "telegram_id": 1_000_000 + i,
+                "full_name": f"User {i}",
+                "subscription_end": now + timedelta(hours=random.randint(-720, 720)),
+                "vless_profile_data": '{"email":"user_%d_0000"}' % i if i % 2 else None,
+                "is_admin": False,
+                "notified_24h": False,
+                "notified_2h": False,
+            }
+            for i in range(users)
+        ])
+
+
+class Stats:
+    def __init__(self):
+        self.ops = 0
+        self.locked = 0
+        self.latencies = []
+
+    def percentile(self, share: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * share))] * 1000
+
+
+async def reader(session_factory, users: int, deadline: float, stats: Stats):
+    """Чтения как у хендлеров и проверки подписок: пользователь по id и выборка истекающих"""
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            async with session_factory() as session:
+                if random.random() < 0.9:
+                    await session.scalar(select(User).filter_by(
+                        telegram_id=1_000_000 + random.randrange(users)
+                    ))
+                else:
+                    now = datetime.utcnow()
+                    (await session.scalars(select(User).filter(
+                        User.subscription_end.between(now, now + timedelta(hours=24))
+                    ))).all()
+            stats.ops += 1
+            stats.latencies.append(time.perf_counter() - start)
+        except OperationalError:
+            stats.locked += 1
+
+
+async def writer(session_factory, users: int, deadline: float, stats: Stats):
+    """Записи как у продления подписки и флагов уведомлений: короткая транзакция на пользователя"""
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            async with session_factory() as session:
+                await session.execute(
+                    update(User)
+                    .where(User.telegram_id == 1_000_000 + random.randrange(users))
+                    .values(subscription_end=datetime.utcnow() + timedelta(days=30), notified_24h=False)
+                )
+                await session.commit()
+            stats.ops += 1
+            stats.latencies.append(time.perf_counter() - start)
+        except OperationalError:
+            stats.locked += 1
+
+
+async def run_profile(name: str, pragmas: dict, args) -> None:
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_engine = database.make_engine(os.path.join(tmp, "bench.db"), pragmas,
+                                         pool_size=args.readers + args.writers)
+        try:
+            await populate(db_engine, args.users)
+            session_factory = async_sessionmaker(db_engine, expire_on_commit=False)
+            reads, writes = Stats(), Stats()
+            deadline = time.perf_counter() + args.duration
+            await asyncio.gather(
+                *(reader(session_factory, args.users, deadline, reads) for _ in range(args.readers)),
+                *(writer(session_factory, args.users, deadline, writes) for _ in range(args.writers)),
+            )
+            journal = (await database.get_db_pragmas(db_engine))["journal_mode"]
+        finally:
+            await db_engine.dispose()
+
+    for kind, stats in (("read", reads), ("write", writes)):
+        print(
+            f"{name:<10} {journal:<9} {kind:<6} {stats.ops / args.duration:>9.0f} ops/s"
+            f"  p50 {stats.percentile(0.5):>7.2f} ms  p95 {stats.percentile(0.95):>8.2f} ms"
+            f"  locked {stats.locked}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    print(f"users={args.users} readers={args.readers} writers={args.writers} duration={args.duration}s")
+    # Базовая линия — как было: журнал отката, PRAGMA по умолчанию
+    asyncio.run(run_profile("default", None, args))
+    asyncio.run(run_profile("tuned", database.sqlite_pragmas(), args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# bench_xui.py
+"""Задержка и пропускная способность XUIAPI против локальной замены панели.
+
+Для каждого размера инбаунда поднимает benchmarks.xui_standin в отдельном процессе
+(чтобы сервер и клиент не делили один event loop) и меряет создание, удаление и
+чтение статистики — последовательно и пачкой параллельных запросов. Режим
+rewrite эмулирует старую панель без addClient/delClient: каждое изменение —
+чтение и полная перезапись инбаунда.
+
+Запуск из src:
+    python -m benchmarks.bench_xui --sizes 100,1000,10000,50000 --ops 50 --modes per-client,rewrite
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+async def start_standin(clients: int, per_client_api: bool, latency_ms: float):
+    port = free_port()
+    cmd = [
+        sys.executable, "-m", "benchmarks.xui_standin",
+        "--port", str(port), "--clients", str(clients), "--latency", str(latency_ms),
+    ]
+    if not per_client_api:
+        cmd.append("--no-per-client-api")
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    # Сервер печатает строку, когда готов принимать запросы (на 50k клиентов — несколько секунд)
+    await asyncio.get_running_loop().run_in_executor(None, process.stdout.readline)
+    return process, f"http://127.0.0.1:{port}"
+
+
+async def panel_stats(url: str) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{url}/_standin/stats") as resp:
+            return await resp.json()
+
+
+class Scenario:
+    """Замер одного сценария: задержки операций и счетчики панели до/после"""
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url
+        self.latencies = []
+        self.failures = 0
+
+    async def __aenter__(self):
+        self.before = await panel_stats(self.url)
+        self.started = time.perf_counter()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
+        after = await panel_stats(self.url)
+        self.requests = sum(after["requests"].values()) - sum(self.before["requests"].values())
+        self.bytes = (after["bytes_in"] + after["bytes_out"]) - (self.before["bytes_in"] + self.before["bytes_out"])
+
+    async def timed(self, coro):
+        start = time.perf_counter()
+        result = await coro
+        self.latencies.append(time.perf_counter() - start)
+        if not result:
+            self.failures += 1
+        return result
+
+    def row(self, size: int, mode: str) -> str:
+        ops = len(self.latencies)
+        return (
+            f"{size:>7} {mode:<10} {self.name:<14} {ops:>4} "
+            f"{1000 * statistics.median(self.latencies):>9.1f} {1000 * percentile(self.latencies, 95):>9.1f} "
+            f"{ops / self.elapsed:>9.1f} {self.requests:>6} {self.bytes / 1024 / 1024:>9.1f} {self.failures:>5}"
+        )
+
+
+async def run_size(size: int, mode: str, ops: int, latency_ms: float):
+    from config import XUINode
+    from functions import XUIAPI
+
+    process, url = await start_standin(size, mode == "per-client", latency_ms)
+    rows = []
+    try:
+        api = XUIAPI(XUINode(name=f"bench-{mode}", url=url, host="127.0.0.1", inbounds=[1]))
+        await api.ensure_login()
+        await api.get_inbound_snapshot(1, max_age=0)  # прогрев: мета инбаунда, кэш
+
+        async with Scenario("create seq", url) as sc:
+            profiles = [await sc.timed(api.create_vless_profile(10 ** 7 + i, 1)) for i in range(ops)]
+        rows.append(sc.row(size, mode))
+
+        async with Scenario("create burst", url) as sc:
+            profiles += await asyncio.gather(*(sc.timed(api.create_vless_profile(2 * 10 ** 7 + i, 1)) for i in range(ops)))
+        rows.append(sc.row(size, mode))
+
+        profiles = [p for p in profiles if p]
+        emails = [p["email"] for p in profiles]
+
+        async with Scenario("stats single", url) as sc:
+            await asyncio.gather(*(sc.timed(api.get_user_stats(email)) for email in emails[:ops]))
+        rows.append(sc.row(size, mode))
+
+        async with Scenario("stats bulk", url) as sc:
+            for _ in range(5):
+                await sc.timed(api.get_all_client_traffics(1, max_age=0))
+        rows.append(sc.row(size, mode))
+
+        half = len(profiles) // 2
+        async with Scenario("delete seq", url) as sc:
+            for p in profiles[:half]:
+                await sc.timed(api.delete_client(p["email"], p["client_id"], 1))
+        rows.append(sc.row(size, mode))
+
+        async with Scenario("delete burst", url) as sc:
+            await asyncio.gather(*(sc.timed(api.delete_client(p["email"], p["client_id"], 1)) for p in profiles[half:]))
+        rows.append(sc.row(size, mode))
+
+        await api.close()
+    finally:
+        process.terminate()
+        process.wait()
+    return rows
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон XUIAPI против xui_standin")
+    parser.add_argument("--sizes", default="100,1000,10000,50000")
+    parser.add_argument("--modes", default="per-client,rewrite")
+    parser.add_argument("--ops", type=int, default=50, help="операций в каждом сценарии")
+    parser.add_argument("--latency", type=float, default=5.0, help="сетевая задержка панели, мс")
+    args = parser.parse_args()
+
+    header = (
+        f"{'clients':>7} {'mode':<10} {'scenario':<14} {'ops':>4} {'p50, ms':>9} {'p95, ms':>9} "
+        f"{'ops/s':>9} {'reqs':>6} {'MB':>9} {'fail':>5}"
+    )
+    print(header)
+    print("-" * len(header))
+    for size in (int(s) for s in args.sizes.split(",")):
+        for mode in args.modes.split(","):
+            for row in await run_size(size, mode, args.ops, args.latency):
+                print(row, flush=True)
+        print()
+
+
+if __name__ == "__main__":
+    # XUIAPI читает настройки из окружения при импорте config
+    os.environ.setdefault("XUI_API_URL", "http://127.0.0.1")
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+# check_query_plans.py
+"""Проверка EXPLAIN QUERY PLAN: фоновые запросы к users не должны читать таблицу целиком.
+
+Запуск из src:  python -m benchmarks.check_query_plans [--users 100000]
+
+Заполняет временную базу, вызывает настоящие функции database.py, перехватывает
+их SQL и для каждого запроса смотрит план. Код выхода 1, если где-то полный скан.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+# Временная база должна быть выбрана до импорта config/database (из тестов — уже выбрана ими)
+_tmp = tempfile.TemporaryDirectory()
+if "database" not in sys.modules:
+    os.environ["DB_PATH"] = os.path.join(_tmp.name, "plans.db")
+
+from sqlalchemy import event  # noqa: E402
+
+import database  # noqa: E402
+from database import User  # noqa: E402
+
+
+async def populate(users: int):
+    """Распределение как в боевой базе: у части профиль, у немногих выставлены флаги"""
+    random.seed(1)
+    now = datetime.utcnow()
+    rows = []
+    for i in range(users):
+        end = now + timedelta(hours=random.randint(-24 * 120, 24 * 60))
+        has_profile = end > now and random.random() < 0.9
+        rows.append({
+            "telegram_id": 1_000_000 + i,
+            "full_name": f"User {i}",
+            "subscription_end": end,
+            "vless_profile_data": '{"email":"user_%d_0000"}' % i if has_profile else None,
+            "client_email": "user_%d_0000" % i if has_profile else None,
+            "is_admin": i < 3,
+            "notified_24h": has_profile and end < now + timedelta(hours=24),
+            "notified_2h": has_profile and end < now + timedelta(hours=2),
+        })
+    async with database.engine.begin() as conn:
+        await conn.execute(User.__table__.insert(), rows)
+        await conn.exec_driver_sql("ANALYZE")
+
+
+def background_queries():
+    """Запросы проверки подписок, сброса флагов, очистки, рассылок и сверки"""
+    now = datetime.utcnow()
+    return [
+        ("checker: expiring before T+24h", lambda: database.get_users_expiring_before(now + timedelta(hours=24))),
+        ("expiring subscriptions", lambda: database.get_users_with_expiring_subscription(24)),
+        ("active users (broadcast)", lambda: database.get_all_users(with_active_subscription=True)),
+        ("inactive users (broadcast)", lambda: database.get_all_users(with_active_subscription=False)),
+        ("reset notification flags", lambda: database.reset_notification_flags(now + timedelta(hours=24))),
+        ("cleanup expired users", database.cleanup_expired_users),
+        ("user stats", database.get_user_stats),
+        ("reconcile: users with profiles", database.get_users_with_profiles),
+        ("user by telegram_id", lambda: database.get_user(1_000_042)),
+        ("user by client email", lambda: database.get_user_by_client_email("user_42_0000")),
+        ("reconcile: known client emails",
+         lambda: database.get_known_client_emails(f"user_{i}_0000" for i in range(0, 2000, 7))),
+    ]
+
+
+async def collect_plans(users: int) -> list:
+    """Заполнить базу и снять планы: [(запрос, строка плана, полный скан)]"""
+    await database.init_db()
+    await populate(users)
+
+    captured = []
+
+    def _capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            captured.append((statement, parameters))
+
+    plans = []
+    sync_engine = database.engine.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", _capture)
+    try:
+        for name, call in background_queries():
+            captured.clear()
+            await call()
+            statements = list(captured)
+            async with database.engine.connect() as conn:
+                for statement, parameters in statements:
+                    if "FROM users" not in statement and "UPDATE users" not in statement:
+                        continue
+                    plan = (await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)).all()
+                    for row in plan:
+                        detail = row[-1]
+                        plans.append((name, detail, detail.startswith("SCAN") and "USING" not in detail))
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", _capture)
+    return plans
+
+
+async def run(users: int) -> bool:
+    plans = await collect_plans(users)
+    await database.close_db()
+    current = None
+    for name, detail, full_scan in plans:
+        if name != current:
+            print(f"■ {name}")
+            current = name
+        print(f"    {'❌' if full_scan else '✅'} {detail}")
+    return not any(full_scan for _, _, full_scan in plans)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    args = parser.parse_args()
+
+    try:
+        ok = asyncio.run(run(args.users))
+    finally:
+        _tmp.cleanup()
+    print("OK: all background queries use indexes" if ok else "FAIL: full table scans found")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+# xui_standin.py
+"""Локальная замена панели 3x-UI для проверок и нагрузочных прогонов.
+
+Реализует эндпоинты, которыми пользуется бот: /login, api/inbounds/get, update,
+getClientTraffics, onlines, addClient, delClient, updateClient. Инбаунд хранит
+settings строкой, как настоящая панель, поэтому каждая запись стоит O(N) и на
+стороне сервера.
+
+Запуск из src:
+    python -m benchmarks.xui_standin --clients 10000 --latency 20 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import random
+import uuid
+
+from aiohttp import web
+
+SESSION_COOKIE = "3x-ui"
+
+
+def make_clients(count: int, inbound_id: int = 1) -> list:
+    """Синтетические клиенты в формате бота"""
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "flow": "",
+            "email": f"user_{1000000 + i}_{inbound_id}{i % 1000:03d}",
+            "limitIp": 0,
+            "totalGB": 0,
+            "expiryTime": 0,
+            "enable": True,
+            "tgId": "",
+            "subId": "",
+            "reset": 0
+        }
+        for i in range(count)
+    ]
+
+
+class XUIStandIn:
+    """Панель в памяти с настраиваемой задержкой и инъекцией ошибок.
+
+    latency / jitter — задержка каждого запроса (сек), error_rate — доля ответов 500,
+    slow_rate / slow_latency — доля «зависших» запросов и их задержка,
+    per_client_api=False — старая панель без addClient/delClient/updateClient.
+    """
+
+    def __init__(self, clients: int = 0, inbounds=(1,), base_path: str = "/panel",
+                 username: str = "admin", password: str = "admin",
+                 latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 slow_rate: float = 0.0, slow_latency: float = 30.0, per_client_api: bool = True,
+                 seed: int = None):
+        self.base_path = "/" + base_path.strip("/") if base_path.strip("/") else ""
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.per_client_api = per_client_api
+        self.random = random.Random(seed)
+        self.token = uuid.uuid4().hex
+        self.inbounds = {}
+        for inbound_id in inbounds:
+            self.reset_inbound(inbound_id, clients)
+        self.stats = {"requests": {}, "errors": 0, "bytes_in": 0, "bytes_out": 0, "logins": 0}
+        self.app = self._build_app()
+        self._runner = None
+
+    def reset_inbound(self, inbound_id: int, clients: int):
+        """Пересоздать инбаунд с clients синтетическими клиентами"""
+        client_list = make_clients(clients, inbound_id)
+        self.inbounds[inbound_id] = {
+            "id": inbound_id, "up": 0, "down": 0, "total": 0, "remark": f"standin-{inbound_id}",
+            "enable": True, "expiryTime": 0, "listen": "", "port": 40000 + inbound_id,
+            "protocol": "vless",
+            "settings": json.dumps({"clients": client_list, "decryption": "none", "fallbacks": []}),
+            "streamSettings": json.dumps({"network": "tcp", "security": "reality"}),
+            "sniffing": json.dumps({"enabled": False}),
+            "allocate": None,
+            # Счетчики трафика панель хранит отдельно от settings
+            "traffic": {
+                c["email"]: {"up": self.random.randint(0, 10 ** 9), "down": self.random.randint(0, 10 ** 10)}
+                for c in client_list
+            },
+        }
+
+    # ----- служебное -----
+
+    def _build_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware], client_max_size=1024 ** 3)
+        api = f"{self.base_path}/api/inbounds"
+        app.router.add_post("/login", self.login)
+        app.router.add_get(f"{api}/get/{{id}}", self.get_inbound)
+        app.router.add_post(f"{api}/update/{{id}}", self.update_inbound)
+        app.router.add_get(f"{api}/getClientTraffics/{{email}}", self.client_traffics)
+        app.router.add_post(f"{api}/onlines", self.onlines)
+        if self.per_client_api:
+            app.router.add_post(f"{api}/addClient", self.add_client)
+            app.router.add_post(f"{api}/{{id}}/delClient/{{client_id}}", self.del_client)
+            app.router.add_post(f"{api}/updateClient/{{client_id}}", self.update_client)
+        app.router.add_get("/_standin/stats", self.get_stats)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        if request.path.startswith("/_standin"):
+            return await handler(request)
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.stats["requests"][route] = self.stats["requests"].get(route, 0) + 1
+        self.stats["bytes_in"] += request.content_length or 0
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if self.slow_rate and self.random.random() < self.slow_rate:
+            delay += self.slow_latency
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response({"success": False, "msg": "injected error"}, status=500)
+
+        if request.path != "/login" and request.cookies.get(SESSION_COOKIE) != self.token:
+            # Настоящая панель отправляет неавторизованных на страницу логина
+            raise web.HTTPFound("/login")
+
+        response = await handler(request)
+        if response.body is not None:
+            self.stats["bytes_out"] += len(response.body)
+        return response
+
+    def _inbound(self, request):
+        return self.inbounds.get(int(request.match_info["id"]))
+
+    @staticmethod
+    def _ok(obj=None, msg: str = ""):
+        return web.json_response({"success": True, "msg": msg, "obj": obj})
+
+    @staticmethod
+    def _fail(msg: str):
+        return web.json_response({"success": False, "msg": msg, "obj": None})
+
+    @staticmethod
+    def _clients(inbound) -> list:
+        return json.loads(inbound["settings"])["clients"]
+
+    @staticmethod
+    def _store(inbound, clients: list):
+        settings = json.loads(inbound["settings"])
+        settings["clients"] = clients
+        inbound["settings"] = json.dumps(settings)
+
+    # ----- эндпоинты панели -----
+
+    async def login(self, request):
+        form = await request.post()
+        if form.get("username") != self.username or form.get("password") != self.password:
+            return self._fail("wrong username or password")
+        self.stats["logins"] += 1
+        response = self._ok(msg="Login Successfully")
+        response.set_cookie(SESSION_COOKIE, self.token)
+        return response
+
+    async def get_inbound(self, request):
+        inbound = self._inbound(request)
+        if inbound is None:
+            return self._fail("inbound not found")
+        obj = {key: value for key, value in inbound.items() if key != "traffic"}
+        obj["clientStats"] = [
+            {"inboundId": inbound["id"], "email": email, "up": t["up"], "down": t["down"], "enable": True}
+            for email, t in inbound["traffic"].items()
+        ]
+        obj["up"] = sum(t["up"] for t in inbound["traffic"].values())
+        obj["down"] = sum(t["down"] for t in inbound["traffic"].values())
+        return self._ok(obj)
+
+    async def update_inbound(self, request):
+        inbound = self._inbound(request)
+        if inbound is None:
+            return self._fail("inbound not found")
+        body = await request.json()
+        clients = json.loads(body["settings"])["clients"]
+        emails = [c["email"] for c in clients]
+        if len(set(emails)) != len(emails):
+            return self._fail("Duplicate email")
+        inbound["settings"] = body["settings"]
+        inbound["traffic"] = {e: inbound["traffic"].get(e, {"up": 0, "down": 0}) for e in emails}
+        return self._ok(msg="Update Successfully")
+
+    async def add_client(self, request):
+        body = await request.json()
+        inbound = self.inbounds.get(int(body["id"]))
+        if inbound is None:
+            return self._fail("inbound not found")
+        new = json.loads(body["settings"])["clients"]
+        clients = self._clients(inbound)
+        existing = {c["email"] for c in clients}
+        if any(c["email"] in existing for c in new):
+            return self._fail("Duplicate email")
+        self._store(inbound, clients + new)
+        for c in new:
+            inbound["traffic"][c["email"]] = {"up": 0, "down": 0}
+        return self._ok(msg="Client(s) added Successfully")
+
+    async def del_client(self, request):
+        inbound = self._inbound(request)
+        if inbound is None:
+            return self._fail("inbound not found")
+        client_id = request.match_info["client_id"]
+        clients = self._clients(inbound)
+        kept = [c for c in clients if c["id"] != client_id]
+        if len(kept) == len(clients):
+            return self._fail("Client Not Found")
+        removed = {c["email"] for c in clients} - {c["email"] for c in kept}
+        self._store(inbound, kept)
+        for email in removed:
+            inbound["traffic"].pop(email, None)
+        return self._ok(msg="Client deleted Successfully")
+
+    async def update_client(self, request):
+        body = await request.json()
+        inbound = self.inbounds.get(int(body["id"]))
+        if inbound is None:
+            return self._fail("inbound not found")
+        client_id = request.match_info["client_id"]
+        updated = json.loads(body["settings"])["clients"][0]
+        clients = self._clients(inbound)
+        for i, client in enumerate(clients):
+            if client["id"] == client_id:
+                clients[i] = updated
+                self._store(inbound, clients)
+                return self._ok(msg="Client updated Successfully")
+        return self._fail("Client Not Found")
+
+    async def client_traffics(self, request):
+        email = request.match_info["email"]
+        for inbound in self.inbounds.values():
+            traffic = inbound["traffic"].get(email)
+            if traffic is not None:
+                return self._ok({"inboundId": inbound["id"], "email": email, **traffic, "enable": True})
+        return self._ok(None)
+
+    async def onlines(self, request):
+        emails = [email for inbound in self.inbounds.values() for email in inbound["traffic"]]
+        return self._ok(emails[:max(1, len(emails) // 10)])
+
+    async def get_stats(self, request):
+        return web.json_response({
+            **self.stats,
+            "clients": {inbound_id: len(self._clients(i)) for inbound_id, i in self.inbounds.items()},
+        })
+
+    # ----- запуск -----
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запустить сервер; возвращает базовый URL (порт 0 — любой свободный)"""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена панели 3x-UI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2053)
+    parser.add_argument("--clients", type=int, default=1000, help="клиентов в каждом инбаунде")
+    parser.add_argument("--inbounds", default="1", help="id инбаундов через запятую")
+    parser.add_argument("--base-path", default="/panel")
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, мс")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="доля зависающих запросов")
+    parser.add_argument("--slow-latency", type=float, default=30.0, help="задержка зависшего запроса, сек")
+    parser.add_argument("--no-per-client-api", action="store_true", help="без addClient/delClient/updateClient")
+    args = parser.parse_args()
+
+    standin = XUIStandIn(
+        clients=args.clients,
+        inbounds=[int(i) for i in args.inbounds.split(",")],
+        base_path=args.base_path,
+        username=args.username,
+        password=args.password,
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        per_client_api=not args.no_per_client_api,
+    )
+
+    async def serve():
+        url = await standin.start(args.host, args.port)
+        print(f"3x-ui stand-in: {url} ({args.clients} clients per inbound, Ctrl+C to stop)", flush=True)
+        try:
+            while True:
+                await asyncio.sleep(3600)
+        finally:
+            await standin.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# checker_metrics.py
+import asyncio
+import time
+from contextlib import asynccontextmanager, nullcontext
+
+# Верхние границы корзин гистограммы длительности прохода, секунды (последняя — остальное)
+PASS_BUCKETS = (0.5, 1, 5, 15, 60, 300)
+
+
+class StageStats:
+    """Время стадии: ожидание семафора и сама работа"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+        self.in_flight = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "avg_wait_ms": self.wait_total / self.count * 1000 if self.count else 0.0,
+            "avg_ms": self.run_total / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.run_max * 1000,
+        }
+
+
+class PipelineMetrics:
+    """Метрики конвейера проверки подписок: стадии (xui, db, telegram) и проходы.
+
+    stage() ограничивает параллелизм стадии своим семафором и замеряет отдельно
+    ожидание в очереди и выполнение — так видно, какая стадия узкое место.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.passes = 0
+        self.last_pass = None       # (длительность, пользователей)
+        self.pass_histogram = [0] * (len(PASS_BUCKETS) + 1)
+
+    @asynccontextmanager
+    async def stage(self, name: str, semaphore: asyncio.Semaphore = None):
+        stats = self.stages.setdefault(name, StageStats())
+        queued = time.perf_counter()
+        async with semaphore or nullcontext():
+            started = time.perf_counter()
+            stats.in_flight += 1
+            try:
+                yield
+            except BaseException:
+                stats.errors += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                stats.in_flight -= 1
+                stats.count += 1
+                stats.wait_total += started - queued
+                stats.run_total += elapsed
+                stats.run_max = max(stats.run_max, elapsed)
+
+    def record_pass(self, duration: float, users: int):
+        self.passes += 1
+        self.last_pass = (duration, users)
+        for i, bound in enumerate(PASS_BUCKETS):
+            if duration <= bound:
+                self.pass_histogram[i] += 1
+                return
+        self.pass_histogram[-1] += 1
+
+    def histogram(self) -> list:
+        """[(подпись корзины, число проходов)]"""
+        labels = [f"≤{bound:g}s" for bound in PASS_BUCKETS] + [f">{PASS_BUCKETS[-1]:g}s"]
+        return list(zip(labels, self.pass_histogram))
+
+    def snapshot(self) -> dict:
+        return {
+            "passes": self.passes,
+            "last_pass": self.last_pass,
+            "histogram": self.histogram(),
+            "stages": {name: stats.as_dict() for name, stats in self.stages.items()},
+        }
+
+
+checker_metrics = PipelineMetrics()
@@ -1,4 +1,6 @@
 import os
+import json
+from functools import cached_property
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field, field_validator
 from typing import List, Dict
@@ -22,16 +24,108 @@ payments_logger.info("Платеж успешен")  # Только в payments.
 error_logger = logging.getLogger('errors')
 error_logger.error("Критическая ошибка")  # Только в errors.log
 
+class XUINode(BaseModel):
+    """Сервер 3x-UI и инбаунды на нем, в которые можно селить клиентов"""
+    name: str
+    url: str
+    base_path: str = "/panel"
+    username: str = "admin"
+    password: str = "admin"
+    host: str
+    inbounds: List[int]
+    max_clients: int = 0  # 0 — без ограничения на инбаунд
+
+    reality_public_key: str = ""
+    reality_fingerprint: str = "chrome"
+    reality_sni: str = "example.com"
+    reality_short_id: str = ""
+    reality_spider_x: str = "/"
+
+
 class Config(BaseModel):
     BOT_TOKEN: str = os.getenv("BOT_TOKEN", "")
     ADMINS: List[int] = Field(default_factory=list)
 
+    # База данных: абсолютный путь (по умолчанию users.db рядом с кодом, а не в текущем каталоге)
+    DB_PATH: str = os.path.abspath(os.getenv(
+        "DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "users.db")
+    ))
+    # Профиль SQLite: журнал, режим синхронизации, кэш страниц (КиБ), mmap (байт),
+    # сколько мс ждать снятия блокировки и размер пула соединений
+    SQLITE_JOURNAL_MODE: str = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+    SQLITE_SYNCHRONOUS: str = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+    SQLITE_CACHE_SIZE_KB: int = int(os.getenv("SQLITE_CACHE_SIZE_KB", 20000))
+    SQLITE_MMAP_SIZE: int = int(os.getenv("SQLITE_MMAP_SIZE", 128 * 1024 * 1024))
+    SQLITE_BUSY_TIMEOUT_MS: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+    SQLITE_POOL_SIZE: int = int(os.getenv("SQLITE_POOL_SIZE", 5))
+    # Кэш снимков пользователей для хендлеров: сколько держать в памяти и сколько секунд (0 — выключен)
+    USER_CACHE_SIZE: int = int(os.getenv("USER_CACHE_SIZE", 10000))
+    USER_CACHE_TTL: float = float(os.getenv("USER_CACHE_TTL", 30))
+    # Сколько строк users обрабатывает один пакет фоновой миграции
+    MIGRATION_BATCH_SIZE: int = int(os.getenv("MIGRATION_BATCH_SIZE", 1000))
+
     XUI_API_URL: str = os.getenv("XUI_API_URL", "http://localhost:54321")
     XUI_BASE_PATH: str = os.getenv("XUI_BASE_PATH", "/panel")
     XUI_USERNAME: str = os.getenv("XUI_USERNAME", "admin")
     XUI_PASSWORD: str = os.getenv("XUI_PASSWORD", "admin")
     XUI_HOST: str = os.getenv("XUI_HOST", "your-server.com")
     XUI_SERVER_NAME: str = os.getenv("XUI_SERVER_NAME", "domain.com")
+    # Несколько панелей: JSON-список узлов (поля XUINode). Пусто — один узел из XUI_*
+    XUI_NODES: str = os.getenv("XUI_NODES", "")
+    XUI_NODE_NAME: str = os.getenv("XUI_NODE_NAME", "main")
+    # Вес недавнего трафика при выборе узла (0 — только по числу клиентов)
+    XUI_PLACEMENT_TRAFFIC_WEIGHT: float = float(os.getenv("XUI_PLACEMENT_TRAFFIC_WEIGHT", 1))
+    # Пул соединений общего клиента панели
+    XUI_POOL_SIZE: int = int(os.getenv("XUI_POOL_SIZE", 10))
+    XUI_KEEPALIVE_TIMEOUT: int = int(os.getenv("XUI_KEEPALIVE_TIMEOUT", 60))
+    # Дедлайны запросов к панели (сек): логин, легкие чтения, полный инбаунд, записи клиентов
+    XUI_TIMEOUT_LOGIN: float = float(os.getenv("XUI_TIMEOUT_LOGIN", 10))
+    XUI_TIMEOUT_READ: float = float(os.getenv("XUI_TIMEOUT_READ", 10))
+    XUI_TIMEOUT_INBOUND: float = float(os.getenv("XUI_TIMEOUT_INBOUND", 30))
+    XUI_TIMEOUT_WRITE: float = float(os.getenv("XUI_TIMEOUT_WRITE", 15))
+    # Повторы идемпотентных чтений с экспоненциальной паузой и джиттером
+    XUI_RETRIES: int = int(os.getenv("XUI_RETRIES", 2))
+    XUI_RETRY_BASE_DELAY: float = float(os.getenv("XUI_RETRY_BASE_DELAY", 0.5))
+    XUI_RETRY_MAX_DELAY: float = float(os.getenv("XUI_RETRY_MAX_DELAY", 5))
+    # Предохранитель: сколько ошибок подряд размыкает его и через сколько секунд пробуем снова
+    XUI_BREAKER_THRESHOLD: int = int(os.getenv("XUI_BREAKER_THRESHOLD", 5))
+    XUI_BREAKER_RESET_TIMEOUT: float = float(os.getenv("XUI_BREAKER_RESET_TIMEOUT", 30))
+    # Окно склейки изменений инбаунда (сек) и порог, после которого пачку
+    # удалений выгоднее записать одной перезаписью инбаунда
+    XUI_COALESCE_WINDOW: float = float(os.getenv("XUI_COALESCE_WINDOW", 0.2))
+    XUI_REWRITE_THRESHOLD: int = int(os.getenv("XUI_REWRITE_THRESHOLD", 20))
+    # Сколько секунд снимок инбаунда считается свежим
+    XUI_INBOUND_CACHE_TTL: float = float(os.getenv("XUI_INBOUND_CACHE_TTL", 10))
+    # Статистику трафика пользователям можно показывать из снимка постарше
+    XUI_TRAFFIC_CACHE_TTL: float = float(os.getenv("XUI_TRAFFIC_CACHE_TTL", 60))
+    # Сэмплы трафика: интервал (сек), сколько дней хранить детально и сколько всего
+    TRAFFIC_SAMPLE_INTERVAL: int = int(os.getenv("TRAFFIC_SAMPLE_INTERVAL", 900))
+    TRAFFIC_RAW_RETENTION_DAYS: int = int(os.getenv("TRAFFIC_RAW_RETENTION_DAYS", 8))
+    TRAFFIC_RETENTION_DAYS: int = int(os.getenv("TRAFFIC_RETENTION_DAYS", 180))
+    # Пауза между сообщениями рассылки (лимит Telegram ~30 сообщений/сек)
+    STATS_SEND_DELAY: float = float(os.getenv("STATS_SEND_DELAY", 0.05))
+    # Сверка БД с панелью: период (сек, 0 — выключена) и максимальная доля
+    # клиентов бота, которую разрешено удалить за один проход
+    RECONCILE_INTERVAL: int = int(os.getenv("RECONCILE_INTERVAL", 6 * 3600))
+    RECONCILE_MAX_DELETE_SHARE: float = float(os.getenv("RECONCILE_MAX_DELETE_SHARE", 0.5))
+    # Планировщик истечений: раз в сколько секунд заново читать дедлайны из БД
+    # (страховка от записей в обход database.py)
+    EXPIRY_RESEED_INTERVAL: int = int(os.getenv("EXPIRY_RESEED_INTERVAL", 3600))
+    # Сколько одновременных операций каждого вида в проходе проверки подписок:
+    # запросы к панели, записи в SQLite (писатель все равно один) и сообщения Telegram
+    CHECKER_XUI_CONCURRENCY: int = int(os.getenv("CHECKER_XUI_CONCURRENCY", 4))
+    CHECKER_DB_CONCURRENCY: int = int(os.getenv("CHECKER_DB_CONCURRENCY", 2))
+    CHECKER_TELEGRAM_CONCURRENCY: int = int(os.getenv("CHECKER_TELEGRAM_CONCURRENCY", 10))
+    # Подписочные ссылки: порт встроенного HTTP-сервера (0 — выключен), публичный адрес,
+    # секрет для токенов (пусто — выводится из BOT_TOKEN), TTL кэша фидов и интервал
+    # обновления для клиентских приложений (часы)
+    SUBSCRIPTION_PORT: int = int(os.getenv("SUBSCRIPTION_PORT", 0))
+    SUBSCRIPTION_HOST: str = os.getenv("SUBSCRIPTION_HOST", "0.0.0.0")
+    SUBSCRIPTION_BASE_URL: str = os.getenv("SUBSCRIPTION_BASE_URL", "")
+    SUBSCRIPTION_SECRET: str = os.getenv("SUBSCRIPTION_SECRET", "")
+    SUBSCRIPTION_CACHE_TTL: float = float(os.getenv("SUBSCRIPTION_CACHE_TTL", 60))
+    SUBSCRIPTION_UPDATE_INTERVAL: int = int(os.getenv("SUBSCRIPTION_UPDATE_INTERVAL", 12))
+    SUBSCRIPTION_TITLE: str = os.getenv("SUBSCRIPTION_TITLE", "TunnelBot")
 
     PAYMENT_TOKEN: str = os.getenv("PAYMENT_TOKEN", "")
     INBOUND_ID: int = Field(default=os.getenv("INBOUND_ID", 1))
@@ -83,6 +177,40 @@ class Config(BaseModel):
             return int(value)
         return value or 15
 
+    @cached_property
+    def nodes(self) -> List[XUINode]:
+        """Узлы 3x-UI: из XUI_NODES или один узел из старых настроек XUI_*"""
+        defaults = {
+            "base_path": self.XUI_BASE_PATH,
+            "username": self.XUI_USERNAME,
+            "password": self.XUI_PASSWORD,
+            "reality_public_key": self.REALITY_PUBLIC_KEY,
+            "reality_fingerprint": self.REALITY_FINGERPRINT,
+            "reality_sni": self.REALITY_SNI,
+            "reality_short_id": self.REALITY_SHORT_ID,
+            "reality_spider_x": self.REALITY_SPIDER_X,
+        }
+        if self.XUI_NODES.strip():
+            return [XUINode(**{**defaults, **node}) for node in json.loads(self.XUI_NODES)]
+        return [XUINode(
+            name=self.XUI_NODE_NAME,
+            url=self.XUI_API_URL,
+            host=self.XUI_HOST,
+            inbounds=[self.INBOUND_ID],
+            **defaults
+        )]
+
+    @property
+    def default_node(self) -> XUINode:
+        """Узел для статических профилей и старых профилей без поля node"""
+        return self.nodes[0]
+
+    def get_node(self, name: str = None) -> XUINode:
+        for node in self.nodes:
+            if node.name == name:
+                return node
+        return self.default_node
+
     def calculate_price(self, months: int) -> int:
         if months not in self.PRICES:
             return 0
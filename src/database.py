@@ -1,8 +1,13 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, func
-from sqlalchemy.orm import declarative_base, sessionmaker
-from datetime import datetime, timedelta
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Index, func, update, delete, select, event, case, type_coerce, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
 import logging
-import json
+import serialization
+from config import config
+from user_cache import UserCache
 
 # В handlers.py, database.py, functions.py и других модулях
 import logging
@@ -40,10 +45,49 @@ class User(Base):
     is_admin = Column(Boolean, default=False)
     notified_24h = Column(Boolean, default=False)  # Уведомление за 24 часа
     notified_2h = Column(Boolean, default=False)   # Уведомление за 2 часа
-    # Новые поля для статистики
+    # Новые поля для статистики: последние счетчики панели (NULL — еще не видели, базы нет)
     total_upload = Column(Integer, default=0)
     total_download = Column(Integer, default=0)
     last_activity = Column(DateTime, default=datetime.utcnow)
+    # Поля профиля, вынесенные из vless_profile_data (см. profile_columns)
+    client_uuid = Column(String)
+    client_email = Column(String)
+    client_port = Column(Integer)
+    node = Column(String)
+    inbound_id = Column(Integer)
+
+    # Частичные индексы под фоновые выборки: в каждый попадает только нужная
+    # доля строк, а условие индекса повторяется в WHERE запроса дословно
+    __table_args__ = (
+        # Проверка подписок, рассылки, сверка: пользователи с профилем по сроку
+        Index('ix_users_profile_end', 'subscription_end',
+              sqlite_where=vless_profile_data.isnot(None)),
+        # Очистка и список «без подписки»: пользователи без профиля по сроку
+        Index('ix_users_no_profile_end', 'subscription_end',
+              sqlite_where=vless_profile_data.is_(None)),
+        # Сброс флагов после продления: только уже уведомленные
+        Index('ix_users_notified_end', 'subscription_end',
+              sqlite_where=(notified_24h == True) | (notified_2h == True)),
+        # Поиск пользователя по email клиента: сверка с панелью, админский поиск
+        Index('ix_users_client_email', 'client_email',
+              sqlite_where=client_email.isnot(None)),
+        # Профили, до которых еще не дошел бэкфилл колонок (после него индекс пуст)
+        Index('ix_users_profile_pending', 'id',
+              sqlite_where=vless_profile_data.isnot(None) & client_email.is_(None)),
+    )
+
+class TrafficSample(Base):
+    """Трафик пользователя за интервал (дельта счетчиков панели)"""
+    __tablename__ = 'traffic_samples'
+    user_id = Column(Integer, primary_key=True)  # users.id
+    ts = Column(Integer, primary_key=True)       # начало интервала, epoch секунды
+    up = Column(Integer, nullable=False, default=0)
+    down = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_traffic_samples_ts', 'ts'),
+        {'sqlite_with_rowid': False},  # Компактное хранение: строка = ключ + два числа
+    )
 
 class StaticProfile(Base):
     __tablename__ = 'static_profiles'
@@ -52,29 +96,134 @@ class StaticProfile(Base):
     vless_url = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-# Используем SQLite с подключением в память для тестов или файл
-engine = create_engine('sqlite:///users.db', echo=False, pool_pre_ping=True)
-Session = sessionmaker(bind=engine, expire_on_commit=False)
+class SchemaMigration(Base):
+    """Примененные миграции (migrations.py); cursor — прогресс пакетной миграции по users.id"""
+    __tablename__ = 'schema_migrations'
+    version = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    cursor = Column(Integer, default=0)
+    applied_at = Column(DateTime)  # NULL — миграция еще не завершена
+    duration_ms = Column(Integer)
+
+class SubscriptionPayment(Base):
+    """Зачтенный платеж: повторная обработка того же payment_id не продлевает подписку второй раз"""
+    __tablename__ = 'subscription_payments'
+    payment_id = Column(String, primary_key=True)  # stars:<charge_id>, manual:<...>
+    telegram_id = Column(Integer, nullable=False)
+    seconds = Column(Integer, nullable=False)
+    subscription_end = Column(DateTime)  # дата окончания после зачисления
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# PRAGMA, которые показываем в отчете при старте
+REPORTED_PRAGMAS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "busy_timeout", "temp_store")
+SYNCHRONOUS_NAMES = {0: "OFF", 1: "NORMAL", 2: "FULL", 3: "EXTRA"}
+
+def sqlite_pragmas() -> dict:
+    """PRAGMA для каждого нового соединения по настройкам из config"""
+    return {
+        # WAL: читатели не ждут писателя, писатель не ждет читателей
+        "journal_mode": config.SQLITE_JOURNAL_MODE,
+        # В WAL режим NORMAL не теряет целостность, только последние транзакции при сбое питания
+        "synchronous": config.SQLITE_SYNCHRONOUS,
+        "cache_size": -config.SQLITE_CACHE_SIZE_KB,  # отрицательное значение — размер в КиБ
+        "mmap_size": config.SQLITE_MMAP_SIZE,
+        "busy_timeout": config.SQLITE_BUSY_TIMEOUT_MS,
+        "temp_store": "MEMORY",
+    }
+
+def make_engine(path: str, pragmas: dict = None, pool_size: int = None):
+    """Асинхронный движок SQLite; pragmas выставляются на каждом новом соединении пула"""
+    db_engine = create_async_engine(
+        f"sqlite+aiosqlite:///{path}", echo=False,
+        pool_size=pool_size or config.SQLITE_POOL_SIZE
+    )
+    if pragmas:
+        @event.listens_for(db_engine.sync_engine, "connect")
+        def _apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+    return db_engine
+
+# Асинхронный движок (aiosqlite): запросы не блокируют event loop бота
+engine = make_engine(config.DB_PATH, sqlite_pragmas())
+Session = async_sessionmaker(engine, expire_on_commit=False)
+# Снимки пользователей для горячих хендлеров; каждая запись ниже сбрасывает свои ключи
+user_cache = UserCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+
+# Подписчики изменений срока/профиля: callback(telegram_id, subscription_end).
+# Вызываются после коммита; через них планировщик истечений узнает о продлениях
+_subscription_listeners = []
+
+def add_subscription_listener(callback):
+    _subscription_listeners.append(callback)
+
+def remove_subscription_listener(callback):
+    if callback in _subscription_listeners:
+        _subscription_listeners.remove(callback)
+
+def _subscription_changed(telegram_id: int, subscription_end):
+    for callback in _subscription_listeners:
+        try:
+            callback(telegram_id, subscription_end)
+        except Exception as e:
+            logger.error(f"❌ Subscription listener failed for {telegram_id}: {e}")
+
+async def get_db_pragmas(db_engine=None) -> dict:
+    """Фактические значения PRAGMA на соединении из пула"""
+    async with (db_engine or engine).connect() as conn:
+        pragmas = {
+            name: (await conn.exec_driver_sql(f"PRAGMA {name}")).scalar()
+            for name in REPORTED_PRAGMAS
+        }
+    pragmas["synchronous"] = SYNCHRONOUS_NAMES.get(pragmas["synchronous"], pragmas["synchronous"])
+    return pragmas
 
 async def init_db():
     """Инициализация базы данных"""
-    Base.metadata.create_all(engine)
-    logger.info("✅ Database tables created")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    logger.info(f"✅ Database tables created: {config.DB_PATH}")
+
+    pragmas = await get_db_pragmas()
+    logger.info("ℹ️ SQLite pragmas: " + ", ".join(f"{name}={value}" for name, value in pragmas.items()))
+    expected = sqlite_pragmas()
+    for name in ("journal_mode", "synchronous"):
+        if str(pragmas[name]).lower() != str(expected[name]).lower():
+            logger.warning(f"⚠️ SQLite {name} is {pragmas[name]}, expected {expected[name]}")
+
+async def close_db():
+    """Закрытие пула соединений при остановке бота"""
+    await engine.dispose()
 
 def get_session():
-    """Получение сессии БД"""
+    """Получение сессии БД (async with get_session() as session: ...)"""
     return Session()
 
+async def _get_user(session, telegram_id: int):
+    return await session.scalar(select(User).filter_by(telegram_id=telegram_id))
+
 async def get_user(telegram_id: int):
-    """Получить пользователя по Telegram ID"""
-    with Session() as session:
-        return session.query(User).filter_by(telegram_id=telegram_id).first()
+    """Получить пользователя по Telegram ID (свежий снимок — из кэша)"""
+    user = user_cache.get(telegram_id)
+    if user is not None:
+        return user
+    generation = user_cache.generation
+    async with Session() as session:
+        user = await _get_user(session, telegram_id)
+    user_cache.put(telegram_id, user, generation)
+    return user
+
+def get_user_cache_stats() -> dict:
+    """Размер и hit rate кэша пользователей"""
+    return user_cache.stats()
 
 async def create_user(telegram_id: int, full_name: str, username: str = None, is_admin: bool = False):
     """Создать нового пользователя"""
-    with Session() as session:
+    async with Session() as session:
         # Проверяем, не существует ли уже пользователь
-        existing = session.query(User).filter_by(telegram_id=telegram_id).first()
+        existing = await _get_user(session, telegram_id)
         if existing:
             logger.info(f"ℹ️ User already exists: {telegram_id}")
             return existing
@@ -88,72 +237,223 @@ async def create_user(telegram_id: int, full_name: str, username: str = None, is
             last_activity=datetime.utcnow()
         )
         session.add(user)
-        session.commit()
+        await session.commit()
+        user_cache.invalidate(telegram_id)
+        _subscription_changed(telegram_id, user.subscription_end)
         logger.info(f"✅ New user created: {telegram_id} ({full_name})")
         return user
 
+async def update_user_info(telegram_id: int, **fields):
+    """Обновить произвольные поля пользователя (имя, username и т.п.)"""
+    if not fields:
+        return False
+    async with Session() as session:
+        result = await session.execute(
+            update(User).where(User.telegram_id == telegram_id).values(**fields)
+        )
+        await session.commit()
+        user_cache.invalidate(telegram_id)
+        return result.rowcount > 0
+
+# Колонка users -> ключ в vless_profile_data
+PROFILE_COLUMNS = {
+    "client_uuid": "client_id",
+    "client_email": "email",
+    "client_port": "port",
+    "node": "node",
+    "inbound_id": "inbound_id",
+}
+
+def as_utc(value: datetime):
+    """Дата из БД как aware UTC.
+
+    Наивные даты в БД — UTC: их пишут datetime.utcnow() и SQL-выражения этого модуля.
+    Единое правило для всех, кто сравнивает subscription_end со временем или переводит его в мс
+    """
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def _as_int(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def profile_columns(profile_data) -> dict:
+    """Значения вынесенных колонок для данных профиля (None — сбросить профиль)"""
+    if not isinstance(profile_data, dict):
+        return dict.fromkeys(PROFILE_COLUMNS)
+    values = {column: profile_data.get(key) for column, key in PROFILE_COLUMNS.items()}
+    values["client_port"] = _as_int(values["client_port"])
+    values["inbound_id"] = _as_int(values["inbound_id"])
+    return values
+
+def profile_ref(user) -> dict:
+    """Где живет клиент пользователя: email, client_id, node, inbound_id, port.
+
+    Читается из колонок; JSON разбирается, только если строку еще не заполнил
+    бэкфилл (фоновая миграция profile_columns_backfill).
+    Пустой словарь — профиля нет или он нечитаем.
+    """
+    if not user.vless_profile_data:
+        return {}
+    if user.client_email is None:
+        try:
+            profile_data = serialization.loads(user.vless_profile_data)
+        except serialization.JSONDecodeError:
+            return {}
+        return profile_data if isinstance(profile_data, dict) else {}
+    return {key: getattr(user, column) for column, key in PROFILE_COLUMNS.items()}
+
 async def delete_user_profile(telegram_id: int):
     """Удалить профиль пользователя (при истечении подписки)"""
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    async with Session() as session:
+        user = await _get_user(session, telegram_id)
         if user:
             # Полностью сбрасываем данные профиля
             user.vless_profile_data = None
             user.vless_profile_id = None
+            for column, value in profile_columns(None).items():
+                setattr(user, column, value)
             user.notified_24h = False
             user.notified_2h = False
             # subscription_end не меняем - он уже прошедшая дата
             
-            session.commit()
+            await session.commit()
+            user_cache.invalidate(telegram_id)
             logger.info(f"✅ User profile deleted: {telegram_id}")
             return True
     return False
 
-async def update_user_profile(telegram_id: int, profile_data: dict):
+async def update_user_profile(telegram_id: int, profile_data: dict, reset_notifications: bool = True):
     """Обновить VPN профиль пользователя"""
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    async with Session() as session:
+        user = await _get_user(session, telegram_id)
         if user:
-            user.vless_profile_data = json.dumps(profile_data, ensure_ascii=False)
-            user.notified_24h = False
-            user.notified_2h = False
+            user.vless_profile_data = serialization.dumps(profile_data)
+            for column, value in profile_columns(profile_data).items():
+                setattr(user, column, value)
+            if reset_notifications:
+                user.notified_24h = False
+                user.notified_2h = False
             user.last_activity = datetime.utcnow()
-            session.commit()
+            await session.commit()
+            user_cache.invalidate(telegram_id)
+            _subscription_changed(telegram_id, user.subscription_end)
             logger.info(f"✅ User profile updated: {telegram_id}")
             return True
     return False
 
-async def update_subscription(telegram_id: int, days: int, reset_notifications: bool = True):
-    """Обновляет подписку пользователя"""
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
-        if user:
-            now = datetime.utcnow()
-            
-            # Если подписка активна, добавляем к текущей дате окончания
-            if user.subscription_end and user.subscription_end > now:
-                user.subscription_end += timedelta(days=days)
-            else:
-                # Если подписка истекла или ее нет, начинаем с текущей даты
-                user.subscription_end = now + timedelta(days=days)
-            
-            # Сбрасываем флаги уведомлений
-            if reset_notifications:
-                user.notified_24h = False
-                user.notified_2h = False
-            
-            user.last_activity = datetime.utcnow()
-            session.commit()
-            logger.info(f"✅ Subscription updated for {telegram_id}: +{days} days (until {user.subscription_end})")
-            return user.subscription_end
-        return None
+# Месяц подписки — 30 дней
+SECONDS_PER_MONTH = 30 * 24 * 60 * 60
 
-from sqlalchemy import or_
+def _sql_datetime(value, modifier: str = None):
+    """datetime() SQLite в формате хранения DateTime SQLAlchemy (YYYY-MM-DD HH:MM:SS.ffffff).
+
+    func.datetime отдает время без дробной части, а такие строки сравниваются с параметрами
+    запросов (всегда с .ffffff) как текст неверно. Точность — миллисекунды
+    """
+    args = (value, modifier) if modifier else (value,)
+    return type_coerce(func.strftime("%Y-%m-%d %H:%M:%f", *args).concat("000"), DateTime)
+
+class SubscriptionExtension(NamedTuple):
+    subscription_end: datetime
+    applied: bool  # False — платеж с этим payment_id уже был зачтен раньше
+
+async def extend_subscription(telegram_id: int, seconds: int, payment_id: str = None,
+                              reset_notifications: bool = True):
+    """Атомарно продлить подписку на seconds секунд одним UPDATE ... RETURNING.
+
+    Продление идет от текущего окончания, если оно в будущем, иначе от текущего момента,
+    поэтому параллельные оплаты не теряют друг друга. С payment_id платеж записывается
+    в той же транзакции, и повторный вызов с тем же id ничего не меняет, а возвращает
+    дату, полученную при первом зачислении (applied=False).
+    Возвращает SubscriptionExtension или None, если пользователя нет.
+    """
+    now = datetime.utcnow()
+    values = {
+        "subscription_end": _sql_datetime(
+            case((User.subscription_end > now, User.subscription_end), else_=now),
+            f"+{int(seconds)} seconds"
+        )
+    }
+    if reset_notifications:
+        values.update(notified_24h=False, notified_2h=False)
+
+    async with Session() as session:
+        if payment_id is not None:
+            inserted = await session.execute(
+                sqlite_insert(SubscriptionPayment)
+                .values(payment_id=payment_id, telegram_id=telegram_id, seconds=int(seconds), created_at=now)
+                .on_conflict_do_nothing(index_elements=["payment_id"])
+            )
+            if inserted.rowcount == 0:
+                previous = await session.get(SubscriptionPayment, payment_id)
+                logger.warning(f"⚠️ Payment {payment_id} already applied for {previous.telegram_id}, skipping")
+                return SubscriptionExtension(previous.subscription_end, False)
+
+        new_end = await session.scalar(
+            update(User)
+            .where(User.telegram_id == telegram_id)
+            .values(**values)
+            .returning(User.subscription_end)
+            .execution_options(synchronize_session=False)
+        )
+        if new_end is None:
+            # Пользователя нет — запись о платеже откатывается вместе с транзакцией
+            await session.rollback()
+            return None
+        if payment_id is not None:
+            await session.execute(
+                update(SubscriptionPayment)
+                .where(SubscriptionPayment.payment_id == payment_id)
+                .values(subscription_end=new_end)
+            )
+        await session.commit()
+    user_cache.invalidate(telegram_id)
+    _subscription_changed(telegram_id, new_end)
+    return SubscriptionExtension(new_end, True)
+
+async def shorten_subscription(telegram_id: int, seconds: int):
+    """Атомарно убрать seconds секунд подписки, не раньше текущего момента.
+
+    Если подписка после этого истекла, флаги уведомлений сбрасываются.
+    Возвращает новую дату окончания или None, если пользователя нет.
+    """
+    now = datetime.utcnow()
+    shortened = func.max(
+        _sql_datetime(func.coalesce(User.subscription_end, now), f"-{int(seconds)} seconds"),
+        _sql_datetime(now),
+        type_=DateTime
+    )
+    expired = shortened <= _sql_datetime(now)
+    async with Session() as session:
+        new_end = await session.scalar(
+            update(User)
+            .where(User.telegram_id == telegram_id)
+            .values(
+                subscription_end=shortened,
+                notified_24h=case((expired, False), else_=User.notified_24h),
+                notified_2h=case((expired, False), else_=User.notified_2h),
+            )
+            .returning(User.subscription_end)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    user_cache.invalidate(telegram_id)
+    if new_end is not None:
+        _subscription_changed(telegram_id, new_end)
+    return new_end
+
+from sqlalchemy import or_, and_, tuple_
 
 async def get_all_users(with_active_subscription: bool = None):
     """Получить всех пользователей с фильтрацией по подписке"""
-    with Session() as session:
-        query = session.query(User)
+    async with Session() as session:
+        query = select(User)
         now = datetime.utcnow()
 
         if with_active_subscription is True:
@@ -164,228 +464,371 @@ async def get_all_users(with_active_subscription: bool = None):
             )
 
         elif with_active_subscription is False:
+            # Третье условие сужено до ещё не истекших, чтобы каждая ветка OR
+            # шла по своему индексу (MULTI-INDEX OR), а не полным сканом
             query = query.filter(
                 or_(
                     User.subscription_end.is_(None),
                     User.subscription_end <= now,
-                    User.vless_profile_data.is_(None)
+                    and_(User.vless_profile_data.is_(None), User.subscription_end > now)
                 )
             )
 
-        return query.all()
+        return (await session.scalars(query)).all()
 
 
 async def get_users_with_expiring_subscription(hours: int = 24):
     """Получить пользователей с истекающей подпиской"""
-    with Session() as session:
+    async with Session() as session:
         now = datetime.utcnow()
         expiration_threshold = now + timedelta(hours=hours)
         
-        users = session.query(User).filter(
+        users = (await session.scalars(select(User).filter(
             User.subscription_end > now,
             User.subscription_end <= expiration_threshold,
             User.vless_profile_data.isnot(None)  # Только у кого есть профиль
-        ).all()
+        ))).all()
         
         return users
 
 
+# Фильтры постраничного списка пользователей в админке
+USER_PAGE_FILTERS = ("active", "expiring", "inactive", "no_profile")
+
+def _user_page_filter(filter_name: str, now: datetime) -> list:
+    if filter_name == "active":
+        return [User.vless_profile_data.isnot(None), User.subscription_end > now]
+    if filter_name == "expiring":
+        return [
+            User.vless_profile_data.isnot(None),
+            User.subscription_end > now,
+            User.subscription_end <= now + timedelta(hours=24)
+        ]
+    if filter_name == "no_profile":
+        return [User.vless_profile_data.is_(None)]
+    if filter_name == "inactive":
+        return [or_(
+            User.subscription_end.is_(None),
+            User.subscription_end <= now,
+            and_(User.vless_profile_data.is_(None), User.subscription_end > now)
+        )]
+    raise ValueError(f"Unknown user filter: {filter_name}")
+
+def _after_cursor(cursor: tuple, backward: bool):
+    """Условие «строго после/до» ключа (subscription_end, id); NULL-сроки идут первыми"""
+    end, user_id = cursor
+    if end is None:
+        if backward:
+            return and_(User.subscription_end.is_(None), User.id < user_id)
+        return or_(
+            User.subscription_end.isnot(None),
+            and_(User.subscription_end.is_(None), User.id > user_id)
+        )
+    key = tuple_(User.subscription_end, User.id)
+    if backward:
+        return or_(User.subscription_end.is_(None), key < tuple_(end, user_id))
+    return key > tuple_(end, user_id)
+
+async def get_users_page(filter_name: str, cursor: tuple = None, backward: bool = False, limit: int = 25):
+    """Страница пользователей по ключу (subscription_end, id) без OFFSET и только нужные колонки.
+
+    cursor — (subscription_end, id) последней строки предыдущей страницы (или первой при
+    backward=True). Возвращает (строки по возрастанию ключа, есть ли еще строки в этом направлении)
+    """
+    now = datetime.utcnow()
+    query = select(
+        User.id, User.telegram_id, User.full_name, User.username, User.subscription_end,
+        User.vless_profile_data.isnot(None).label("has_profile")
+    ).filter(*_user_page_filter(filter_name, now))
+    if cursor is not None:
+        query = query.filter(_after_cursor(cursor, backward))
+    if backward:
+        query = query.order_by(User.subscription_end.desc(), User.id.desc())
+    else:
+        query = query.order_by(User.subscription_end, User.id)
+
+    async with Session() as session:
+        rows = (await session.execute(query.limit(limit + 1))).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+async def count_users(filter_name: str) -> int:
+    """Число пользователей под фильтром списка"""
+    async with Session() as session:
+        return await session.scalar(
+            select(func.count(User.id)).filter(*_user_page_filter(filter_name, datetime.utcnow()))
+        )
+
+
+async def get_users_expiring_before(deadline: datetime):
+    """Пользователи с профилем, у которых подписка кончается не позже deadline (и уже истекшие)"""
+    async with Session() as session:
+        return (await session.scalars(select(User).filter(
+            User.vless_profile_data.isnot(None),
+            User.subscription_end <= deadline
+        ))).all()
+
+async def get_users_by_ids(telegram_ids, chunk_size: int = 500):
+    """Пользователи по списку Telegram ID — точечные выборки по индексу"""
+    telegram_ids = list(telegram_ids)
+    users = []
+    async with Session() as session:
+        for i in range(0, len(telegram_ids), chunk_size):
+            users += (await session.scalars(
+                select(User).where(User.telegram_id.in_(telegram_ids[i:i + chunk_size]))
+            )).all()
+    return users
+
 
 
 async def create_static_profile(name: str, vless_url: str):
     """Создать статический профиль"""
-    with Session() as session:
+    async with Session() as session:
         # Проверяем, нет ли уже профиля с таким именем
-        existing = session.query(StaticProfile).filter_by(name=name).first()
+        existing = await session.scalar(select(StaticProfile).filter_by(name=name))
         if existing:
             logger.warning(f"⚠️ Static profile already exists: {name}")
             return None
         
         profile = StaticProfile(name=name, vless_url=vless_url)
         session.add(profile)
-        session.commit()
+        await session.commit()
         logger.info(f"✅ Static profile created: {name}")
         return profile
 
 async def get_static_profiles():
     """Получить все статические профили"""
-    with Session() as session:
-        return session.query(StaticProfile).order_by(StaticProfile.created_at.desc()).all()
+    async with Session() as session:
+        return (await session.scalars(
+            select(StaticProfile).order_by(StaticProfile.created_at.desc())
+        )).all()
+
+async def get_static_profile(profile_id: int):
+    """Получить статический профиль по id"""
+    async with Session() as session:
+        return await session.get(StaticProfile, profile_id)
 
 async def delete_static_profile(profile_id: int):
     """Удалить статический профиль"""
-    with Session() as session:
-        profile = session.query(StaticProfile).filter_by(id=profile_id).first()
+    async with Session() as session:
+        profile = await session.get(StaticProfile, profile_id)
         if profile:
-            session.delete(profile)
-            session.commit()
+            await session.delete(profile)
+            await session.commit()
             logger.info(f"✅ Static profile deleted: {profile.name}")
             return True
     return False
 
 async def get_user_stats():
     """Получить статистику пользователей"""
-    with Session() as session:
+    async with Session() as session:
         now = datetime.utcnow()
         
-        total = session.query(func.count(User.id)).scalar()
-        with_sub = session.query(func.count(User.id)).filter(
+        total = await session.scalar(select(func.count(User.id)))
+        with_sub = await session.scalar(select(func.count(User.id)).filter(
             User.subscription_end > now
-        ).scalar()
+        ))
         without_sub = total - with_sub
         
         # Пользователи с истекающей подпиской (менее 24 часов)
-        expiring_soon = session.query(func.count(User.id)).filter(
+        expiring_soon = await session.scalar(select(func.count(User.id)).filter(
             User.subscription_end > now,
             User.subscription_end <= now + timedelta(hours=24)
-        ).scalar()
+        ))
         
         return {
             "total": total,
             "with_active_subscription": with_sub,
             "without_subscription": without_sub,
             "expiring_soon": expiring_soon,
-            "trial_users": session.query(func.count(User.id)).filter(
+            "trial_users": await session.scalar(select(func.count(User.id)).filter(
                 User.subscription_end > now,
                 User.subscription_end <= now + timedelta(days=3)
-            ).scalar()
+            ))
         }
 
 async def update_user_stats(telegram_id: int, upload: int = None, download: int = None):
     """Обновить статистику пользователя"""
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    async with Session() as session:
+        user = await _get_user(session, telegram_id)
         if user:
             if upload is not None:
                 user.total_upload = upload
             if download is not None:
                 user.total_download = download
             user.last_activity = datetime.utcnow()
-            session.commit()
+            await session.commit()
+            user_cache.invalidate(telegram_id)
             return True
     return False
 
 async def get_admin_users():
     """Получить всех администраторов"""
-    with Session() as session:
-        return session.query(User).filter_by(is_admin=True).all()
+    async with Session() as session:
+        return (await session.scalars(select(User).filter_by(is_admin=True))).all()
 
 async def update_user_admin_status(telegram_id: int, is_admin: bool):
     """Обновить статус администратора"""
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    async with Session() as session:
+        user = await _get_user(session, telegram_id)
         if user:
             user.is_admin = is_admin
-            session.commit()
+            await session.commit()
+            user_cache.invalidate(telegram_id)
             logger.info(f"✅ Admin status updated for {telegram_id}: {is_admin}")
             return True
     return False
 
-# В database.py добавьте эти функции перед последней строкой:
-
-from datetime import datetime, timedelta
+async def sync_admins(admin_ids: list, admin_subscription_end: datetime):
+    """Выставить флаг администратора ровно пользователям из admin_ids (недостающих создать).
 
-async def update_subscription(telegram_id: int, months: int, is_admin_action: bool = False):
-    """Обновляет подписку пользователя и возвращает новую дату окончания"""
-    try:
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=telegram_id).first()
-            if not user:
-                logger.error(f"❌ User {telegram_id} not found for subscription update")
-                return None
-            
-            # Определяем текущее время
-            now = datetime.utcnow()
-            
-            # Если подписка еще активна, продлеваем от текущей даты окончания
-            if user.subscription_end and user.subscription_end > now:
-                new_end = user.subscription_end + timedelta(days=30*months)
-            else:
-                # Если подписка истекла или ее нет, начинаем с текущего момента
-                new_end = now + timedelta(days=30*months)
-            
-            user.subscription_end = new_end
-            
-            # Сбрасываем флаги уведомлений при продлении
-            user.notified_24h = False
-            user.notified_2h = False
-            
-            session.commit()
-            
-            # Логируем продление
-            logger.info(
-                f"✅ Subscription updated for user {telegram_id}: "
-                f"+{months} months, new end: {new_end.strftime('%d.%m.%Y %H:%M')}"
+    Пишет только строки, у которых флаг действительно меняется; возвращает их число
+    """
+    admin_ids = list(admin_ids)
+    async with Session() as session:
+        demoted = await session.execute(
+            update(User)
+            .where(User.is_admin == True, User.telegram_id.notin_(admin_ids))
+            .values(is_admin=False)
+        )
+        promoted = await session.execute(
+            update(User)
+            .where(User.telegram_id.in_(admin_ids), or_(User.is_admin.is_(None), User.is_admin == False))
+            .values(is_admin=True)
+        )
+        changed = demoted.rowcount + promoted.rowcount
+        if admin_ids:
+            created = await session.execute(
+                sqlite_insert(User)
+                .values([
+                    {
+                        "telegram_id": admin_id,
+                        "full_name": f"Admin {admin_id}",
+                        "is_admin": True,
+                        "subscription_end": admin_subscription_end,
+                        "registration_date": datetime.utcnow(),
+                        "last_activity": datetime.utcnow(),
+                    }
+                    for admin_id in admin_ids
+                ])
+                .on_conflict_do_nothing(index_elements=["telegram_id"])
             )
-            
-            # Логируем в payments.log
-            payments_logger.info(
-                f"SUBSCRIPTION_EXTENDED | "
-                f"user_id={telegram_id} | "
-                f"months={months} | "
-                f"new_end={new_end.strftime('%Y-%m-%d %H:%M:%S')} | "
-                f"admin_action={is_admin_action}"
+            changed += created.rowcount
+        await session.commit()
+    if changed:
+        user_cache.clear()
+    return changed
+
+NOTIFICATION_FLAGS = ("notified_24h", "notified_2h")
+
+async def set_notification_flags(flags: dict, value: bool = True, chunk_size: int = 500):
+    """Выставить флаги уведомлений пачкой одной транзакцией.
+
+    flags: {"notified_24h": [telegram_id, ...], "notified_2h": [...]}; возвращает число обновленных строк
+    """
+    updated = 0
+    async with Session() as session:
+        for flag_name, telegram_ids in flags.items():
+            if flag_name not in NOTIFICATION_FLAGS:
+                raise ValueError(f"Unknown notification flag: {flag_name}")
+            telegram_ids = list(telegram_ids)
+            for i in range(0, len(telegram_ids), chunk_size):
+                result = await session.execute(
+                    update(User)
+                    .where(User.telegram_id.in_(telegram_ids[i:i + chunk_size]))
+                    .values({flag_name: value})
+                )
+                updated += result.rowcount
+        await session.commit()
+        user_cache.clear()
+    return updated
+
+async def reset_notification_flags(expiring_after: datetime):
+    """Сбросить флаги уведомлений тем, чья подписка теперь кончается позже expiring_after"""
+    async with Session() as session:
+        result = await session.execute(
+            update(User)
+            .where(
+                User.subscription_end > expiring_after,
+                (User.notified_24h == True) | (User.notified_2h == True)
             )
-            
-            return new_end
+            .values(notified_24h=False, notified_2h=False)
+        )
+        await session.commit()
+        user_cache.clear()
+        return result.rowcount
+
+async def update_subscription(telegram_id: int, months: int, is_admin_action: bool = False,
+                              payment_id: str = None):
+    """Продлить подписку на months месяцев (оплата или подтверждение админом).
+
+    Возвращает SubscriptionExtension (повторный payment_id — applied=False) или None
+    """
+    try:
+        extension = await extend_subscription(telegram_id, months * SECONDS_PER_MONTH, payment_id=payment_id)
+        if extension is None:
+            logger.error(f"❌ User {telegram_id} not found for subscription update")
+            return None
+        if not extension.applied:
+            return extension
+        
+        new_end = extension.subscription_end
+        logger.info(
+            f"✅ Subscription updated for user {telegram_id}: "
+            f"+{months} months, new end: {new_end.strftime('%d.%m.%Y %H:%M')}"
+        )
+        
+        # Логируем в payments.log
+        payments_logger.info(
+            f"SUBSCRIPTION_EXTENDED | "
+            f"user_id={telegram_id} | "
+            f"months={months} | "
+            f"new_end={new_end.strftime('%Y-%m-%d %H:%M:%S')} | "
+            f"admin_action={is_admin_action} | "
+            f"payment_id={payment_id}"
+        )
+        
+        return extension
             
     except Exception as e:
         logger.error(f"❌ Error updating subscription for user {telegram_id}: {e}")
         return None
 
+def _duration_seconds(months: int, days: int, hours: int, minutes: int) -> int:
+    return months * SECONDS_PER_MONTH + days * 24 * 60 * 60 + hours * 60 * 60 + minutes * 60
+
 async def add_time_to_subscription(telegram_id: int, months: int, days: int = 0, hours: int = 0, minutes: int = 0):
     """Добавляет время к подписке пользователя (для админ-меню)"""
     try:
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=telegram_id).first()
-            if not user:
-                logger.error(f"❌ User {telegram_id} not found for adding time")
-                return None
-            
-            # Вычисляем общее количество секунд
-            total_seconds = (
-                months * 30 * 24 * 60 * 60 +
-                days * 24 * 60 * 60 +
-                hours * 60 * 60 +
-                minutes * 60
-            )
-            
-            now = datetime.utcnow()
-            
-            # Если подписка активна, добавляем к текущей дате окончания
-            if user.subscription_end > now:
-                new_end = user.subscription_end + timedelta(seconds=total_seconds)
-            else:
-                # Если подписка истекла, добавляем к текущему времени
-                new_end = now + timedelta(seconds=total_seconds)
-            
-            user.subscription_end = new_end
-            
-            # Сбрасываем флаги уведомлений
-            user.notified_24h = False
-            user.notified_2h = False
-            
-            session.commit()
-            
-            # Вычисляем общее количество месяцев для логирования
-            total_months = round(total_seconds / (30 * 24 * 60 * 60), 1)
-            
-            logger.info(
-                f"✅ Time added to user {telegram_id}: "
-                f"+{months}m {days}d {hours}h {minutes}m "
-                f"(total: ~{total_months} months), "
-                f"new end: {new_end.strftime('%d.%m.%Y %H:%M')}"
-            )
-            
-            payments_logger.info(
-                f"ADMIN_ADDED_TIME | "
-                f"user_id={telegram_id} | "
-                f"months={months} | days={days} | hours={hours} | minutes={minutes} | "
-                f"total_months={total_months} | "
-                f"new_end={new_end.strftime('%Y-%m-%d %H:%M:%S')}"
-            )
-            
-            return new_end
+        total_seconds = _duration_seconds(months, days, hours, minutes)
+        extension = await extend_subscription(telegram_id, total_seconds)
+        if extension is None:
+            logger.error(f"❌ User {telegram_id} not found for adding time")
+            return None
+        new_end = extension.subscription_end
+        
+        # Вычисляем общее количество месяцев для логирования
+        total_months = round(total_seconds / SECONDS_PER_MONTH, 1)
+        
+        logger.info(
+            f"✅ Time added to user {telegram_id}: "
+            f"+{months}m {days}d {hours}h {minutes}m "
+            f"(total: ~{total_months} months), "
+            f"new end: {new_end.strftime('%d.%m.%Y %H:%M')}"
+        )
+        
+        payments_logger.info(
+            f"ADMIN_ADDED_TIME | "
+            f"user_id={telegram_id} | "
+            f"months={months} | days={days} | hours={hours} | minutes={minutes} | "
+            f"total_months={total_months} | "
+            f"new_end={new_end.strftime('%Y-%m-%d %H:%M:%S')}"
+        )
+        
+        return new_end
             
     except Exception as e:
         logger.error(f"❌ Error adding time to user {telegram_id}: {e}")
@@ -394,56 +837,31 @@ async def add_time_to_subscription(telegram_id: int, months: int, days: int = 0,
 async def remove_time_from_subscription(telegram_id: int, months: int, days: int = 0, hours: int = 0, minutes: int = 0):
     """Удаляет время из подписки пользователя (для админ-меню)"""
     try:
-        with Session() as session:
-            user = session.query(User).filter_by(telegram_id=telegram_id).first()
-            if not user:
-                logger.error(f"❌ User {telegram_id} not found for removing time")
-                return None
-            
-            # Вычисляем общее количество секунд
-            total_seconds = (
-                months * 30 * 24 * 60 * 60 +
-                days * 24 * 60 * 60 +
-                hours * 60 * 60 +
-                minutes * 60
-            )
-            
-            # Вычитаем время
-            new_end = user.subscription_end - timedelta(seconds=total_seconds)
-            
-            # Проверяем, чтобы не ушло в прошлое
-            now = datetime.utcnow()
-            if new_end < now:
-                new_end = now
-            
-            user.subscription_end = new_end
-            
-            # Если подписка теперь истекла, сбрасываем флаги уведомлений
-            if new_end <= now:
-                user.notified_24h = False
-                user.notified_2h = False
-            
-            session.commit()
-            
-            # Вычисляем общее количество месяцев для логирования
-            total_months = round(total_seconds / (30 * 24 * 60 * 60), 1)
-            
-            logger.info(
-                f"✅ Time removed from user {telegram_id}: "
-                f"-{months}m {days}d {hours}h {minutes}m "
-                f"(total: ~{total_months} months), "
-                f"new end: {new_end.strftime('%d.%m.%Y %H:%M')}"
-            )
-            
-            payments_logger.info(
-                f"ADMIN_REMOVED_TIME | "
-                f"user_id={telegram_id} | "
-                f"months={months} | days={days} | hours={hours} | minutes={minutes} | "
-                f"total_months={total_months} | "
-                f"new_end={new_end.strftime('%Y-%m-%d %H:%M:%S')}"
-            )
-            
-            return new_end
+        total_seconds = _duration_seconds(months, days, hours, minutes)
+        new_end = await shorten_subscription(telegram_id, total_seconds)
+        if new_end is None:
+            logger.error(f"❌ User {telegram_id} not found for removing time")
+            return None
+        
+        # Вычисляем общее количество месяцев для логирования
+        total_months = round(total_seconds / SECONDS_PER_MONTH, 1)
+        
+        logger.info(
+            f"✅ Time removed from user {telegram_id}: "
+            f"-{months}m {days}d {hours}h {minutes}m "
+            f"(total: ~{total_months} months), "
+            f"new end: {new_end.strftime('%d.%m.%Y %H:%M')}"
+        )
+        
+        payments_logger.info(
+            f"ADMIN_REMOVED_TIME | "
+            f"user_id={telegram_id} | "
+            f"months={months} | days={days} | hours={hours} | minutes={minutes} | "
+            f"total_months={total_months} | "
+            f"new_end={new_end.strftime('%Y-%m-%d %H:%M:%S')}"
+        )
+        
+        return new_end
             
     except Exception as e:
         logger.error(f"❌ Error removing time from user {telegram_id}: {e}")
@@ -451,23 +869,262 @@ async def remove_time_from_subscription(telegram_id: int, months: int, days: int
 
 async def cleanup_expired_users():
     """Очистка устаревших данных (пользователи без подписки и профиля)"""
-    with Session() as session:
+    async with Session() as session:
         month_ago = datetime.utcnow() - timedelta(days=30)
         
-        # Находим пользователей без подписки и без профиля более месяца
-        expired_users = session.query(User).filter(
+        # Удаляем пользователей без подписки и без профиля более месяца
+        result = await session.execute(delete(User).where(
             User.subscription_end < month_ago,
             User.vless_profile_data.is_(None),
             User.is_admin == False
-        ).all()
-        
-        deleted_count = 0
-        for user in expired_users:
-            session.delete(user)
-            deleted_count += 1
+        ))
+        await session.commit()
+        user_cache.clear()
         
+        deleted_count = result.rowcount
         if deleted_count > 0:
-            session.commit()
             logger.info(f"🧹 Cleaned up {deleted_count} expired user records")
         
-        return deleted_count
\ No newline at end of file
+        return deleted_count
+
+async def record_traffic_samples(ts: int, traffics: dict):
+    """Сохранить дельты трафика за интервал.
+
+    traffics — текущие счетчики панели {email: {"upload", "download"}}.
+    Последние увиденные счетчики храним в total_upload/total_download пользователя.
+    Пока их нет (NULL), первое наблюдение только запоминается как база, без сэмпла.
+    """
+    async with Session() as session:
+        users = (await session.execute(select(
+            User.id, User.client_email, User.vless_profile_data, User.total_upload, User.total_download
+        ).filter(User.vless_profile_data.isnot(None)))).all()
+
+        samples = []
+        totals = []
+        for user_id, email, profile_json, last_up, last_down in users:
+            if email is None:
+                # Строку еще не заполнил бэкфилл колонок профиля
+                try:
+                    email = serialization.loads(profile_json).get("email")
+                except (ValueError, AttributeError):
+                    continue
+            stats = traffics.get(email)
+            if not stats:
+                continue
+
+            up, down = stats["upload"], stats["download"]
+            if last_up is None or last_down is None:
+                # Счетчики панели — трафик за всё время клиента, а не за интервал
+                totals.append({"id": user_id, "total_upload": up, "total_download": down})
+                continue
+            # Счетчики панели начинаются с нуля после пересоздания клиента
+            delta_up = up - last_up if up >= last_up else up
+            delta_down = down - last_down if down >= last_down else down
+
+            if delta_up or delta_down:
+                samples.append({"user_id": user_id, "ts": ts, "up": delta_up, "down": delta_down})
+            if up != last_up or down != last_down:
+                totals.append({"id": user_id, "total_upload": up, "total_download": down})
+
+        if samples:
+            stmt = sqlite_insert(TrafficSample)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[TrafficSample.user_id, TrafficSample.ts],
+                set_={
+                    "up": TrafficSample.up + stmt.excluded.up,
+                    "down": TrafficSample.down + stmt.excluded.down
+                }
+            )
+            await session.execute(stmt, samples)
+        if totals:
+            await session.execute(update(User), totals)
+        await session.commit()
+        user_cache.clear()
+        return len(samples)
+
+async def downsample_traffic_samples(older_than: int, bucket: int):
+    """Склеить сэмплы старше older_than в интервалы длиной bucket секунд"""
+    async with Session() as session:
+        bucket_ts = (TrafficSample.ts // bucket) * bucket
+        condition = (TrafficSample.ts < older_than) & (TrafficSample.ts % bucket != 0)
+
+        merged = (await session.execute(select(
+            TrafficSample.user_id,
+            bucket_ts.label("bucket_ts"),
+            func.sum(TrafficSample.up),
+            func.sum(TrafficSample.down)
+        ).filter(condition).group_by(TrafficSample.user_id, "bucket_ts"))).all()
+
+        if not merged:
+            return 0
+
+        await session.execute(delete(TrafficSample).where(condition))
+
+        stmt = sqlite_insert(TrafficSample)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[TrafficSample.user_id, TrafficSample.ts],
+            set_={
+                "up": TrafficSample.up + stmt.excluded.up,
+                "down": TrafficSample.down + stmt.excluded.down
+            }
+        )
+        await session.execute(stmt, [
+            {"user_id": user_id, "ts": ts, "up": up, "down": down}
+            for user_id, ts, up, down in merged
+        ])
+        await session.commit()
+        return len(merged)
+
+async def purge_traffic_samples(older_than: int):
+    """Удалить сэмплы старше срока хранения"""
+    async with Session() as session:
+        result = await session.execute(delete(TrafficSample).where(
+            TrafficSample.ts < older_than
+        ))
+        await session.commit()
+        return result.rowcount
+
+async def get_traffic_usage(since: int, user_id: int = None):
+    """Трафик с момента since (epoch): всего или одного пользователя (users.id)"""
+    async with Session() as session:
+        query = select(
+            func.coalesce(func.sum(TrafficSample.up), 0),
+            func.coalesce(func.sum(TrafficSample.down), 0)
+        ).filter(TrafficSample.ts >= since)
+        if user_id is not None:
+            query = query.filter(TrafficSample.user_id == user_id)
+        up, down = (await session.execute(query)).one()
+        return {"upload": up, "download": down}
+
+async def get_traffic_usage_by_user(since: int):
+    """Трафик каждого пользователя с момента since: {users.id: {"upload", "download"}}"""
+    async with Session() as session:
+        rows = (await session.execute(select(
+            TrafficSample.user_id,
+            func.sum(TrafficSample.up),
+            func.sum(TrafficSample.down)
+        ).filter(TrafficSample.ts >= since).group_by(TrafficSample.user_id))).all()
+        return {user_id: {"upload": up, "download": down} for user_id, up, down in rows}
+
+async def get_traffic_totals():
+    """Суммарные счетчики панели по всем пользователям"""
+    async with Session() as session:
+        up, down = (await session.execute(select(
+            func.coalesce(func.sum(User.total_upload), 0),
+            func.coalesce(func.sum(User.total_download), 0)
+        ))).one()
+        return {"upload": up, "download": down}
+
+async def get_users_with_profiles():
+    """Все пользователи с VPN-профилем одним запросом (для сверки с панелью).
+
+    Возвращает кортежи (id, telegram_id, subscription_end, last_activity, vless_profile_data).
+    """
+    async with Session() as session:
+        return (await session.execute(select(
+            User.id, User.telegram_id, User.subscription_end, User.last_activity, User.vless_profile_data
+        ).filter(User.vless_profile_data.isnot(None)))).all()
+
+async def get_user_by_client_email(email: str):
+    """Пользователь по email клиента в панели (индекс ix_users_client_email)"""
+    async with Session() as session:
+        return await session.scalar(select(User).where(User.client_email == email))
+
+async def get_known_client_emails(emails, chunk_size: int = 500) -> set:
+    """Какие из emails принадлежат профилям в БД — точечные выборки по индексу.
+
+    Профили, которые бэкфилл колонок еще не заполнил, проверяются по JSON.
+    """
+    emails = list(emails)
+    known = set()
+    async with Session() as session:
+        for i in range(0, len(emails), chunk_size):
+            known.update((await session.scalars(
+                select(User.client_email).where(User.client_email.in_(emails[i:i + chunk_size]))
+            )).all())
+        # ORDER BY id — чтобы планировщик взял почти пустой ix_users_profile_pending:
+        # пустой индекс ANALYZE не описывает, и без сортировки выигрывает ix_users_profile_end
+        pending = (await session.scalars(
+            select(User.vless_profile_data)
+            .where(User.vless_profile_data.isnot(None), User.client_email.is_(None))
+            .order_by(User.id)
+        )).all()
+    wanted = set(emails)
+    for raw in pending:
+        try:
+            email = serialization.loads(raw).get("email")
+        except (ValueError, AttributeError):
+            continue
+        if email in wanted:
+            known.add(email)
+    return known
+
+async def clear_user_profiles(user_ids: list, chunk_size: int = 500):
+    """Сбросить профили пачкой (клиенты в панели уже удалены или не существуют)"""
+    user_ids = list(user_ids)
+    async with Session() as session:
+        for i in range(0, len(user_ids), chunk_size):
+            await session.execute(
+                update(User)
+                .where(User.id.in_(user_ids[i:i + chunk_size]))
+                .values(vless_profile_data=None, vless_profile_id=None, notified_24h=False, notified_2h=False,
+                        **profile_columns(None))
+            )
+        await session.commit()
+        user_cache.clear()
+    return len(user_ids)
+
+async def get_expired_profiles(user_ids, now: datetime, chunk_size: int = 500) -> dict:
+    """{id: vless_profile_data} тех из user_ids, у кого профиль есть, а подписка истекла к now"""
+    user_ids = list(user_ids)
+    profiles = {}
+    async with Session() as session:
+        for i in range(0, len(user_ids), chunk_size):
+            rows = await session.execute(
+                select(User.id, User.vless_profile_data).where(
+                    User.id.in_(user_ids[i:i + chunk_size]),
+                    User.vless_profile_data.isnot(None),
+                    or_(User.subscription_end.is_(None), User.subscription_end <= now)
+                )
+            )
+            profiles.update(rows.all())
+    return profiles
+
+async def clear_expired_profiles(expected: dict, now: datetime) -> int:
+    """Сбросить профили {id: прочитанный vless_profile_data} истекших пользователей.
+
+    Строка меняется, только если профиль с момента чтения не менялся и подписка
+    все еще истекла к now — продление или новый профиль между чтением и записью не теряются.
+    Возвращает число сброшенных профилей
+    """
+    if not expected:
+        return 0
+    table = User.__table__
+    async with Session() as session:
+        result = await session.execute(
+            update(table)
+            .where(
+                table.c.id == bindparam("b_id"),
+                table.c.vless_profile_data == bindparam("b_old"),
+                or_(table.c.subscription_end.is_(None), table.c.subscription_end <= now)
+            )
+            .values(vless_profile_data=None, vless_profile_id=None, notified_24h=False, notified_2h=False,
+                    **profile_columns(None)),
+            [{"b_id": user_id, "b_old": raw} for user_id, raw in expected.items()]
+        )
+        await session.commit()
+        user_cache.clear()
+    return result.rowcount
+
+async def update_user_profiles(profiles: dict):
+    """Перезаписать данные профилей пачкой: {user_id: profile_data}"""
+    if not profiles:
+        return 0
+    async with Session() as session:
+        await session.execute(update(User), [
+            {"id": user_id, "vless_profile_data": serialization.dumps(profile_data), **profile_columns(profile_data)}
+            for user_id, profile_data in profiles.items()
+        ])
+        await session.commit()
+        user_cache.clear()
+    return len(profiles)
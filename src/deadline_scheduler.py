@@ -0,0 +1,91 @@
+# deadline_scheduler.py
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class DeadlineScheduler:
+    """Мин-куча ближайших дедлайнов по ключу (telegram_id) с ленивым удалением.
+
+    На ключ действует только последний schedule(): старые записи в куче остаются,
+    но при извлечении отбрасываются по номеру версии. Между дедлайнами wait_due()
+    спит ровно до ближайшего из них; более ранний дедлайн будит его через событие.
+    Время — unix-секунды (time.time()).
+    """
+
+    def __init__(self):
+        self._heap = []                # (when, seq, key)
+        self._current = {}             # key -> seq действующей записи
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._current)
+
+    def schedule(self, key, when: float):
+        """Назначить (или перенести) дедлайн ключа"""
+        seq = next(self._seq)
+        self._current[key] = seq
+        heapq.heappush(self._heap, (when, seq, key))
+        if self._heap[0][1] == seq:
+            self._wakeup.set()
+
+    def discard(self, key):
+        self._current.pop(key, None)
+
+    def replace(self, deadlines: dict):
+        """Пересобрать кучу целиком: {key: when}"""
+        self._current = {}
+        self._heap = []
+        for key, when in deadlines.items():
+            seq = next(self._seq)
+            self._current[key] = seq
+            self._heap.append((when, seq, key))
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    def next_deadline(self):
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float = None) -> list:
+        """Извлечь все ключи с наступившим дедлайном"""
+        now = time.time() if now is None else now
+        due = []
+        while True:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return due
+            _, seq, key = heapq.heappop(self._heap)
+            del self._current[key]
+            due.append(key)
+
+    async def wait_due(self, timeout: float = None) -> list:
+        """Дождаться наступивших дедлайнов (не дольше timeout секунд).
+
+        Возвращает их ключи; пустой список — истек timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            due = self.pop_due()
+            if due:
+                return due
+            wake_at = self.next_deadline()
+            if deadline is not None:
+                wake_at = deadline if wake_at is None else min(wake_at, deadline)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(),
+                    None if wake_at is None else max(0.0, wake_at - time.time())
+                )
+            except asyncio.TimeoutError:
+                pass
+            if deadline is not None and time.time() >= deadline:
+                return self.pop_due()
+
+    def _drop_stale(self):
+        heap = self._heap
+        while heap and self._current.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
@@ -1,9 +1,16 @@
+import asyncio
 import aiohttp
 import uuid
-import json
+import serialization
 import logging
 import random
-from config import config
+import time
+from datetime import datetime
+from config import config, XUINode
+from xui_queue import InboundMutationQueue
+from xui_cache import InboundCache
+from xui_transport import CircuitBreaker, CircuitOpenError, endpoint_deadline, backoff_delay
+from database import profile_ref, as_utc
 from urllib.parse import urljoin
 
 # В handlers.py, database.py, functions.py и других модулях
@@ -25,35 +32,66 @@ error_logger.error("Критическая ошибка")  # Только в err
 
 
 class XUIAPI:
-    def __init__(self):
+    """Долгоживущий клиент 3x-UI API с пулом соединений и переиспользованием куки"""
+
+    def __init__(self, node: XUINode = None):
+        self.node = node or config.default_node
         self.session = None
         self.cookie_jar = aiohttp.CookieJar(unsafe=True)  # Разрешаем небезопасные куки
         self.auth_cookies = None
+        self.logged_in = False
+        self._login_lock = asyncio.Lock()
+        self._login_generation = 0
+        # Панели до появления addClient/delClient/updateClient обслуживаем через update
+        self.per_client_api = True
+        self._inbound_meta = {}
+        self._mutation_queues = {}
+        self._traffic_marks = {}
+        self.inbound_cache = InboundCache(self.get_inbound, config.XUI_INBOUND_CACHE_TTL)
+        self.breaker = CircuitBreaker(
+            self.node.name, config.XUI_BREAKER_THRESHOLD, config.XUI_BREAKER_RESET_TIMEOUT
+        )
+        self._last_online = 0
 
-    async def login(self):
-        """Аутентификация в 3x-UI API"""
-        try:
-            # Создаем новую сессию с общей куки-банкой
+        # Базовые URL вычисляем один раз, а не в каждом методе
+        self.base_url = self.node.url.rstrip('/')
+        base_path = self.node.base_path.strip('/')
+        self.api_url = f"{self.base_url}/{base_path}" if base_path else self.base_url
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Ленивое создание общей сессии с keep-alive пулом соединений"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=config.XUI_POOL_SIZE,
+                keepalive_timeout=config.XUI_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300
+            )
             self.session = aiohttp.ClientSession(
+                connector=connector,
                 cookie_jar=self.cookie_jar,
+                json_serialize=serialization.dumps,
                 trust_env=True  # Доверять переменным окружения для прокси
             )
-            
+            self.logged_in = False
+        return self.session
+
+    async def login(self):
+        """Аутентификация в 3x-UI API"""
+        try:
+            session = self._get_session()
+
             auth_data = {
-                "username": config.XUI_USERNAME,
-                "password": config.XUI_PASSWORD
+                "username": self.node.username,
+                "password": self.node.password
             }
             
-            # Формируем URL с учетом базового пути
-            base_url = config.XUI_API_URL.rstrip('/')
-            # base_path = config.XUI_BASE_PATH.strip('/')
-            # if base_path:
-            #     base_url = f"{base_url}/{base_path}"
-            login_url = f"{base_url}/login"
+            # Логин всегда идет по корню панели, без базового пути API
+            login_url = f"{self.base_url}/login"
             
-            logger.info(f"ℹ️  Trying login to {login_url} with user: {config.XUI_USERNAME}")
+            logger.info(f"ℹ️  Trying login to {login_url} with user: {self.node.username}")
             
-            async with self.session.post(login_url, data=auth_data) as resp:
+            timeout = aiohttp.ClientTimeout(total=endpoint_deadline("login"))
+            async with session.post(login_url, data=auth_data, timeout=timeout) as resp:
                 if resp.status != 200:
                     logger.error(f"🛑 Login failed with status: {resp.status}")
                     return False
@@ -65,6 +103,7 @@ class XUIAPI:
                         logger.info("✅ Login successful")
                         # Сохраняем куки для последующих запросов
                         self.auth_cookies = self.cookie_jar
+                        self.logged_in = True
                         logger.debug(f"⚙️ Auth cookies: {self.auth_cookies}")
                         return True
                     else:
@@ -77,457 +116,759 @@ class XUIAPI:
                         logger.warning("⚠️ Login successful (text response)")
                         # Сохраняем куки для последующих запросов
                         self.auth_cookies = self.cookie_jar
+                        self.logged_in = True
                         logger.debug(f"⚙️ Auth cookies: {self.auth_cookies}")
                         return True
                     logger.error(f"🛑 Login failed. Response text: {text[:100]}...")
                     return False
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # Сетевые ошибки учитывает предохранитель в _request
+            raise
         except Exception as e:
             logger.exception(f"🛑 Login error: {e}")
             return False
 
+    async def ensure_login(self, stale_generation: int = None):
+        """Логин только если сессия еще не авторизована (или куки протухли)"""
+        async with self._login_lock:
+            # Пока мы ждали блокировку, другой запрос уже перелогинился
+            if stale_generation is not None and stale_generation != self._login_generation:
+                return self.logged_in
+            if self.logged_in and stale_generation is None:
+                return True
+            self.logged_in = False
+            if await self.login():
+                self._login_generation += 1
+                return True
+            return False
+
+    @staticmethod
+    def _is_auth_failure(resp) -> bool:
+        """Панель отвечает 401 или редиректом на страницу логина, если куки протухли"""
+        if resp.status == 401:
+            return True
+        if resp.status in (301, 302, 303, 307, 308):
+            return True
+        return False
+
+    async def _request(self, method: str, path: str, idempotent: bool = None, **kwargs):
+        """Запрос к API панели через общую сессию с дедлайном, повторами и предохранителем.
+
+        Возвращает (status, data), где data — распарсенный JSON или текст ответа.
+        Идемпотентные запросы (по умолчанию GET) повторяются при сетевых ошибках,
+        таймаутах и 5xx с экспоненциальной паузой. Записи не повторяются: панель
+        могла применить изменение до обрыва соединения.
+        Пока предохранитель узла разомкнут, бросает CircuitOpenError без запроса в панель.
+        """
+        if idempotent is None:
+            idempotent = method == "GET"
+        attempts = 1 + (config.XUI_RETRIES if idempotent else 0)
+        timeout = aiohttp.ClientTimeout(total=endpoint_deadline(path))
+
+        for attempt in range(attempts):
+            self.breaker.before_request()
+            try:
+                status, data = await self._send(method, path, timeout=timeout, **kwargs)
+                error = None if status is not None and status < 500 else f"status={status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, data = None, None
+                error = f"{type(e).__name__}: {e}"
+            except Exception as e:
+                # Неожиданный сбой (например, ответ не декодируется) тоже считаем ошибкой узла
+                self.breaker.record_failure(f"{type(e).__name__}: {e}")
+                raise
+            except BaseException:
+                # Отмена — не ошибка панели, но пробный запрос half_open должен освободиться
+                self.breaker.release_trial()
+                raise
+
+            if error is None:
+                self.breaker.record_success()
+                return status, data
+
+            self.breaker.record_failure(error)
+            if attempt + 1 < attempts and self.breaker.state == CircuitBreaker.CLOSED:
+                delay = backoff_delay(attempt)
+                logger.warning(f"⚠️ XUI {method} {path} failed ({error}), retry in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            return status, data
+        return None, None
+
+    async def _send(self, method: str, path: str, **kwargs):
+        """Одна попытка запроса. При 401/редиректе на логин — один повторный логин"""
+        if not await self.ensure_login():
+            return None, None
+
+        url = f"{self.api_url}/{path.lstrip('/')}"
+        for attempt in range(2):
+            generation = self._login_generation
+            session = self._get_session()
+            async with session.request(method, url, allow_redirects=False, **kwargs) as resp:
+                if self._is_auth_failure(resp) and attempt == 0:
+                    logger.info(f"ℹ️  XUI session expired (status={resp.status}), logging in again")
+                    if not await self.ensure_login(stale_generation=generation):
+                        return None, None
+                    continue
+
+                try:
+                    data = await resp.json(content_type=None, loads=serialization.loads)
+                except Exception:
+                    data = await resp.text()
+                return resp.status, data
+        return None, None
+
     async def get_inbound(self, inbound_id: int):
         """Получение данных инбаунда"""
         try:
-            base_url = config.XUI_API_URL.rstrip('/')
-            base_path = config.XUI_BASE_PATH.strip('/')
-            if base_path:
-                base_url = f"{base_url}/{base_path}"
-            url = f"{base_url}/api/inbounds/get/{inbound_id}"
-            
-            logger.info(f"ℹ️  Getting inbound data from: {url}")
-            logger.debug(f"⚙️ Using cookies: {self.cookie_jar}")
-            
-            async with self.session.get(url) as resp:
-                logger.debug(f"⚙️ Response status: {resp.status}")
-                logger.debug(f"⚙️ Response cookies: {resp.cookies}")
-                
-                if resp.status != 200:
-                    text = await resp.text()
-                    logger.error(f"🛑 Get inbound failed: status={resp.status}, response={text[:100]}...")
-                    return None
-                
-                try:
-                    data = await resp.json()
-                    if data.get("success"):
-                        logger.debug(f'⚙️ Data: {str(data)}')
-                        return data.get("obj")
-                    else:
-                        logger.error(f"🛑 Get inbound failed: {data.get('msg')}")
-                        return None
-                except:
-                    text = await resp.text()
-                    logger.error(f"🛑 Get inbound response error: {text[:100]}...")
-                    return None
+            logger.info(f"ℹ️  Getting inbound data: {inbound_id}")
+            status, data = await self._request("GET", f"api/inbounds/get/{inbound_id}")
+
+            if status != 200:
+                logger.error(f"🛑 Get inbound failed: status={status}, response={str(data)[:100]}...")
+                return None
+
+            if isinstance(data, dict):
+                if data.get("success"):
+                    logger.debug(f'⚙️ Data: {str(data)}')
+                    return data.get("obj")
+                logger.error(f"🛑 Get inbound failed: {data.get('msg')}")
+                return None
+
+            logger.error(f"🛑 Get inbound response error: {str(data)[:100]}...")
+            return None
+        except CircuitOpenError as e:
+            logger.warning(f"⚠️ Get inbound {inbound_id} skipped: {e}")
+            return None
         except Exception as e:
             logger.exception(f"🛑 Get inbound error: {e}")
             return None
 
+    async def get_inbound_snapshot(self, inbound_id: int, max_age: float = None, allow_stale: bool = True):
+        """Разобранный снимок инбаунда из кэша (параллельные запросы объединяются)"""
+        return await self.inbound_cache.get(inbound_id, max_age, allow_stale)
+
     async def update_inbound(self, inbound_id: int, data: dict):
         """Обновление инбаунда"""
         try:
-            base_url = config.XUI_API_URL.rstrip('/')
-            base_path = config.XUI_BASE_PATH.strip('/')
-            if base_path:
-                base_url = f"{base_url}/{base_path}"
-            url = f"{base_url}/api/inbounds/update/{inbound_id}"
-            
-            logger.info(f"ℹ️  Updating inbound at: {url}")
-            
-            async with self.session.post(url, json=data) as resp:
-                if resp.status != 200:
-                    logger.error(f"🛑 Update inbound failed with status: {resp.status}")
-                    return False
-                
-                try:
-                    response = await resp.json()
-                    return response.get("success", False)
-                except:
-                    text = await resp.text()
-                    return "success" in text.lower()
+            logger.info(f"ℹ️  Updating inbound: {inbound_id}")
+            status, response = await self._request("POST", f"api/inbounds/update/{inbound_id}", json=data)
+
+            if status != 200:
+                logger.error(f"🛑 Update inbound failed with status: {status}")
+                return False
+
+            if isinstance(response, dict):
+                return response.get("success", False)
+            return "success" in str(response).lower()
         except Exception as e:
             logger.exception(f"🛑 Update inbound error: {e}")
             return False
 
-    async def create_vless_profile(self, telegram_id: int):
-        """Создание нового клиента для пользователя"""
-        if not await self.login():
-            logger.error("🛑 Login failed before creating profile")
-            return None
-        
-        inbound = await self.get_inbound(config.INBOUND_ID)
-        if not inbound:
-            logger.error(f"🛑 Inbound {config.INBOUND_ID} not found")
-            return None
-        
+    @staticmethod
+    def _is_success(status, data) -> bool:
+        """Панель отвечает {"success": true} (старые версии — текстом)"""
+        if status != 200:
+            return False
+        if isinstance(data, dict):
+            return bool(data.get("success", False))
+        return "success" in str(data).lower()
+
+    @staticmethod
+    def _is_not_found(status, data) -> bool:
+        """Панель ответила, что такого клиента нет ("Client Not Found")"""
+        message = data.get("msg", "") if isinstance(data, dict) else data
+        return status == 200 and "not found" in str(message).lower()
+
+    def _build_client(self, client_id: str, email: str, expiry_time: int = 0) -> dict:
+        """Настройки клиента для инбаунда с Reality (expiry_time — мс, 0 — бессрочно)"""
+        return {
+            "id": client_id,
+            "flow": "",
+            "email": email,
+            "limitIp": 0,
+            "totalGB": 0,
+            "expiryTime": expiry_time,
+            "enable": True,
+            "tgId": "",
+            "subId": "",
+            "reset": 0,
+            # Добавляем настройки для Reality
+            "fingerprint": self.node.reality_fingerprint,
+            "publicKey": self.node.reality_public_key,
+            "shortId": self.node.reality_short_id,
+            "spiderX": self.node.reality_spider_x
+        }
+
+    def _build_profile(self, client_id: str, email: str, inbound_id: int, meta: dict) -> dict:
+        """Данные профиля, которые сохраняются в БД и идут в vless-ссылку"""
+        return {
+            "client_id": client_id,
+            "email": email,
+            # Где живет клиент: по этим полям идут удаление, статистика и ссылка
+            "node": self.node.name,
+            "inbound_id": inbound_id,
+            "port": meta["port"],
+            # Указываем тип безопасности как reality
+            "security": "reality",
+            "remark": meta["remark"],
+            # Добавляем необходимые параметры для Reality
+            "sni": self.node.reality_sni,
+            "pbk": self.node.reality_public_key,
+            "fp": self.node.reality_fingerprint,
+            "sid": self.node.reality_short_id,
+            "spx": self.node.reality_spider_x
+        }
+
+    async def _get_inbound_meta(self, inbound_id: int):
+        """Порт и remark инбаунда (не меняются, поэтому запрашиваем один раз)"""
+        meta = self._inbound_meta.get(inbound_id)
+        if meta is None:
+            snapshot = await self.get_inbound_snapshot(inbound_id)
+            if not snapshot:
+                return None
+            meta = {"port": snapshot.inbound["port"], "remark": snapshot.inbound["remark"]}
+            self._inbound_meta[inbound_id] = meta
+        return meta
+
+    def _disable_per_client_api(self, endpoint: str):
+        """Старая панель без addClient/delClient/updateClient — дальше работаем через update"""
+        if self.per_client_api:
+            logger.warning(f"⚠️ Panel has no {endpoint} endpoint, falling back to full inbound update")
+        self.per_client_api = False
+
+    def mutation_queue(self, inbound_id: int) -> InboundMutationQueue:
+        """Очередь записей для инбаунда (одна на инбаунд)"""
+        queue = self._mutation_queues.get(inbound_id)
+        if queue is None:
+            queue = InboundMutationQueue(self, inbound_id, config.XUI_COALESCE_WINDOW)
+            self._mutation_queues[inbound_id] = queue
+        return queue
+
+    async def _rewrite_clients(self, inbound_id: int, add: list = (), remove_emails=(), replace: list = ()):
+        """Запасной путь для старых панелей: читаем весь инбаунд и записываем его целиком.
+
+        add — новые клиенты, remove_emails — email удаляемых клиентов,
+        replace — клиенты, которые нужно заменить по id.
+        Возвращает (успех, множество email из remove_emails, которых после записи в инбаунде нет —
+        в том числе тех, кого там не было и до нее).
+        """
+        # Перед перезаписью нужен свежий снимок, а не закэшированный
+        snapshot = await self.get_inbound_snapshot(inbound_id, max_age=0, allow_stale=False)
+        if not snapshot:
+            logger.error(f"🛑 Inbound {inbound_id} not found")
+            return False, set()
+
+        inbound = snapshot.inbound
+        clients = snapshot.clients
+
+        remove_emails = set(remove_emails)
+        replace_by_id = {c["id"]: c for c in replace}
+
+        new_clients = [
+            replace_by_id.get(c["id"], c)
+            for c in clients
+            if c["email"] not in remove_emails
+        ]
+        removed = remove_emails & {c["email"] for c in clients}
+        new_clients.extend(add)
+
+        # Если не было изменений (удаляемых клиентов в панели уже нет — это тоже успех)
+        if not add and not replace_by_id and not removed:
+            return True, remove_emails
+
+        # Снимок общий для всех читателей — меняем копию settings
+        settings = dict(snapshot.settings)
+        settings["clients"] = new_clients
+
+        # Формируем данные для обновления
+        update_data = {
+            "up": inbound["up"],
+            "down": inbound["down"],
+            "total": inbound["total"],
+            "remark": inbound["remark"],
+            "enable": inbound["enable"],
+            "expiryTime": inbound["expiryTime"],
+            "listen": inbound["listen"],
+            "port": inbound["port"],
+            "protocol": inbound["protocol"],
+            "settings": serialization.dumps(settings),
+            "streamSettings": inbound["streamSettings"],
+            "sniffing": inbound["sniffing"],
+            "allocate": inbound.get("allocate")
+        }
+
+        ok = await self.update_inbound(inbound_id, update_data)
+        return ok, remove_emails if ok else set()
+
+    async def _post_clients(self, path: str, inbound_id: int, clients: list):
+        payload = {"id": inbound_id, "settings": serialization.dumps({"clients": clients})}
+        return await self._request("POST", path, json=payload)
+
+    async def _apply_per_client(self, inbound_id: int, add: list, remove: list, update: list, results: dict):
+        """Пачка изменений через addClient/updateClient/delClient.
+
+        Возвращает то, что не удалось применить из-за отсутствия эндпоинтов
+        (панель старой версии) — это дописывается через полную перезапись.
+        """
+        if add:
+            status, data = await self._post_clients("api/inbounds/addClient", inbound_id, add)
+            if status == 404:
+                self._disable_per_client_api("addClient")
+                return add, remove, update
+            ok = self._is_success(status, data)
+            if not ok and len(add) > 1:
+                # Один плохой клиент не должен валить всю пачку
+                for client in add:
+                    status, data = await self._post_clients("api/inbounds/addClient", inbound_id, [client])
+                    results[("add", client["email"])] = self._is_success(status, data)
+            else:
+                for client in add:
+                    results[("add", client["email"])] = ok
+
+        for i, client in enumerate(update):
+            status, data = await self._post_clients(
+                f"api/inbounds/updateClient/{client['id']}", inbound_id, [client]
+            )
+            if status == 404:
+                self._disable_per_client_api("updateClient")
+                return [], remove, update[i:]
+            results[("update", client["id"])] = self._is_success(status, data)
+
+        # UUID тех, кого удаляют только по email, ищем одним чтением инбаунда
+        snapshot = None
+        if any(not client_id for _, client_id in remove):
+            snapshot = await self.get_inbound_snapshot(inbound_id, max_age=0, allow_stale=False)
+
+        for i, (email, client_id) in enumerate(remove):
+            if not client_id:
+                client = snapshot.find(email) if snapshot else None
+                client_id = client.get("id") if client else None
+            if not client_id:
+                # В свежем снимке клиента нет — удалять нечего, цель достигнута
+                results[("remove", email)] = snapshot is not None
+                continue
+            status, data = await self._request("POST", f"api/inbounds/{inbound_id}/delClient/{client_id}")
+            if status == 404:
+                self._disable_per_client_api("delClient")
+                return [], remove[i:], []
+            # Клиента уже удалили (вручную, сверкой) — для вызывающего это такой же успех
+            results[("remove", email)] = self._is_success(status, data) or self._is_not_found(status, data)
+
+        return [], [], []
+
+    async def apply_mutations(self, inbound_id: int, add: list = (), remove: list = (), update: list = (),
+                              results: dict = None):
+        """Применение пачки изменений инбаунда (вызывается из очереди записей).
+
+        add — новые клиенты, remove — пары (email, client_id), update — измененные клиенты.
+        Возвращает словарь {("add"|"update"|"remove", email или id): успех}. Если передан
+        results, он заполняется по ходу записи — при исключении в нем остается уже примененное.
+        """
+        results = {} if results is None else results
+        add, remove, update = list(add), list(remove), list(update)
+
         try:
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-            
-            client_id = str(uuid.uuid4())
-            email = f"user_{telegram_id}_{random.randint(1000,9999)}"
-            
-            # Обновленные настройки для Reality
-            new_client = {
-                "id": client_id,
-                "flow": "",
-                "email": email,
-                "limitIp": 0,
-                "totalGB": 0,
-                "expiryTime": 0,
-                "enable": True,
-                "tgId": str(telegram_id),
-                "tgId": "",
-                "subId": "",
-                "reset": 0,
-                # Добавляем настройки для Reality
-                "fingerprint": config.REALITY_FINGERPRINT,
-                "publicKey": config.REALITY_PUBLIC_KEY,
-                "shortId": config.REALITY_SHORT_ID,
-                "spiderX": config.REALITY_SPIDER_X
-            }
-            
-            clients.append(new_client)
-            settings["clients"] = clients
-            
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
-                "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
-                # "allocate": inbound["allocate"]
-            }
-            
-            if await self.update_inbound(config.INBOUND_ID, update_data):
-                return {
-                    "client_id": client_id,
-                    "email": email,
-                    "port": inbound["port"],
-                    # Указываем тип безопасности как reality
-                    "security": "reality",
-                    "remark": inbound["remark"],
-                    # Добавляем необходимые параметры для Reality
-                    "sni": config.REALITY_SNI,
-                    "pbk": config.REALITY_PUBLIC_KEY,
-                    "fp": config.REALITY_FINGERPRINT,
-                    "sid": config.REALITY_SHORT_ID,
-                    "spx": config.REALITY_SPIDER_X
-                }
-            return None
-        except Exception as e:
-            logger.exception(f"🛑 Create profile error: {e}")
+            # Крупную пачку удалений дешевле записать одной перезаписью инбаунда
+            if self.per_client_api and len(remove) + len(update) <= config.XUI_REWRITE_THRESHOLD:
+                add, remove, update = await self._apply_per_client(inbound_id, add, remove, update, results)
+
+            if add or remove or update:
+                ok, removed = await self._rewrite_clients(
+                    inbound_id,
+                    add=add,
+                    remove_emails=[email for email, _ in remove],
+                    replace=update
+                )
+                for client in add:
+                    results[("add", client["email"])] = ok
+                for client in update:
+                    results[("update", client["id"])] = ok
+                for email, _ in remove:
+                    results[("remove", email)] = email in removed
+        finally:
+            # Любая наша запись (даже прерванная) делает закэшированный снимок устаревшим
+            self.inbound_cache.invalidate(inbound_id)
+        return results
+
+    async def add_clients(self, inbound_id: int, clients: list):
+        """Добавление клиентов через очередь записей"""
+        queue = self.mutation_queue(inbound_id)
+        results = await asyncio.gather(*(queue.add(client) for client in clients))
+        return all(results)
+
+    async def restore_clients(self, inbound_id: int, clients: list):
+        """Вернуть в инбаунд пропавших клиентов [(client_id, email, expiry_time), ...] с прежними UUID.
+
+        Ссылки пользователей остаются рабочими. Возвращает {email: успех}.
+        """
+        queue = self.mutation_queue(inbound_id)
+        results = await asyncio.gather(
+            *(queue.add(self._build_client(client_id, email, expiry_time))
+              for client_id, email, expiry_time in clients)
+        )
+        return {email: ok for (_, email, _), ok in zip(clients, results)}
+
+    async def set_client_expiry(self, inbound_id: int, email: str, expiry_time: int):
+        """Записать клиенту expiryTime (мс): по нему Xray сам отключит доступ"""
+        snapshot = await self.get_inbound_snapshot(inbound_id)
+        client = snapshot.find(email) if snapshot else None
+        if client is None:
+            logger.warning(f"⚠️ Client {email} not found in inbound {inbound_id}, expiry not updated")
+            return False
+        updated = client_with_expiry(client, expiry_time)
+        if updated is None:
+            return True
+        return await self.update_client(inbound_id, updated)
+
+    async def update_client(self, inbound_id: int, client: dict):
+        """Изменение одного клиента через очередь записей"""
+        return await self.mutation_queue(inbound_id).update(client)
+
+    async def find_client(self, inbound_id: int, email: str):
+        """Поиск клиента в инбаунде по email"""
+        snapshot = await self.get_inbound_snapshot(inbound_id)
+        if not snapshot:
             return None
+        return snapshot.find(email)
+
+    @property
+    def default_inbound(self) -> int:
+        return self.node.inbounds[0]
 
-    async def create_static_client(self, profile_name: str):
+    async def create_vless_profile(self, telegram_id: int, inbound_id: int = None, expiry_time: int = 0):
+        """Создание нового клиента для пользователя"""
+        email = f"user_{telegram_id}_{random.randint(1000,9999)}"
+        return await self._create_client(email, inbound_id or self.default_inbound, expiry_time)
+
+    async def create_static_client(self, profile_name: str, inbound_id: int = None):
         """Создание статического клиента"""
-        if not await self.login():
-            logger.error("🛑 Login failed before creating static client")
-            return None
-        
-        inbound = await self.get_inbound(config.INBOUND_ID)
-        if not inbound:
-            logger.error(f"🛑 Inbound {config.INBOUND_ID} not found")
+        return await self._create_client(profile_name, inbound_id or self.default_inbound)
+
+    async def _create_client(self, email: str, inbound_id: int, expiry_time: int = 0):
+        meta = await self._get_inbound_meta(inbound_id)
+        if not meta:
+            logger.error(f"🛑 Inbound {inbound_id} not found")
             return None
-        
+
         try:
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-            
             client_id = str(uuid.uuid4())
-            
-            # Обновленные настройки для Reality
-            new_client = {
-                "id": client_id,
-                "flow": "",
-                "email": profile_name,
-                "limitIp": 0,
-                "totalGB": 0,
-                "expiryTime": 0,
-                "enable": True,
-                "tgId": "",
-                "subId": "",
-                "reset": 0,
-                # Добавляем настройки для Reality
-                "fingerprint": config.REALITY_FINGERPRINT,
-                "publicKey": config.REALITY_PUBLIC_KEY,
-                "shortId": config.REALITY_SHORT_ID,
-                "spiderX": config.REALITY_SPIDER_X
-            }
-            
-            clients.append(new_client)
-            settings["clients"] = clients
-            
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
-                "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
-                # "allocate": inbound["allocate"]
-            }
-            
-            if await self.update_inbound(config.INBOUND_ID, update_data):
-                return {
-                    "client_id": client_id,
-                    "email": profile_name,
-                    "port": inbound["port"],
-                    # Указываем тип безопасности как reality
-                    "security": "reality",
-                    "remark": inbound["remark"],
-                    # Добавляем необходимые параметры для Reality
-                    "sni": config.REALITY_SNI,
-                    "pbk": config.REALITY_PUBLIC_KEY,
-                    "fp": config.REALITY_FINGERPRINT,
-                    "sid": config.REALITY_SHORT_ID,
-                    "spx": config.REALITY_SPIDER_X
-                }
+            if await self.mutation_queue(inbound_id).add(self._build_client(client_id, email, expiry_time)):
+                return self._build_profile(client_id, email, inbound_id, meta)
             return None
         except Exception as e:
-            logger.exception(f"🛑 Create static client error: {e}")
+            logger.exception(f"🛑 Create client error: {e}")
             return None
 
-    async def delete_client(self, email: str):
-        """Удаление клиента по email"""
-        if not await self.login():
-            return False
-        
+    async def delete_client(self, email: str, client_id: str = None, inbound_id: int = None):
+        """Удаление клиента по email (client_id экономит поиск по инбаунду)"""
         try:
-            # Получаем данные инбаунда
-            inbound = await self.get_inbound(config.INBOUND_ID)
-            if not inbound:
-                return False
-            
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-            
-            # Фильтруем клиентов
-            new_clients = [c for c in clients if c["email"] != email]
-            
-            # Если не было изменений
-            if len(new_clients) == len(clients):
-                return False
-            
-            settings["clients"] = new_clients
-            
-            # Формируем данные для обновления
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
-                "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
-                "allocate": inbound.get("allocate")
-            }
-            
-            return await self.update_inbound(config.INBOUND_ID, update_data)
+            return await self.mutation_queue(inbound_id or self.default_inbound).remove(email, client_id)
         except Exception as e:
             logger.exception(f"🛑 Delete client error: {e}")
             return False
+
+    async def delete_clients(self, clients: list, inbound_id: int = None):
+        """Удаление пачки клиентов [(email, client_id), ...] одной записью.
+
+        Возвращает {email: успех}.
+        """
+        queue = self.mutation_queue(inbound_id or self.default_inbound)
+        results = await asyncio.gather(*(queue.remove(email, client_id) for email, client_id in clients))
+        return {email: ok for (email, _), ok in zip(clients, results)}
     
     async def get_user_stats(self, email: str):
         """Получение статистики по email"""
-        if not await self.login():
-            logger.error("🛑 Login failed before getting stats")
-            return {"upload": 0, "download": 0}
-        
         try:
-            base_url = config.XUI_API_URL.rstrip('/')
-            base_path = config.XUI_BASE_PATH.strip('/')
-            if base_path:
-                base_url = f"{base_url}/{base_path}"
-            url = f"{base_url}/api/inbounds/getClientTraffics/{email}"
-            
-            async with self.session.get(url) as resp:
-                if resp.status != 200:
-                    return {"upload": 0, "download": 0}
-                
-                try:
-                    data = await resp.json()
-                    if data.get("success"):
-                        client_data = data.get("obj")
-                        if isinstance(client_data, dict):
-                            return {
-                                "upload": client_data.get("up", 0),
-                                "download": client_data.get("down", 0)
-                            }
-                except:
-                    return {"upload": 0, "download": 0}
+            status, data = await self._request("GET", f"api/inbounds/getClientTraffics/{email}")
+            if status != 200 or not isinstance(data, dict):
+                return {"upload": 0, "download": 0}
+
+            if data.get("success"):
+                client_data = data.get("obj")
+                if isinstance(client_data, dict):
+                    return {
+                        "upload": client_data.get("up", 0),
+                        "download": client_data.get("down", 0)
+                    }
         except Exception as e:
             logger.error(f"🛑 Stats error: {e}")
         return {"upload": 0, "download": 0}
     
+    async def get_all_client_traffics(self, inbound_id: int, max_age: float = None):
+        """Трафик всех клиентов инбаунда одним запросом: {email: {"upload", "download"}}"""
+        snapshot = await self.get_inbound_snapshot(inbound_id, max_age)
+        if not snapshot:
+            return None
+        return snapshot.traffic_by_email
+
+    def recent_traffic_rate(self, inbound_id: int, snapshot) -> float:
+        """Недавний трафик инбаунда (байт/сек) по разнице счетчиков между снимками"""
+        total = snapshot.inbound.get("up", 0) + snapshot.inbound.get("down", 0)
+        mark = self._traffic_marks.get(inbound_id)
+        if mark is None or total < mark[1]:
+            self._traffic_marks[inbound_id] = (snapshot.fetched_at, total, 0.0)
+            return 0.0
+
+        fetched_at, last_total, rate = mark
+        elapsed = snapshot.fetched_at - fetched_at
+        # Слишком близкие снимки дают шум, оставляем прошлую оценку
+        if elapsed >= 60:
+            rate = (total - last_total) / elapsed
+            self._traffic_marks[inbound_id] = (snapshot.fetched_at, total, rate)
+        return rate
+
     async def get_global_stats(self, inbound_id: int):
-        """Получение статистики по email"""
-        if not await self.login():
-            logger.error("🛑 Login failed before getting stats")
-            return {"upload": 0, "download": 0}
-        
+        """Получение общей статистики инбаунда"""
         try:
-            base_url = config.XUI_API_URL.rstrip('/')
-            base_path = config.XUI_BASE_PATH.strip('/')
-            if base_path:
-                base_url = f"{base_url}/{base_path}"
-            url = f"{base_url}/api/inbounds/get/{inbound_id}"
-            
-            async with self.session.get(url) as resp:
-                if resp.status != 200:
-                    return {"upload": 0, "download": 0}
-                
-                try:
-                    data = await resp.json()
-                    if data.get("success"):
-                        client_data = data.get("obj")
-                        if isinstance(client_data, dict):
-                            return {
-                                "upload": client_data.get("up", 0),
-                                "download": client_data.get("down", 0)
-                            }
-                except:
-                    return {"upload": 0, "download": 0}
+            snapshot = await self.get_inbound_snapshot(inbound_id)
+            if snapshot:
+                return {
+                    "upload": snapshot.inbound.get("up", 0),
+                    "download": snapshot.inbound.get("down", 0)
+                }
         except Exception as e:
             logger.error(f"🛑 Stats error: {e}")
         return {"upload": 0, "download": 0}
 
     async def get_online_users(self):
-        if not await self.login():
-            logger.error("🛑 Login failed before getting stats")
-            return {"upload": 0, "download": 0}
-        
+        """Количество онлайн-клиентов бота"""
         try:
-            base_url = config.XUI_API_URL.rstrip('/')
-            base_path = config.XUI_BASE_PATH.strip('/')
-            if base_path:
-                base_url = f"{base_url}/{base_path}"
-            url = f"{base_url}/api/inbounds/onlines"
-            
-            async with self.session.post(url) as resp:
-                if resp.status != 200:
-                    return 0
+            # onlines только читает, поэтому его можно повторять
+            status, data = await self._request("POST", "api/inbounds/onlines", idempotent=True)
+            if status != 200 or not isinstance(data, dict):
+                return self._last_online
 
-                
-                try:
-                    data = await resp.json()
-                    logger.debug(data)
-                    online = 0
-                    if data.get("success"):
-                        users = data.get("obj")
-                        if isinstance(users, list):
-                            for user in users:
-                                if str(user).startswith("user_"):
-                                    online += 1
-                        return online
-                except:
-                    return 0
+            logger.debug(data)
+            online = 0
+            if data.get("success"):
+                users = data.get("obj")
+                if isinstance(users, list):
+                    for user in users:
+                        if str(user).startswith("user_"):
+                            online += 1
+            self._last_online = online
+            return online
         except Exception as e:
             logger.error(f"🛑 Stats error: {e}")
-        return {"upload": 0, "download": 0}
+        # Панель недоступна — показываем последнее известное значение
+        return self._last_online
+
+    def health(self) -> dict:
+        """Состояние узла для админ-меню"""
+        return {"node": self.node.name, **self.breaker.describe()}
 
     async def close(self):
+        # Дописываем в панель всё, что уже стоит в очередях
+        for queue in self._mutation_queues.values():
+            await queue.drain()
         if self.session:
             await self.session.close()
+        self.session = None
+        self.logged_in = False
+
+
+# Один долгоживущий клиент (своя сессия и пул соединений) на каждый узел
+_xui_apis = {}
+
+def get_xui_api(node_name: str = None) -> XUIAPI:
+    """Общий для всего бота экземпляр XUIAPI нужного узла (по умолчанию — основного)"""
+    node = config.get_node(node_name)
+    api = _xui_apis.get(node.name)
+    if api is None:
+        api = XUIAPI(node)
+        _xui_apis[node.name] = api
+    return api
+
+async def close_xui_api():
+    """Закрытие сессий всех узлов при остановке бота"""
+    for api in list(_xui_apis.values()):
+        await api.close()
+    _xui_apis.clear()
+
+def get_xui_health():
+    """Состояние предохранителей всех узлов"""
+    return [get_xui_api(node.name).health() for node in config.nodes]
+
+def profile_location(profile_data: dict):
+    """Узел и инбаунд клиента из данных профиля (старые профили — основной узел)"""
+    api = get_xui_api(profile_data.get("node"))
+    return api, profile_data.get("inbound_id") or api.default_inbound
 
-async def force_check_subscription(user_id: int):
+def _all_targets():
+    """Все пары (клиент узла, инбаунд) из реестра узлов"""
+    return [
+        (get_xui_api(node.name), inbound_id)
+        for node in config.nodes
+        for inbound_id in node.inbounds
+    ]
+
+async def choose_placement():
+    """Наименее загруженные узел и инбаунд для нового клиента.
+
+    Нагрузка — доля клиентов плюс доля недавнего трафика среди всех кандидатов.
     """
-    Принудительная проверка и обновление статуса подписки
+    targets = _all_targets()
+    snapshots = await asyncio.gather(
+        *(api.get_inbound_snapshot(inbound_id) for api, inbound_id in targets)
+    )
+
+    candidates = []
+    for (api, inbound_id), snapshot in zip(targets, snapshots):
+        if not snapshot:
+            continue
+        clients = len(snapshot.clients)
+        if api.node.max_clients and clients >= api.node.max_clients:
+            continue
+        candidates.append((api, inbound_id, clients, api.recent_traffic_rate(inbound_id, snapshot)))
+
+    if not candidates:
+        return None
+
+    total_clients = sum(c[2] for c in candidates) or 1
+    total_traffic = sum(c[3] for c in candidates) or 1
+    weight = config.XUI_PLACEMENT_TRAFFIC_WEIGHT
+
+    api, inbound_id, clients, traffic = min(
+        candidates,
+        key=lambda c: c[2] / total_clients + weight * c[3] / total_traffic
+    )
+    logger.info(f"ℹ️  Placement: node {api.node.name}, inbound {inbound_id} ({clients} clients)")
+    return api, inbound_id
+
+def expiry_ms(subscription_end: datetime) -> int:
+    """subscription_end -> expiryTime клиента в мс (наивные даты — UTC, см. as_utc)"""
+    if not subscription_end:
+        return 0
+    return int(as_utc(subscription_end).timestamp() * 1000)
+
+def client_with_expiry(client: dict, expiry_time: int):
+    """Клиент с новым expiryTime или None, если менять нечего.
+
+    Истекшего клиента панель выключает (enable=False) — с будущим сроком включаем обратно,
+    иначе продление не вернет доступ.
     """
-    user = await get_user(user_id)
-    if not user:
-        return "not_found"
-    
-    status, _ = check_subscription_status(user)
-    
-    # Если подписка истекла, но в XUI еще есть клиент
-    if status == "Истекла" and user.vless_profile_data:
-        try:
-            profile_data = json.loads(user.vless_profile_data)
-            email = profile_data.get("email")
-            if email and email != "N/A":
-                # Удаляем из XUI
-                await delete_client_by_email(email)
-                # Очищаем данные профиля
-                await update_user_profile(user_id, vless_profile_data=None)
-                logger.info(f"🧹 Удален истекший профиль: {user_id}")
-        except Exception as e:
-            logger.error(f"Ошибка при удалении истекшего профиля: {e}")
-    
-    return status
+    updated = {**client, "expiryTime": expiry_time}
+    if expiry_time > time.time() * 1000:
+        updated["enable"] = True
+    return None if updated == client else updated
 
+async def create_vless_profile(telegram_id: int, subscription_end: datetime = None):
+    placement = await choose_placement()
+    if not placement:
+        logger.error("🛑 No available node for a new client")
+        return None
+    api, inbound_id = placement
+    return await api.create_vless_profile(telegram_id, inbound_id, expiry_ms(subscription_end))
 
-async def create_vless_profile(telegram_id: int):
-    api = XUIAPI()
+async def sync_client_expiry(user):
+    """Перенести subscription_end пользователя в expiryTime его клиента в панели"""
+    if not user or not user.vless_profile_data:
+        return False
     try:
-        return await api.create_vless_profile(telegram_id)
-    finally:
-        await api.close()
+        profile_data = profile_ref(user)
+        if not profile_data:
+            return False
+        api, inbound_id = profile_location(profile_data)
+        return await api.set_client_expiry(
+            inbound_id, profile_data.get("email"), expiry_ms(user.subscription_end)
+        )
+    except Exception as e:
+        logger.error(f"🛑 Expiry sync failed for {user.telegram_id}: {e}")
+        return False
 
 async def create_static_client(profile_name: str):
-    api = XUIAPI()
-    try:
-        return await api.create_static_client(profile_name)
-    finally:
-        await api.close()
+    # Статические профили живут на основном узле
+    return await get_xui_api().create_static_client(profile_name)
 
-async def delete_client_by_email(email: str):
-    api = XUIAPI()
-    try:
-        return await api.delete_client(email)
-    finally:
-        await api.close()
+async def delete_client_by_email(email: str, client_id: str = None, node: str = None, inbound_id: int = None):
+    return await get_xui_api(node).delete_client(email, client_id, inbound_id)
+
+async def delete_profile_client(profile_data: dict):
+    """Удаление клиента из панели по сохраненным данным профиля"""
+    api, inbound_id = profile_location(profile_data)
+    return await api.delete_client(profile_data.get("email"), profile_data.get("client_id"), inbound_id)
+
+async def delete_clients(profiles: list):
+    """Пакетное удаление клиентов по данным профилей: одна пачка на инбаунд.
+
+    Возвращает {email: успех}.
+    """
+    groups = {}
+    for profile_data in profiles:
+        api, inbound_id = profile_location(profile_data)
+        groups.setdefault((api, inbound_id), []).append(
+            (profile_data.get("email"), profile_data.get("client_id"))
+        )
+
+    results = {}
+    for batch in await asyncio.gather(
+        *(api.delete_clients(clients, inbound_id) for (api, inbound_id), clients in groups.items())
+    ):
+        results.update(batch)
+    return results
 
 async def get_global_stats():
-    api = XUIAPI()
-    try:
-        return await api.get_global_stats(config.INBOUND_ID)
-    finally:
-        await api.close()
+    stats = await asyncio.gather(
+        *(api.get_global_stats(inbound_id) for api, inbound_id in _all_targets())
+    )
+    return {
+        "upload": sum(s["upload"] for s in stats),
+        "download": sum(s["download"] for s in stats)
+    }
 
 async def get_online_users():
-    api = XUIAPI()
-    try:
-        return await api.get_online_users()
-    finally:
-        await api.close()
+    apis = [get_xui_api(node.name) for node in config.nodes]
+    return sum(await asyncio.gather(*(api.get_online_users() for api in apis)))
 
-async def get_user_stats(email: str):
-    api = XUIAPI()
-    try:
-        return await api.get_user_stats(email)
-    finally:
-        await api.close()
+async def get_all_client_traffics(max_age: float = None):
+    """Трафик клиентов со всех узлов и инбаундов: {email: {"upload", "download"}}.
+
+    None — если не ответил ни один узел.
+    """
+    results = await asyncio.gather(
+        *(api.get_all_client_traffics(inbound_id, max_age) for api, inbound_id in _all_targets())
+    )
+    if all(traffics is None for traffics in results):
+        return None
+    merged = {}
+    for traffics in results:
+        merged.update(traffics or {})
+    return merged
+
+async def get_user_stats(email: str, node: str = None):
+    # Сначала смотрим в общий снимок трафика, отдельный запрос — только для новых клиентов
+    traffics = await get_all_client_traffics(config.XUI_TRAFFIC_CACHE_TTL)
+    if traffics and email in traffics:
+        return traffics[email]
+    return await get_xui_api(node).get_user_stats(email)
+
+def format_traffic(num_bytes: int) -> str:
+    """Трафик в MB или GB для сообщений"""
+    megabytes = (num_bytes or 0) / (1024 * 1024)
+    if megabytes >= 1024:
+        return f"{megabytes / 1024:.2f} GB"
+    return f"{megabytes:.2f} MB"
+
+def client_id_from_vless_url(vless_url: str):
+    """UUID клиента из ссылки vless://<uuid>@host:port..."""
+    if not vless_url or "://" not in vless_url:
+        return None
+    return vless_url.split("://", 1)[1].split("@", 1)[0] or None
 
 def generate_vless_url(profile_data: dict) -> str:
+    node = config.get_node(profile_data.get("node"))
     remark = profile_data.get('remark', '')
     email = profile_data['email']
     fragment = f"{remark}-{email}" if remark else email
     
     return (
-        f"vless://{profile_data['client_id']}@{config.XUI_HOST}:{profile_data['port']}"
+        f"vless://{profile_data['client_id']}@{node.host}:{profile_data['port']}"
         f"?type=tcp&security=reality&encryption=none"  # <-- добавили encryption=none
-        f"&pbk={config.REALITY_PUBLIC_KEY}"
-        f"&fp={config.REALITY_FINGERPRINT}"
-        f"&sni={config.REALITY_SNI}"
-        f"&sid={config.REALITY_SHORT_ID}"
-        f"&spx={config.REALITY_SPIDER_X}"
+        f"&pbk={node.reality_public_key}"
+        f"&fp={node.reality_fingerprint}"
+        f"&sni={node.reality_sni}"
+        f"&sid={node.reality_short_id}"
+        f"&spx={node.reality_spider_x}"
         f"#{fragment}"
-    )
\ No newline at end of file
+    )
@@ -1,6 +1,8 @@
 import asyncio
+import html
 import logging
-import json
+import serialization
+import time
 from datetime import datetime, timedelta
 from aiogram import Dispatcher, Router, F, Bot
 from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery
@@ -19,14 +21,19 @@ from aiogram import F
 import aiohttp
 from aiogram.types import Message
 from database import (
-    StaticProfile, get_user, create_user, update_subscription, 
+    get_user, create_user, update_subscription, 
     add_time_to_subscription, remove_time_from_subscription,
     get_all_users, create_static_profile, get_static_profiles, 
-    User, Session, get_user_stats as db_user_stats,
-    get_admin_users
+    get_user_stats as db_user_stats, update_user_info, update_user_profile,
+    get_static_profile, delete_static_profile, get_users_page, count_users, get_user_cache_stats,
+    get_admin_users, get_traffic_usage, get_traffic_totals, delete_user_profile,
+    get_user_by_client_email, profile_ref, as_utc
 )
-from functions import create_vless_profile, delete_client_by_email, generate_vless_url, get_user_stats, create_static_client, get_global_stats, get_online_users
+from functions import create_vless_profile, sync_client_expiry, delete_client_by_email, delete_profile_client, generate_vless_url, client_id_from_vless_url, create_static_client, get_online_users, get_xui_health, format_traffic
 from notifications import send_subscription_extended_notification, send_test_notification
+from reconcile import reconcile
+from subscription_server import subscription_url, feed_cache
+from checker_metrics import checker_metrics
 
 #логируем 
 from logging.handlers import RotatingFileHandler
@@ -120,11 +127,8 @@ def check_subscription_status(user):
     # Текущее время в MSK
     now_msk = datetime.now(MSK)
     
-    # Если subscription_end naive, приводим к MSK
-    if user.subscription_end.tzinfo is None:
-        subscription_end_msk = MSK.localize(user.subscription_end)
-    else:
-        subscription_end_msk = user.subscription_end.astimezone(MSK)
+    # В БД срок хранится в UTC (см. as_utc), показываем по MSK
+    subscription_end_msk = as_utc(user.subscription_end).astimezone(MSK)
     
     # Проверяем статус
     if subscription_end_msk > now_msk:
@@ -291,31 +295,21 @@ async def connect_cmd(message: Message):
     # Текущее время в MSK
     now_msk = datetime.now(MSK)
     
-    # Приводим subscription_end к MSK если нужно
-    if user.subscription_end.tzinfo is None:
-        subscription_end_msk = MSK.localize(user.subscription_end)
-    else:
-        subscription_end_msk = user.subscription_end.astimezone(MSK)
+    # В БД срок хранится в UTC (см. as_utc), показываем по MSK
+    subscription_end_msk = as_utc(user.subscription_end).astimezone(MSK)
     
     # Проверяем истекла ли подписка
     if subscription_end_msk <= now_msk:
         # Если есть профиль в XUI - удаляем его
         if user.vless_profile_data:
             try:
-                profile_data = safe_json_loads(user.vless_profile_data, default={})
+                profile_data = profile_ref(user)
                 email = profile_data.get("email")
-                if email and email != "N/A":
-                    await delete_client_by_email(email)
+                # Профиль в БД чистим только после подтверждения панели, иначе клиент осиротеет.
+                # Клиент, которого в панели уже нет (или профиль без email), считается удаленным
+                if not email or email == "N/A" or await delete_profile_client(profile_data):
                     logger.info(f"🧹 Удален профиль истекшей подписки через /connect: {email}")
-                    
-                    # Обновляем БД - удаляем данные профиля
-                    with Session() as session:
-                        db_user = session.query(User).filter_by(
-                            telegram_id=user.telegram_id
-                        ).first()
-                        if db_user:
-                            db_user.vless_profile_data = None
-                            session.commit()
+                    await delete_user_profile(user.telegram_id)
             except Exception as e:
                 logger.error(f"Ошибка при удалении профиля: {e}")
         
@@ -339,19 +333,17 @@ async def connect_cmd(message: Message):
     if not user.vless_profile_data:
         # Создаем новый профиль
         msg = await message.answer("⚙️ Создаем ваш VPN профиль...")
-        profile_data = await create_vless_profile(user.telegram_id)
+        profile_data = await create_vless_profile(user.telegram_id, user.subscription_end)
         
         if not profile_data:
             await msg.edit_text("🛑 Ошибка при создании профиля. Попробуйте позже.")
             return
         
         # Сохраняем профиль в БД
-        with Session() as session:
-            db_user = session.query(User).filter_by(telegram_id=user.telegram_id).first()
-            if db_user:
-                db_user.vless_profile_data = json.dumps(profile_data)
-                session.commit()
-                logger.info(f"✅ Создан профиль через /connect для {user.telegram_id}")
+        if await update_user_profile(user.telegram_id, profile_data, reset_notifications=False):
+            logger.info(f"✅ Создан профиль через /connect для {user.telegram_id}")
+        # Подписочная ссылка должна сразу отдавать новый профиль
+        feed_cache.invalidate(user.telegram_id)
         
         # Уведомление админов
         for admin_id in config.ADMINS:
@@ -362,6 +354,7 @@ async def connect_cmd(message: Message):
                     f"👤 Telegram ID: `{user.telegram_id}`\n"
                     f"👤 Telegram User: `{user.full_name}`\n"
                     f"📧 Email: `{profile_data['email']}`\n"
+                    f"🖥 Узел: `{profile_data['node']}`\n"
                     f"🌐 Inbound: `{profile_data['remark']}`\n"
                     f"🔐 Security: `{profile_data['security']}`\n"
                     f"⏰ Подписка до: `{subscription_end_msk.strftime('%d.%m.%Y %H:%M')}`",
@@ -394,6 +387,7 @@ async def connect_cmd(message: Message):
         "2. Скопируйте эту ссылку и импортируйте в приложение:\n"
         f"<pre>{vless_url}</pre>\n\n"
         "3. Активируйте соединение в приложении."
+        f"{subscription_hint(user.telegram_id)}"
     )
     
     builder = InlineKeyboardBuilder()
@@ -526,12 +520,8 @@ async def start_cmd(message: Message, bot: Bot):
     
     # Обновляем данные если есть изменения
     if update_data:
-        with Session() as session:
-            db_user = session.query(User).get(user.id)
-            for key, value in update_data.items():
-                setattr(db_user, key, value)
-            session.commit()
-            logger.info(f"🔄 Updated user data: {message.from_user.id}")
+        await update_user_info(message.from_user.id, **update_data)
+        logger.info(f"🔄 Updated user data: {message.from_user.id}")
     
     await show_menu(bot, message.from_user.id)
 
@@ -553,12 +543,8 @@ async def menu_cmd(message: Message, bot: Bot):
     
     # Обновляем данные если есть изменения
     if update_data:
-        with Session() as session:
-            db_user = session.query(User).get(user.id)
-            for key, value in update_data.items():
-                setattr(db_user, key, value)
-            session.commit()
-            logger.info(f"🔄 Updated user data in menu: {message.from_user.id}")
+        await update_user_info(message.from_user.id, **update_data)
+        logger.info(f"🔄 Updated user data in menu: {message.from_user.id}")
     
     await show_menu(bot, message.from_user.id)
 
@@ -837,7 +823,8 @@ async def confirm_payment(callback: CallbackQuery, bot: Bot):
             builder = InlineKeyboardBuilder()
             builder.button(
                 text="✅ Подтвердить оплату", 
-                callback_data=f"confirm_payment_{user.telegram_id}_{months}"
+                # id запроса общий для всех админов: подтвердить можно только один раз
+                callback_data=f"confirm_payment_{user.telegram_id}_{months}_{callback.id}"
             )
             
             await bot.send_message(
@@ -875,8 +862,16 @@ async def process_successful_payment(message: Message, bot: Bot):
             now = datetime.utcnow()
             action_type = "продлена" if user.subscription_end > now else "куплена"
             
-            # Обновляем подписку с использованием новой функции
-            new_end_date = await update_subscription(message.from_user.id, months, is_admin_action=False)
+            # Продление атомарное и по charge_id: повторная доставка платежа не зачтется дважды
+            extension = await update_subscription(
+                message.from_user.id, months, is_admin_action=False,
+                payment_id=f"stars:{message.successful_payment.telegram_payment_charge_id}"
+            )
+            if extension and not extension.applied:
+                return
+            new_end_date = extension.subscription_end if extension else None
+            # Новая дата окончания сразу уходит в expiryTime клиента в панели
+            await sync_client_expiry(await get_user(message.from_user.id))
             suffix = "месяц" if months == 1 else "месяца" if months in (2,3,4) else "месяцев"
             
             if new_end_date:
@@ -1013,6 +1008,32 @@ async def admin_menu(callback: CallbackQuery):
         f"**С подпиской/Без подписки**: `{with_sub}`/`{without_sub}`\n"
         f"**Онлайн**: `{online_count}` | **Офлайн**: `{with_sub - online_count}`"
     )
+
+    # Состояние панелей: разомкнутый предохранитель значит, что показываются кэшированные данные
+    state_icons = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}
+    for health in get_xui_health():
+        line = f"\n{state_icons[health['state']]} Панель `{health['node']}`: `{health['state']}`"
+        if health["state"] == "open":
+            line += f", повтор через `{health['retry_in']}` с"
+        text += line
+
+    cache = get_user_cache_stats()
+    text += (
+        f"\n🗃 Кэш пользователей: `{cache['hit_rate']:.0%}` попаданий "
+        f"(`{cache['hits']}`/`{cache['hits'] + cache['misses']}`), в памяти `{cache['size']}`"
+    )
+
+    # Проверка подписок: последний проход и среднее время стадий
+    checker = checker_metrics.snapshot()
+    if checker["last_pass"]:
+        duration, users = checker["last_pass"]
+        stages = ", ".join(
+            f"{name} `{stage['avg_ms']:.0f}` мс" for name, stage in checker["stages"].items()
+        )
+        text += (
+            f"\n⏱ Проверка подписок: последний проход `{duration:.1f}` с на `{users}` польз., "
+            f"проходов `{checker['passes']}`; стадии: {stages}"
+        )
     
     builder = InlineKeyboardBuilder()
     builder.button(text="+ время", callback_data="admin_add_time")
@@ -1021,9 +1042,10 @@ async def admin_menu(callback: CallbackQuery):
     builder.button(text="📊 Статистика", callback_data="admin_network_stats")
     builder.button(text="📢 Рассылка", callback_data="admin_send_message")
     builder.button(text="🔔 Тест СМС", callback_data="admin_test_notification")  # Новая кнопка
+    builder.button(text="🔄 Сверка с панелью", callback_data="admin_reconcile")
     builder.button(text="⬅️ Назад", callback_data="back_to_menu")
     
-    builder.adjust(2, 2, 2, 1, 1, 1)
+    builder.adjust(2, 2, 2, 1, 1)
     
     await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode='Markdown')
 
@@ -1057,21 +1079,31 @@ async def admin_test_notification(callback: CallbackQuery, bot: Bot):
         await callback.message.answer(f"❌ Ошибка: {str(e)}")
 
 # Обработчики для управления временем подписки (ОБНОВЛЕННЫЕ)
+async def resolve_admin_target(text: str):
+    """Telegram ID из ввода админа: число или email клиента в панели"""
+    text = (text or "").strip()
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    user = await get_user_by_client_email(text) if text else None
+    return user.telegram_id if user else None
+
 @router.callback_query(F.data == "admin_add_time")
 async def admin_add_time_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()  # Снимаем анимацию
-    await callback.message.answer("Введите Telegram ID пользователя:")
+    await callback.message.answer("Введите Telegram ID пользователя или email его клиента:")
     await state.set_state(AdminStates.ADD_TIME_USER)
 
 @router.message(AdminStates.ADD_TIME_USER)
 async def admin_add_time_user(message: Message, state: FSMContext):
-    try:
-        user_id = int(message.text)
-        await state.update_data(user_id=user_id)
-        await message.answer("Введите количество времени в формате:\nМесяцы Дни Часы Минуты\nПример: 1 0 0 0")
-        await state.set_state(AdminStates.ADD_TIME_AMOUNT)
-    except ValueError:
-        await message.answer("Ошибка: ID должен быть числом")
+    user_id = await resolve_admin_target(message.text)
+    if user_id is None:
+        await message.answer("Ошибка: введите числовой ID или email клиента (user_...)")
+        return
+    await state.update_data(user_id=user_id)
+    await message.answer("Введите количество времени в формате:\nМесяцы Дни Часы Минуты\nПример: 1 0 0 0")
+    await state.set_state(AdminStates.ADD_TIME_AMOUNT)
 
 # ОБНОВЛЕННЫЙ обработчик добавления времени
 @router.message(AdminStates.ADD_TIME_AMOUNT)
@@ -1095,6 +1127,7 @@ async def admin_add_time_amount(message: Message, state: FSMContext, bot: Bot):
             hours=hours,
             minutes=minutes
         )
+        await sync_client_expiry(await get_user(user_id))
         
         if new_end_date:
             # Отправляем уведомление пользователю
@@ -1137,18 +1170,18 @@ async def admin_add_time_amount(message: Message, state: FSMContext, bot: Bot):
 @router.callback_query(F.data == "admin_remove_time")
 async def admin_remove_time_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()  # Снимаем анимацию
-    await callback.message.answer("Введите Telegram ID пользователя:")
+    await callback.message.answer("Введите Telegram ID пользователя или email его клиента:")
     await state.set_state(AdminStates.REMOVE_TIME_USER)
 
 @router.message(AdminStates.REMOVE_TIME_USER)
 async def admin_remove_time_user(message: Message, state: FSMContext):
-    try:
-        user_id = int(message.text)
-        await state.update_data(user_id=user_id)
-        await message.answer("Введите количество времени в формате:\nМесяцы Дни Часы Минуты\nПример: 1 0 0 0")
-        await state.set_state(AdminStates.REMOVE_TIME_AMOUNT)
-    except ValueError:
-        await message.answer("Ошибка: ID должен быть числом")
+    user_id = await resolve_admin_target(message.text)
+    if user_id is None:
+        await message.answer("Ошибка: введите числовой ID или email клиента (user_...)")
+        return
+    await state.update_data(user_id=user_id)
+    await message.answer("Введите количество времени в формате:\nМесяцы Дни Часы Минуты\nПример: 1 0 0 0")
+    await state.set_state(AdminStates.REMOVE_TIME_AMOUNT)
 
 # ОБНОВЛЕННЫЙ обработчик удаления времени
 @router.message(AdminStates.REMOVE_TIME_AMOUNT)
@@ -1172,6 +1205,7 @@ async def admin_remove_time_amount(message: Message, state: FSMContext, bot: Bot
             hours=hours,
             minutes=minutes
         )
+        await sync_client_expiry(await get_user(user_id))
         
         if new_end_date:
             # Формируем строку с удаленным временем
@@ -1205,91 +1239,89 @@ async def admin_remove_time_amount(message: Message, state: FSMContext, bot: Bot
 @router.callback_query(F.data == "admin_user_list")
 async def admin_user_list(callback: CallbackQuery):
     builder = InlineKeyboardBuilder()
-    builder.button(text="✅ С подпиской", callback_data="user_list_active")
-    builder.button(text="🛑 Без подписки", callback_data="user_list_inactive")
+    builder.button(text="✅ С подпиской", callback_data="ul:active:n")
+    builder.button(text="⏳ Истекают за 24 часа", callback_data="ul:expiring:n")
+    builder.button(text="🛑 Без подписки", callback_data="ul:inactive:n")
+    builder.button(text="⚠️ Без профиля", callback_data="ul:no_profile:n")
     builder.button(text="⏱️ Статические профили", callback_data="static_profiles_menu")
     builder.button(text="⬅️ Назад", callback_data="admin_menu")
-    builder.adjust(1, 1, 1)
+    builder.adjust(1)
     await callback.message.edit_text("**Выберите фильтр**", reply_markup=builder.as_markup(), parse_mode='Markdown')
 
-@router.callback_query(F.data == "user_list_active")
-async def handle_user_list_active(callback: CallbackQuery):
-    await callback.answer()
-    users = await get_all_users(with_active_subscription=True)
-
-    if not users:
-        await callback.answer("Нет пользователей с активной подпиской")
-        return
-
-    text = "👤 <b>Пользователи с активной подпиской:</b>\n\n"
-
-    for user in users:
-        expire_date = user.subscription_end.strftime("%d.%m.%Y %H:%M")
-        username = f"@{user.username}" if user.username else "none"
-
-        if user.vless_profile_data:
-            profile_status = "✅ профиль есть"
+# Постраничный список пользователей: ключ страницы (subscription_end, id) хранится
+# в callback_data кнопок ◀️/▶️, поэтому каждая страница — один запрос по индексу
+USER_PAGE_SIZE = 25
+USER_LIST_TITLES = {
+    "active": "✅ Пользователи с активной подпиской",
+    "expiring": "⏳ Подписка истекает в ближайшие 24 часа",
+    "inactive": "🛑 Неактивные пользователи",
+    "no_profile": "⚠️ Пользователи без профиля",
+}
+_EPOCH = datetime(1970, 1, 1)
+
+def _encode_user_cursor(row) -> str:
+    """Ключ строки для callback_data (лимит Telegram — 64 байта)"""
+    if row.subscription_end is None:
+        return f"-:{row.id}"
+    micros = (row.subscription_end.replace(tzinfo=None) - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}:{row.id}"
+
+def _decode_user_cursor(end: str, user_id: str) -> tuple:
+    subscription_end = None if end == "-" else _EPOCH + timedelta(microseconds=int(end))
+    return subscription_end, int(user_id)
+
+def _user_list_line(row, now: datetime) -> str:
+    username = f"@{row.username}" if row.username else "none"
+    if row.subscription_end is None:
+        status = "❌"
+    else:
+        expire_date = row.subscription_end.strftime("%d.%m.%Y %H:%M")
+        if row.subscription_end <= now:
+            status = f"⏳ <code>{expire_date}</code>"
+        elif not row.has_profile:
+            status = f"⚠️ <code>{expire_date}</code>"
         else:
-            profile_status = "⚠️ профиль отсутствует"
-
-        user_line = (
-            f"• {user.full_name} "
-            f"({username} | <code>{user.telegram_id}</code>) — "
-            f"до <code>{expire_date}</code> | {profile_status}\n"
-        )
-
-        if len(text) + len(user_line) > MAX_MESSAGE_LENGTH:
-            await callback.message.answer(text, parse_mode="HTML")
-            text = "👤 <b>Пользователи с активной подпиской (продолжение):</b>\n\n"
-
-        text += user_line
-
-    await callback.message.answer(text, parse_mode="HTML")
-
-
-from datetime import datetime
+            status = f"✅ до <code>{expire_date}</code>"
+    return (
+        # Имя обрезаем, чтобы 25 строк гарантированно влезли в одно сообщение
+        f"• {html.escape((row.full_name or '')[:40])} | {html.escape(username)} | "
+        f"<code>{row.telegram_id}</code> — {status}\n"
+    )
 
-@router.callback_query(F.data == "user_list_inactive")
-async def handle_user_list_inactive(callback: CallbackQuery):
+@router.callback_query(F.data.startswith("ul:"))
+async def handle_user_list_page(callback: CallbackQuery):
+    """ul:<фильтр>:n — первая страница, ul:<фильтр>:n|p:<срок>:<id> — следующая/предыдущая"""
+    parts = callback.data.split(":")
+    filter_name, direction = parts[1], parts[2]
+    cursor = _decode_user_cursor(parts[3], parts[4]) if len(parts) == 5 else None
+    backward = direction == "p"
+
+    rows, has_more = await get_users_page(filter_name, cursor, backward=backward, limit=USER_PAGE_SIZE)
+    if not rows:
+        await callback.answer("Нет пользователей под этот фильтр")
+        return
     await callback.answer()
-    users = await get_all_users(with_active_subscription=False)
 
-    if not users:
-        await callback.answer("Нет пользователей без подписки")
-        return
+    has_prev = has_more if backward else cursor is not None
+    has_next = cursor is not None if backward else has_more
+    total = await count_users(filter_name)
 
     now = datetime.utcnow()
-    text = (
-    "👤 <b>Неактивные пользователи:</b>\n"
-    "⏳ — истекла | ⚠️ — без профиля | ❌ — нет подписки\n\n"
-)
-
-    for user in users:
-        username = f"@{user.username}" if user.username else "none"
-
-        if user.subscription_end:
-            expire_date = user.subscription_end.strftime("%d.%m.%Y %H:%M")
-
-            if user.subscription_end > now:
-                status = f"⚠️ <code>{expire_date}</code>"
-            else:
-                status = f"⏳ <code>{expire_date}</code>"
-        else:
-            status = "❌"
-
-        user_line = (
-            f"• {user.full_name} | {username} | "
-            f"<code>{user.telegram_id}</code> — {status}\n"
-        )
-
-        if len(text) + len(user_line) > MAX_MESSAGE_LENGTH:
-            await callback.message.answer(text, parse_mode="HTML")
-            text = "👤 <b>Неактивные пользователи (продолжение):</b>\n\n"
-
-        text += user_line
+    text = f"<b>{USER_LIST_TITLES[filter_name]}</b> (всего: {total})\n\n"
+    text += "".join(_user_list_line(row, now) for row in rows)
 
+    builder = InlineKeyboardBuilder()
+    nav = 0
+    if has_prev:
+        builder.button(text="◀️", callback_data=f"ul:{filter_name}:p:{_encode_user_cursor(rows[0])}")
+        nav += 1
+    if has_next:
+        builder.button(text="▶️", callback_data=f"ul:{filter_name}:n:{_encode_user_cursor(rows[-1])}")
+        nav += 1
+    builder.button(text="⬅️ Назад", callback_data="admin_user_list")
+    builder.adjust(*([nav] if nav else []), 1)
 
-    await callback.message.answer(text, parse_mode="HTML")
+    await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
 
 # Обработчики для рассылки сообщений
 @router.callback_query(F.data == "admin_send_message")
@@ -1353,24 +1385,32 @@ async def confirm_payment_by_admin(callback: CallbackQuery, bot: Bot):
     """Подтверждение оплаты администратором через кнопку"""
     try:
         # Ожидаемый формат:
-        # confirm_payment_{user_id}_{months}
+        # confirm_payment_{user_id}_{months}_{request_id} (старые кнопки — без request_id)
         data = callback.data.split("_")
 
-        if len(data) != 4:
+        if len(data) not in (4, 5):
             await callback.answer("❌ Некорректный запрос")
             return
 
-        _, _, user_id, months = data
+        _, _, user_id, months, *request_id = data
 
         user_id = int(user_id)
         months = int(months)
+        payment_id = f"manual:{user_id}:{request_id[0]}" if request_id else None
 
         # Обновляем подписку
-        new_end_date = await update_subscription(
+        extension = await update_subscription(
             user_id,
             months,
-            True
+            True,
+            payment_id=payment_id
         )
+        if extension and not extension.applied:
+            await callback.answer("✅ Уже подтверждено")
+            await callback.message.edit_reply_markup(reply_markup=None)
+            return
+        new_end_date = extension.subscription_end if extension else None
+        await sync_client_expiry(await get_user(user_id))
 
         if new_end_date:
             # Уведомляем пользователя
@@ -1424,22 +1464,33 @@ async def confirm_payment_command(message: Message, bot: Bot):
         return
     
     try:
-        # Парсим аргументы: /confirm_payment <user_id> <months>
+        # Парсим аргументы: /confirm_payment <user_id> <months> [id платежа]
         args = message.text.split()
         if len(args) < 3:
             await message.answer(
                 "Использование:\n"
-                "`/confirm_payment <user_id> <months>`\n\n"
+                "`/confirm_payment <user_id> <months> [id платежа]`\n\n"
                 "Пример:\n"
-                "`/confirm_payment 123456789 3`"
+                "`/confirm_payment 123456789 3`\n\n"
+                "С id платежа повторная команда не продлит подписку второй раз"
             )
             return
         
         user_id = int(args[1])
         months = int(args[2])
+        payment_id = f"manual:{user_id}:{args[3]}" if len(args) > 3 else None
         
         # Обновляем подписку
-        new_end_date = await update_subscription(user_id, months, is_admin_action=True)
+        extension = await update_subscription(user_id, months, is_admin_action=True, payment_id=payment_id)
+        if extension and not extension.applied:
+            await message.answer(
+                f"ℹ️ Платеж `{args[3]}` уже зачтен, подписка до "
+                f"`{extension.subscription_end.strftime('%d.%m.%Y %H:%M')}`",
+                parse_mode="Markdown"
+            )
+            return
+        new_end_date = extension.subscription_end if extension else None
+        await sync_client_expiry(await get_user(user_id))
         
         if new_end_date:
             # Отправляем уведомление пользователю
@@ -1526,18 +1577,18 @@ async def handle_delete_static_profile(callback: CallbackQuery):
     try:
         profile_id = int(callback.data.split("_")[-1])
         
-        with Session() as session:
-            profile = session.query(StaticProfile).filter_by(id=profile_id).first()
-            if not profile:
-                await callback.answer("⚠️ Профиль не найден")
-                return
-            
-            success = await delete_client_by_email(profile.name)
-            if not success:
-                logger.error(f"🛑 Ошибка удаления клиента из инбаунда: {profile.name}")
-            
-            session.delete(profile)
-            session.commit()
+        profile = await get_static_profile(profile_id)
+        if not profile:
+            await callback.answer("⚠️ Профиль не найден")
+            return
+        
+        success = await delete_client_by_email(
+            profile.name, client_id_from_vless_url(profile.vless_url)
+        )
+        if not success:
+            logger.error(f"🛑 Ошибка удаления клиента из инбаунда: {profile.name}")
+        
+        await delete_static_profile(profile_id)
         
         await callback.answer("✅ Профиль удален!")
         await callback.message.delete()
@@ -1572,11 +1623,8 @@ async def connect_profile(callback: CallbackQuery):
     # Текущее время в MSK
     now_msk = datetime.now(MSK)
     
-    # Приводим subscription_end к MSK если нужно
-    if user.subscription_end.tzinfo is None:
-        subscription_end_msk = MSK.localize(user.subscription_end)
-    else:
-        subscription_end_msk = user.subscription_end.astimezone(MSK)
+    # В БД срок хранится в UTC (см. as_utc), показываем по MSK
+    subscription_end_msk = as_utc(user.subscription_end).astimezone(MSK)
     
     # Проверяем истекла ли подписка
     if subscription_end_msk <= now_msk:
@@ -1585,11 +1633,11 @@ async def connect_profile(callback: CallbackQuery):
         # Если есть профиль в XUI - удаляем его
         if user.vless_profile_data:
             try:
-                profile_data = safe_json_loads(user.vless_profile_data, default={})
+                profile_data = profile_ref(user)
                 email = profile_data.get("email")
-                if email and email != "N/A":
-                    await delete_client_by_email(email)
+                if not email or email == "N/A" or await delete_profile_client(profile_data):
                     logger.info(f"🧹 Удален профиль истекшей подписки: {email}")
+                    await delete_user_profile(user.telegram_id)
             except Exception as e:
                 logger.error(f"Ошибка при удалении профиля: {e}")
         
@@ -1613,7 +1661,7 @@ async def connect_profile(callback: CallbackQuery):
     if not user.vless_profile_data:
         # Создаем новый профиль
         await callback.message.edit_text("⚙️ Создаем ваш VPN профиль...")
-        profile_data = await create_vless_profile(user.telegram_id)
+        profile_data = await create_vless_profile(user.telegram_id, user.subscription_end)
 
         if not profile_data:
             await callback.message.edit_text(
@@ -1622,14 +1670,10 @@ async def connect_profile(callback: CallbackQuery):
             return
 
         # Сохраняем профиль в БД
-        with Session() as session:
-            db_user = session.query(User).filter_by(
-                telegram_id=user.telegram_id
-            ).first()
-            if db_user:
-                db_user.vless_profile_data = json.dumps(profile_data)
-                session.commit()
-                logger.info(f"✅ Создан профиль для {user.telegram_id}: {profile_data['email']}")
+        if await update_user_profile(user.telegram_id, profile_data, reset_notifications=False):
+            logger.info(f"✅ Создан профиль для {user.telegram_id}: {profile_data['email']}")
+        # Подписочная ссылка должна сразу отдавать новый профиль
+        feed_cache.invalidate(user.telegram_id)
 
         # 🔔 Уведомление админов
         for admin_id in config.ADMINS:
@@ -1640,6 +1684,7 @@ async def connect_profile(callback: CallbackQuery):
                     f"👤 Telegram ID: `{user.telegram_id}`\n"
                     f"👤 Telegram User: `{user.full_name}`\n"
                     f"📧 Email: `{profile_data['email']}`\n"
+                    f"🖥 Узел: `{profile_data['node']}`\n"
                     f"🌐 Inbound: `{profile_data['remark']}`\n"
                     f"🔐 Security: `{profile_data['security']}`\n"
                     f"⏰ Подписка до: `{subscription_end_msk.strftime('%d.%m.%Y %H:%M')}`",
@@ -1671,6 +1716,7 @@ async def connect_profile(callback: CallbackQuery):
         "2. Скопируйте эту ссылку и импортируйте в приложение:\n"
         f"<pre>{vless_url}</pre>\n\n"
         "3. Активируйте соединение в приложении."
+        f"{subscription_hint(user.telegram_id)}"
     )
 
     builder = InlineKeyboardBuilder()
@@ -1693,23 +1739,12 @@ async def user_stats(callback: CallbackQuery):
     
     await callback.message.edit_text("⚙️ Загружаем вашу статистику...")
     
-    # Статистика использования трафика
-    profile_data = safe_json_loads(user.vless_profile_data, default={})
-    stats = await get_user_stats(profile_data["email"])
-
-    logger.debug(stats)
-    
-    # Обработка аплоада
-    upload = f"{stats.get('upload', 0) / 1024 / 1024:.2f}"
-    upload_size = 'MB' if int(float(upload)) < 1024 else 'GB'
-    if upload_size == "GB":
-        upload = f"{float(upload) / 1024:.2f}"
+    # Статистика трафика из локальных сэмплов, без запросов к панели
+    now_ts = int(time.time())
+    day_usage = await get_traffic_usage(now_ts - 24 * 60 * 60, user_id=user.id)
+    week_usage = await get_traffic_usage(now_ts - 7 * 24 * 60 * 60, user_id=user.id)
 
-    # Обработка даунлоада
-    download = f"{stats.get('download', 0) / 1024 / 1024:.2f}"
-    download_size = 'MB' if int(float(download)) < 1024 else 'GB'
-    if download_size == "GB":
-        download = f"{float(download) / 1024:.2f}"
+    logger.debug(week_usage)
     
     # Статус подписки
     from datetime import datetime, timezone
@@ -1737,8 +1772,15 @@ async def user_stats(callback: CallbackQuery):
     
     text = (
         "📊 **Ваша статистика:**\n\n"
-        f"🔼 Загружено: `{upload} {upload_size}`\n"
-        f"🔽 Скачано: `{download} {download_size}`\n\n"
+        "**За сутки:**\n"
+        f"🔼 Загружено: `{format_traffic(day_usage['upload'])}`\n"
+        f"🔽 Скачано: `{format_traffic(day_usage['download'])}`\n\n"
+        "**За 7 дней:**\n"
+        f"🔼 Загружено: `{format_traffic(week_usage['upload'])}`\n"
+        f"🔽 Скачано: `{format_traffic(week_usage['download'])}`\n\n"
+        "**Всего:**\n"
+        f"🔼 Загружено: `{format_traffic(user.total_upload)}`\n"
+        f"🔽 Скачано: `{format_traffic(user.total_download)}`\n\n"
         f"{status_text}"
     )
     
@@ -1746,25 +1788,47 @@ async def user_stats(callback: CallbackQuery):
 
 @router.callback_query(F.data == "admin_network_stats")
 async def network_stats(callback: CallbackQuery):
-    stats = await get_global_stats()
-
-    upload = f"{stats.get('upload', 0) / 1024 / 1024:.2f}"
-    upload_size = 'MB' if int(float(upload)) < 1024 else 'GB'
-    if upload_size == "GB":
-        upload = f"{int(float(upload) / 1024):.2f}"
-
-    download = f"{stats.get('download', 0) / 1024 / 1024:.2f}"
-    download_size = 'MB' if int(float(download)) < 1024 else 'GB'
-    if download_size == "GB":
-        download = f"{int(float(download) / 1024):.2f}"
+    # Всё из локальных данных сэмплера, без запросов к панели
+    now_ts = int(time.time())
+    day_usage = await get_traffic_usage(now_ts - 24 * 60 * 60)
+    week_usage = await get_traffic_usage(now_ts - 7 * 24 * 60 * 60)
+    totals = await get_traffic_totals()
     
     await callback.answer()
     text = (
         "📊 **Статистика использования сети:**\n\n"
-        f"🔼 Upload - `{upload} {upload_size}` | 🔽 Download - `{download} {download_size}`"
+        f"**За сутки:** 🔼 `{format_traffic(day_usage['upload'])}` | 🔽 `{format_traffic(day_usage['download'])}`\n"
+        f"**За 7 дней:** 🔼 `{format_traffic(week_usage['upload'])}` | 🔽 `{format_traffic(week_usage['download'])}`\n"
+        f"**Всего:** 🔼 `{format_traffic(totals['upload'])}` | 🔽 `{format_traffic(totals['download'])}`"
     )
     await callback.message.edit_text(text, parse_mode='Markdown')
 
+@router.callback_query(F.data.in_({"admin_reconcile", "admin_reconcile_apply"}))
+async def admin_reconcile(callback: CallbackQuery):
+    """Сверка БД с панелью: сначала пробный прогон, исправления — отдельной кнопкой"""
+    user = await get_user(callback.from_user.id)
+    if not user or not user.is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
+        return
+
+    apply = callback.data == "admin_reconcile_apply"
+    await callback.answer("⏳ Сверяю..." if not apply else "⏳ Исправляю...")
+    builder = InlineKeyboardBuilder()
+    try:
+        # При исправлении сверка выполняется заново: с момента отчета всё могло измениться
+        report = await reconcile(apply=apply)
+        if not apply and report.has_changes:
+            builder.button(text="✅ Исправить", callback_data="admin_reconcile_apply")
+        builder.button(text="⬅️ Назад", callback_data="admin_menu")
+        builder.adjust(1)
+        await callback.message.edit_text(report.summary(), reply_markup=builder.as_markup(), parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"❌ Reconcile report error: {e}", exc_info=True)
+        builder = InlineKeyboardBuilder()
+        builder.button(text="⬅️ Назад", callback_data="admin_menu")
+        # Без Markdown: текст ошибки может содержать символы разметки
+        await callback.message.edit_text(f"❌ Ошибка сверки: {e}", reply_markup=builder.as_markup())
+
 @router.callback_query(F.data == "back_to_menu")
 async def back_to_menu(callback: CallbackQuery, bot: Bot):
     await callback.answer()
@@ -1774,10 +1838,20 @@ def setup_handlers(dp: Dispatcher):
     dp.include_router(router)
     logger.info("✅ Handlers setup completed")
 
+def subscription_hint(telegram_id: int) -> str:
+    """Блок с подписочной ссылкой для сообщения с профилем (пусто, если сервер выключен)"""
+    url = subscription_url(telegram_id)
+    if not url:
+        return ""
+    return (
+        "\n\n🔄 <b>Или добавьте ссылку-подписку</b> — приложение само подтянет "
+        f"новые настройки при смене сервера:\n<pre>{url}</pre>"
+    )
+
 def safe_json_loads(data, default=None):
     if not data:
         return default
     try:
-        return json.loads(data)
+        return serialization.loads(data)
     except Exception:
         return default
\ No newline at end of file
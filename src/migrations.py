@@ -0,0 +1,255 @@
+# migrations.py
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+from sqlalchemy import Column, bindparam, inspect, select, text, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import visitors
+
+import serialization
+from config import config
+from database import PROFILE_COLUMNS, Base, SchemaMigration, User, engine, profile_columns
+
+logger = logging.getLogger(__name__)
+
+BATCH_RETRIES = 5
+
+
+class Migration(NamedTuple):
+    """Одноразовая миграция. Ровно одно из schema/batch.
+
+    schema(sync_conn) — изменение схемы, выполняется одной транзакцией.
+    batch(conn, after_id, limit) -> последний обработанный users.id или None, если строк
+    больше нет. Каждый пакет — своя транзакция вместе с сохранением курсора, поэтому
+    прерванная миграция продолжается с места остановки.
+    online=True — пакетная миграция идет в фоне уже после старта бота.
+    """
+    version: int
+    name: str
+    schema: Optional[Callable] = None
+    batch: Optional[Callable[..., Awaitable[Optional[int]]]] = None
+    online: bool = False
+
+
+def _create_missing_indexes(sync_conn):
+    """create_all не добавляет новые индексы к уже существующим таблицам — досоздаем.
+
+    Индексы по колонкам, которых в таблице еще нет, создаст миграция, добавляющая колонки.
+    """
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if _index_columns(index) <= existing:
+                index.create(sync_conn, checkfirst=True)
+
+
+def _index_columns(index) -> set:
+    """Колонки индекса вместе с колонками условия частичного индекса"""
+    names = {column.name for column in index.columns}
+    where = index.dialect_options["sqlite"]["where"]
+    if where is not None:
+        names.update(
+            element.name for element in visitors.iterate(where) if isinstance(element, Column)
+        )
+    return names
+
+
+def _add_profile_columns(sync_conn):
+    """Колонки полей профиля в существующей таблице users и индекс по email"""
+    existing = {column["name"] for column in inspect(sync_conn).get_columns("users")}
+    for name in PROFILE_COLUMNS:
+        if name not in existing:
+            column_type = User.__table__.c[name].type.compile(sync_conn.dialect)
+            sync_conn.execute(text(f"ALTER TABLE users ADD COLUMN {name} {column_type}"))
+    _create_missing_indexes(sync_conn)
+
+
+def _normalize_subscription_end(sync_conn):
+    """Сроки, записанные прежним func.datetime без дробной части, — в формат хранения DateTime.
+
+    Иначе текстовое сравнение с параметрами запросов (…SS.ffffff) теряет строки той же секунды
+    """
+    sync_conn.execute(text(
+        "UPDATE users SET subscription_end = subscription_end || '.000000' "
+        "WHERE length(subscription_end) = 19"
+    ))
+
+
+def _reset_traffic_baseline(sync_conn):
+    """Счетчики трафика, которые никто не записывал (0 по умолчанию), — в NULL.
+
+    Иначе первый сэмпл после запуска сэмплера запишет весь трафик клиента за всё время
+    как трафик за 15 минут. Кто уже получил сэмплы, базу сохраняет
+    """
+    sync_conn.execute(text(
+        "UPDATE users SET total_upload = NULL, total_download = NULL "
+        "WHERE id NOT IN (SELECT user_id FROM traffic_samples)"
+    ))
+
+
+async def _compact_profile_json(conn, after_id: int, limit: int):
+    """Старые профили записаны json.dumps(indent=2) — перекодировать компактно"""
+    rows = (await conn.execute(
+        select(User.id, User.vless_profile_data)
+        .where(User.id > after_id)
+        .order_by(User.id)
+        .limit(limit)
+    )).all()
+    if not rows:
+        return None
+
+    updates = []
+    for user_id, raw in rows:
+        if not raw:
+            continue
+        try:
+            compact = serialization.dumps(serialization.loads(raw))
+        except serialization.JSONDecodeError:
+            continue  # Нечитаемые профили показывает сверка, здесь их не трогаем
+        if compact != raw:
+            updates.append({"b_id": user_id, "b_old": raw, "b_data": compact})
+    if updates:
+        # SELECT пакета идет вне транзакции записи (BEGIN драйвер шлет только перед
+        # UPDATE), поэтому пишем только если профиль не сменился после чтения. Новый
+        # профиль хендлер уже записал компактно — такую строку просто пропускаем
+        await conn.execute(
+            update(User.__table__)
+            .where(User.__table__.c.id == bindparam("b_id"),
+                   User.__table__.c.vless_profile_data == bindparam("b_old"))
+            .values(vless_profile_data=bindparam("b_data")),
+            updates
+        )
+    return rows[-1].id
+
+
+async def _backfill_profile_columns(conn, after_id: int, limit: int):
+    """Заполнить колонки профиля из vless_profile_data"""
+    rows = (await conn.execute(
+        select(User.id, User.vless_profile_data)
+        .where(User.id > after_id)
+        .order_by(User.id)
+        .limit(limit)
+    )).all()
+    if not rows:
+        return None
+
+    updates = []
+    for user_id, raw in rows:
+        if not raw:
+            continue
+        try:
+            profile_data = serialization.loads(raw)
+        except serialization.JSONDecodeError:
+            continue
+        values = profile_columns(profile_data)
+        if any(value is not None for value in values.values()):
+            updates.append({
+                "b_id": user_id, "b_old": raw,
+                **{f"b_{name}": value for name, value in values.items()}
+            })
+    if updates:
+        # Как и в _compact_profile_json: колонки пишем, только если JSON не сменился после
+        # чтения. Новый профиль хендлер записал вместе с колонками — строку пропускаем
+        await conn.execute(
+            update(User.__table__)
+            .where(User.__table__.c.id == bindparam("b_id"),
+                   User.__table__.c.vless_profile_data == bindparam("b_old"))
+            .values({name: bindparam(f"b_{name}") for name in PROFILE_COLUMNS}),
+            updates
+        )
+    return rows[-1].id
+
+
+# Версии только добавляются в конец; примененную миграцию не меняют
+MIGRATIONS = [
+    Migration(1, "users_partial_indexes", schema=_create_missing_indexes),
+    Migration(2, "compact_profile_json", batch=_compact_profile_json, online=True),
+    Migration(3, "users_profile_columns", schema=_add_profile_columns),
+    Migration(4, "profile_columns_backfill", batch=_backfill_profile_columns, online=True),
+    Migration(5, "subscription_end_format", schema=_normalize_subscription_end),
+    Migration(6, "traffic_baseline", schema=_reset_traffic_baseline),
+]
+
+
+async def _load_state() -> dict:
+    async with engine.connect() as conn:
+        rows = (await conn.execute(select(SchemaMigration))).all()
+    return {row.version: row for row in rows}
+
+
+async def _save_state(conn, migration: Migration, cursor: int, applied_at=None, duration_ms=None):
+    values = {"name": migration.name, "cursor": cursor, "applied_at": applied_at, "duration_ms": duration_ms}
+    updated = await conn.execute(
+        update(SchemaMigration).where(SchemaMigration.version == migration.version).values(**values)
+    )
+    if updated.rowcount == 0:
+        await conn.execute(SchemaMigration.__table__.insert().values(version=migration.version, **values))
+
+
+async def _apply(migration: Migration, state, batch_size: int):
+    start = time.perf_counter()
+    cursor = (state.cursor or 0) if state else 0
+    if migration.schema is not None:
+        async with engine.begin() as conn:
+            await conn.run_sync(migration.schema)
+            await _save_state(conn, migration, cursor, datetime.utcnow(),
+                              round((time.perf_counter() - start) * 1000))
+    else:
+        if cursor:
+            logger.info(f"ℹ️ Resuming migration {migration.version} {migration.name} after id {cursor}")
+        retries = 0
+        while True:
+            try:
+                async with engine.begin() as conn:
+                    last_id = await migration.batch(conn, cursor, batch_size)
+                    if last_id is None:
+                        await _save_state(conn, migration, cursor, datetime.utcnow(),
+                                          round((time.perf_counter() - start) * 1000))
+                        break
+                    await _save_state(conn, migration, last_id)
+            except OperationalError as e:
+                # Пакет пересекся с записью хендлера (database is locked) — повторяем его же
+                retries += 1
+                if retries > BATCH_RETRIES:
+                    raise
+                logger.warning(f"⚠️ Migration {migration.name} batch after id {cursor} failed, retrying: {e}")
+                await asyncio.sleep(retries)
+                continue
+            retries = 0
+            cursor = last_id
+            await asyncio.sleep(0)  # отдаем цикл хендлерам между пакетами
+    logger.info(
+        f"✅ Migration {migration.version} {migration.name} applied "
+        f"in {(time.perf_counter() - start) * 1000:.0f} ms"
+    )
+
+
+async def run_migrations(online: bool = False, batch_size: int = None) -> int:
+    """Применить недостающие миграции: блокирующие (online=False) до старта или фоновые.
+
+    Возвращает число примененных миграций
+    """
+    batch_size = batch_size or config.MIGRATION_BATCH_SIZE
+    state = await _load_state()
+    applied = 0
+    for migration in MIGRATIONS:
+        if migration.online != online:
+            continue
+        current = state.get(migration.version)
+        if current is not None and current.applied_at is not None:
+            continue
+        await _apply(migration, current, batch_size)
+        applied += 1
+    return applied
+
+
+async def online_migrations_task():
+    """Фоновые пакетные миграции после старта бота"""
+    try:
+        await run_migrations(online=True)
+    except Exception as e:
+        logger.error(f"❌ Online migration failed, will resume on next start: {e}", exc_info=True)
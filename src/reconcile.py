@@ -0,0 +1,336 @@
+# reconcile.py
+"""Сверка БД с панелями 3x-UI.
+
+Обе стороны читаются целиком (снимок каждого инбаунда + все профили одним запросом),
+расхождения считаются за один проход по словарям email/UUID, исправления уходят
+пачками через очереди записей инбаундов.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+import serialization
+from config import config
+from database import (
+    get_users_with_profiles, get_static_profiles, update_user_profiles, get_known_client_emails,
+    get_expired_profiles, clear_expired_profiles, as_utc
+)
+from functions import get_xui_api, profile_location, client_id_from_vless_url, expiry_ms, client_with_expiry
+
+logger = logging.getLogger(__name__)
+
+# Клиенты бота в панели; остальных (созданных вручную, статических) не трогаем
+BOT_EMAIL_PREFIX = "user_"
+# Истекшие подписки сначала обрабатывает checker (уведомление + удаление),
+# сверка подчищает только то, что осталось после него
+EXPIRED_MARGIN = timedelta(hours=2)
+# Первый проход после старта — когда бот уже поднялся и прогрел кэши
+STARTUP_DELAY = 300
+
+
+class ReconcileReport:
+    """Результат сверки: найденные расхождения и (после apply) что исправлено"""
+
+    def __init__(self):
+        self.duration = 0.0
+        self.panel_clients = 0
+        self.bot_clients = 0
+        self.db_profiles = 0
+        self.unavailable = []       # "узел:инбаунд", которые не удалось прочитать
+        self.orphans = []           # (api, inbound_id, email, client_id): в панели есть, в БД нет
+        self.expired_live = []      # (user_id, profile, raw): подписка истекла, клиент еще в панели
+        self.expired_ghosts = []    # (user_id, raw): подписка истекла, клиента нет, профиль висит в БД
+        self.active_ghosts = []     # (user_id, profile, expiry_time): активная подписка, а клиента в панели нет
+        self.expiry_fixes = []      # (api, inbound_id, client): expiryTime в панели не совпадает с БД или клиент выключен
+        self.profile_fixes = {}     # user_id -> профиль с актуальными UUID/узлом/инбаундом
+        self.static_ghosts = []     # (name, client_id): статический профиль без клиента
+        self.broken_profiles = []   # user_id с нечитаемым vless_profile_data
+        self.applied = None
+        self.aborted = None
+
+    @property
+    def deletes(self) -> int:
+        return len(self.orphans) + len(self.expired_live)
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(
+            self.orphans or self.expired_live or self.expired_ghosts or self.active_ghosts
+            or self.expiry_fixes or self.profile_fixes or self.static_ghosts
+        )
+
+    def summary(self, examples: int = 5) -> str:
+        """Текст отчета для админа (Markdown)"""
+        mode = "исправления" if self.applied is not None or self.aborted else "пробный прогон"
+        lines = [
+            f"**Сверка с панелью** ({mode})\n",
+            f"Клиентов в панели: `{self.panel_clients}` (бота: `{self.bot_clients}`)",
+            f"Профилей в БД: `{self.db_profiles}`, время: `{self.duration:.2f}` с",
+        ]
+        if self.unavailable:
+            lines.append(f"🔴 Не прочитаны: `{', '.join(self.unavailable)}`")
+        lines += [
+            "",
+            f"👻 Лишние клиенты в панели: `{len(self.orphans)}`",
+            f"⌛ Истекшие с живым клиентом: `{len(self.expired_live)}`",
+            f"🧹 Истекшие профили без клиента: `{len(self.expired_ghosts)}`",
+            f"🔁 Активные профили без клиента: `{len(self.active_ghosts)}`",
+            f"⏰ Клиенты с неверным сроком в панели: `{len(self.expiry_fixes)}`",
+            f"✏️ Профили с устаревшим UUID/узлом: `{len(self.profile_fixes)}`",
+            f"📌 Статические профили без клиента: `{len(self.static_ghosts)}`",
+            f"⚠️ Нечитаемые профили: `{len(self.broken_profiles)}`",
+        ]
+        if self.orphans:
+            sample = ", ".join(f"`{email}`" for _, _, email, _ in self.orphans[:examples])
+            lines.append(f"\nНапример: {sample}")
+        if self.aborted:
+            lines.append(f"\n❌ Исправления отменены: {self.aborted}")
+        if self.applied is not None:
+            lines.append("")
+            lines += [f"✅ {name}: `{count}`" for name, count in self.applied.items()]
+        return "\n".join(lines)
+
+
+def _targets():
+    return [
+        (get_xui_api(node.name), inbound_id)
+        for node in config.nodes
+        for inbound_id in node.inbounds
+    ]
+
+
+def _location(profile: dict):
+    """(узел, инбаунд), где по данным профиля должен жить клиент"""
+    node = config.get_node(profile.get("node"))
+    return node.name, profile.get("inbound_id") or node.inbounds[0]
+
+
+def _telegram_id(email: str):
+    try:
+        return int(email.split("_")[1])
+    except (IndexError, ValueError):
+        return None
+
+
+async def _load_panel(report: ReconcileReport):
+    """Все клиенты всех инбаундов: индексы по email и по UUID"""
+    targets = _targets()
+    # Для сверки нужен свежий снимок: устаревший дал бы ложные расхождения
+    snapshots = await asyncio.gather(
+        *(api.get_inbound_snapshot(inbound_id, max_age=0, allow_stale=False) for api, inbound_id in targets)
+    )
+    by_email, by_id, unavailable = {}, {}, set()
+    for (api, inbound_id), snapshot in zip(targets, snapshots):
+        if snapshot is None:
+            unavailable.add((api.node.name, inbound_id))
+            report.unavailable.append(f"{api.node.name}:{inbound_id}")
+            continue
+        for client in snapshot.clients:
+            entry = (api, inbound_id, client)
+            by_email[client.get("email")] = entry
+            if client.get("id"):
+                by_id[client["id"]] = entry
+    report.panel_clients = len(by_email)
+    report.bot_clients = sum(1 for email in by_email if str(email).startswith(BOT_EMAIL_PREFIX))
+    return by_email, by_id, unavailable
+
+
+def _parse_profile(raw):
+    try:
+        profile = serialization.loads(raw)
+    except ValueError:
+        return None
+    return profile if isinstance(profile, dict) else None
+
+
+async def reconcile(apply: bool = False) -> ReconcileReport:
+    """Найти расхождения БД и панелей; с apply=True — сразу исправить"""
+    started = time.monotonic()
+    report = ReconcileReport()
+    by_email, by_id, unavailable = await _load_panel(report)
+    # БД читаем после панели: клиент, созданный между чтениями, в БД уже будет
+    users = await get_users_with_profiles()
+    statics = await get_static_profiles()
+    report.db_profiles = len(users)
+
+    now = datetime.now(timezone.utc)
+    matched = set()
+    for user_id, telegram_id, subscription_end, _, raw in users:
+        profile = _parse_profile(raw)
+        if profile is None:
+            report.broken_profiles.append(user_id)
+            continue
+
+        end = as_utc(subscription_end)
+        expired = end is None or end <= now
+        email, client_id = profile.get("email"), profile.get("client_id")
+        entry = by_email.get(email) or (by_id.get(client_id) if client_id else None)
+
+        if entry is None:
+            if _location(profile) in unavailable:
+                continue
+            if expired:
+                report.expired_ghosts.append((user_id, raw))
+            else:
+                report.active_ghosts.append((user_id, profile, expiry_ms(subscription_end)))
+            continue
+
+        api, inbound_id, client = entry
+        matched.add(client.get("email"))
+        actual = {
+            **profile,
+            "email": client.get("email"),
+            "client_id": client.get("id"),
+            "node": api.node.name,
+            "inbound_id": inbound_id,
+        }
+        if expired:
+            if end is None or end <= now - EXPIRED_MARGIN:
+                report.expired_live.append((user_id, actual, raw))
+            continue
+        # Срок в панели должен совпадать с подпиской: по нему Xray сам отключает клиента
+        fixed = client_with_expiry(client, expiry_ms(subscription_end))
+        if fixed is not None:
+            report.expiry_fixes.append((api, inbound_id, fixed))
+        if (email, client_id) != (actual["email"], actual["client_id"]) \
+                or _location(profile) != (api.node.name, inbound_id):
+            report.profile_fixes[user_id] = actual
+
+    for email, (api, inbound_id, client) in by_email.items():
+        if email in matched or not str(email).startswith(BOT_EMAIL_PREFIX):
+            continue
+        report.orphans.append((api, inbound_id, email, client.get("id")))
+
+    default_target = (config.default_node.name, config.default_node.inbounds[0])
+    if default_target not in unavailable:
+        for profile in statics:
+            client_id = client_id_from_vless_url(profile.vless_url)
+            if client_id and client_id not in by_id:
+                report.static_ghosts.append((profile.name, client_id))
+
+    report.duration = time.monotonic() - started
+    if apply:
+        await apply_fixes(report)
+        report.duration = time.monotonic() - started
+    logger.info(
+        f"ℹ️  Reconcile: {report.panel_clients} panel clients, {report.db_profiles} profiles, "
+        f"{len(report.orphans)} orphans, {len(report.expired_live)} expired live, "
+        f"{len(report.expired_ghosts) + len(report.active_ghosts)} ghosts, "
+        f"{len(report.profile_fixes)} stale profiles in {report.duration:.2f}s"
+    )
+    return report
+
+
+async def _delete_grouped(entries):
+    """Удаление клиентов пачками по инбаундам: entries — (api, inbound_id, email, client_id)"""
+    groups = {}
+    for api, inbound_id, email, client_id in entries:
+        groups.setdefault((api, inbound_id), []).append((email, client_id))
+    results = {}
+    for batch in await asyncio.gather(
+        *(api.delete_clients(clients, inbound_id) for (api, inbound_id), clients in groups.items())
+    ):
+        results.update(batch)
+    return results
+
+
+async def _restore_grouped(entries):
+    """Возврат клиентов пачками: entries — (api, inbound_id, client_id, email, expiry_time)"""
+    groups = {}
+    for api, inbound_id, *client in entries:
+        groups.setdefault((api, inbound_id), []).append(tuple(client))
+    results = {}
+    for batch in await asyncio.gather(
+        *(api.restore_clients(inbound_id, clients) for (api, inbound_id), clients in groups.items())
+    ):
+        results.update(batch)
+    return results
+
+
+async def apply_fixes(report: ReconcileReport):
+    """Исправить найденные расхождения"""
+    if report.deletes > max(10, report.bot_clients * config.RECONCILE_MAX_DELETE_SHARE):
+        logger.error(
+            f"❌ Reconcile aborted: {report.deletes} deletions of {report.bot_clients} bot clients "
+            f"exceed RECONCILE_MAX_DELETE_SHARE"
+        )
+        report.aborted = (
+            f"удалений `{report.deletes}` из `{report.bot_clients}` клиентов бота — "
+            f"больше порога `RECONCILE_MAX_DELETE_SHARE`"
+        )
+        return report
+
+    # Профиль мог появиться в БД уже после чтения панели — перепроверяем перед удалением
+    known = await get_known_client_emails(entry[2] for entry in report.orphans)
+    orphans = [entry for entry in report.orphans if entry[2] not in known]
+
+    # Отчет читался раньше: пользователь мог продлить подписку или получить новый профиль.
+    # Удаляем и чистим только тех, у кого профиль тот же, а подписка все еще истекла
+    now = datetime.utcnow()
+    still_expired = await get_expired_profiles(
+        [entry[0] for entry in report.expired_live] + [user_id for user_id, _ in report.expired_ghosts], now
+    )
+    expired_live = [entry for entry in report.expired_live if still_expired.get(entry[0]) == entry[2]]
+
+    deleted = await _delete_grouped(
+        orphans + [
+            (*profile_location(profile), profile["email"], profile["client_id"])
+            for _, profile, _ in expired_live
+        ]
+    )
+    # Профиль истекшего пользователя чистим только если панель подтвердила удаление
+    expected = {user_id: raw for user_id, profile, raw in expired_live if deleted.get(profile["email"])}
+    expected.update(report.expired_ghosts)
+    cleared = await clear_expired_profiles(expected, now)
+
+    node_names = {node.name for node in config.nodes}
+    restore = []
+    for _, profile, expiry_time in report.active_ghosts:
+        node_name, inbound_id = _location(profile)
+        if node_name in node_names and inbound_id in config.get_node(node_name).inbounds \
+                and profile.get("client_id") and profile.get("email"):
+            restore.append(
+                (get_xui_api(node_name), inbound_id, profile["client_id"], profile["email"], expiry_time)
+            )
+    default_api = get_xui_api()
+    restore += [
+        (default_api, default_api.default_inbound, client_id, name, 0)
+        for name, client_id in report.static_ghosts
+    ]
+    restored = await _restore_grouped(restore)
+
+    expiry_results = await asyncio.gather(
+        *(api.update_client(inbound_id, client) for api, inbound_id, client in report.expiry_fixes)
+    )
+
+    await update_user_profiles(report.profile_fixes)
+
+    report.applied = {
+        "Удалено из панели": sum(1 for ok in deleted.values() if ok),
+        "Очищено профилей": cleared,
+        "Возвращено в панель": sum(1 for ok in restored.values() if ok),
+        "Исправлено сроков": sum(1 for ok in expiry_results if ok),
+        "Обновлено профилей": len(report.profile_fixes),
+        "Ошибок": (
+            sum(1 for ok in deleted.values() if not ok)
+            + sum(1 for ok in restored.values() if not ok)
+            + sum(1 for ok in expiry_results if not ok)
+        ),
+    }
+    logger.info(f"✅ Reconcile applied: {report.applied}")
+    return report
+
+
+async def reconcile_task():
+    """Фоновая сверка БД с панелями раз в RECONCILE_INTERVAL"""
+    if config.RECONCILE_INTERVAL <= 0:
+        logger.info("ℹ️  Reconcile task disabled")
+        return
+    await asyncio.sleep(STARTUP_DELAY)
+    while True:
+        try:
+            await reconcile(apply=True)
+        except Exception as e:
+            logger.error(f"❌ Reconcile error: {e}")
+        await asyncio.sleep(config.RECONCILE_INTERVAL)
@@ -0,0 +1,44 @@
+# serialization.py
+"""Компактная JSON-сериализация для запросов к 3x-UI и vless_profile_data.
+
+Если установлен orjson — используем его, иначе стандартный json с компактными
+разделителями. Результат в обоих случаях одинаковый: str без лишних пробелов,
+не-ASCII символы как есть.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson — необязательная зависимость
+    orjson = None
+
+# orjson.JSONDecodeError наследуется от json.JSONDecodeError, так что ловить можно его
+JSONDecodeError = json.JSONDecodeError
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def _dumps_stdlib(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+if orjson is not None:
+    def dumps(obj) -> str:
+        """Компактная JSON-строка"""
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            # Нестроковые ключи, большие int и т.п. — отдаем стандартному json
+            return _dumps_stdlib(obj)
+
+    def loads(data):
+        """Разбор JSON из str/bytes"""
+        return orjson.loads(data)
+else:
+    def dumps(obj) -> str:
+        """Компактная JSON-строка"""
+        return _dumps_stdlib(obj)
+
+    def loads(data):
+        """Разбор JSON из str/bytes"""
+        return json.loads(data)
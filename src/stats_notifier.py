@@ -3,42 +3,33 @@ import asyncio
 import logging
 from datetime import datetime, timedelta
 from aiogram import Bot
-from database import get_all_users, Session, User
-from functions import get_user_stats
-import json
+from database import get_all_users, get_traffic_usage, get_traffic_usage_by_user
+from functions import format_traffic
+from traffic_sampler import sample_traffic
+from config import config
+import time
+
+WEEK = 7 * 24 * 60 * 60
 
 logger = logging.getLogger(__name__)
 
-async def send_weekly_stats_to_user(bot: Bot, user):
-    """Отправляет статистику трафика пользователю без уведомления"""
+async def send_weekly_stats_to_user(bot: Bot, user, usage: dict = None):
+    """Отправляет статистику трафика за неделю пользователю без уведомления.
+
+    usage — заранее посчитанный недельный трафик этого пользователя
+    из локальных сэмплов; без него считается отдельным запросом к БД.
+    """
     try:
         if not user.vless_profile_data:
             return False
         
-        # Парсим данные профиля
-        profile_data = json.loads(user.vless_profile_data)
-        email = profile_data.get("email")
-        
-        if not email:
-            return False
-        
-        # Получаем статистику
-        stats = await get_user_stats(email)
+        # Трафик за неделю из локальных сэмплов, без запросов к панели
+        if usage is None:
+            week_ago = int(time.time()) - WEEK
+            usage = await get_traffic_usage(week_ago, user_id=user.id)
         
-        # Форматируем статистику
-        upload_mb = stats.get('upload', 0) / (1024 * 1024)
-        download_mb = stats.get('download', 0) / (1024 * 1024)
-        
-        # Конвертируем в ГБ если нужно
-        if upload_mb > 1024:
-            upload_str = f"{upload_mb / 1024:.2f} GB"
-        else:
-            upload_str = f"{upload_mb:.2f} MB"
-        
-        if download_mb > 1024:
-            download_str = f"{download_mb / 1024:.2f} GB"
-        else:
-            download_str = f"{download_mb:.2f} MB"
+        upload = usage.get('upload', 0)
+        download = usage.get('download', 0)
         
         # Проверяем статус подписки
         now = datetime.utcnow()
@@ -54,10 +45,10 @@ async def send_weekly_stats_to_user(bot: Bot, user):
             f"👤 Пользователь: {user.full_name}\n"
             f"🆔 ID: `{user.telegram_id}`\n\n"
             f"{status_text}\n\n"
-            "📈 **Использование трафика:**\n"
-            f"🔼 Загружено: `{upload_str}`\n"
-            f"🔽 Скачано: `{download_str}`\n"
-            f"📊 Всего: `{upload_mb + download_mb:.2f} MB`\n\n"
+            "📈 **Трафик за неделю:**\n"
+            f"🔼 Загружено: `{format_traffic(upload)}`\n"
+            f"🔽 Скачано: `{format_traffic(download)}`\n"
+            f"📊 Всего: `{format_traffic(upload + download)}`\n\n"
             "Для управления подпиской используйте /menu"
         )
         
@@ -79,20 +70,25 @@ async def send_weekly_stats_to_all(bot: Bot):
     """Отправляет статистику всем пользователям с активной подпиской"""
     try:
         users = await get_all_users(with_active_subscription=True)
+
+        # Свежий сэмпл (один запрос к панели), дальше всё считаем по локальным данным
+        await sample_traffic()
+        usage_by_user = await get_traffic_usage_by_user(int(time.time()) - WEEK)
         
         success_count = 0
         failed_count = 0
         
         for user in users:
             try:
-                success = await send_weekly_stats_to_user(bot, user)
+                usage = usage_by_user.get(user.id, {"upload": 0, "download": 0})
+                success = await send_weekly_stats_to_user(bot, user, usage)
                 if success:
                     success_count += 1
                 else:
                     failed_count += 1
                 
                 # Задержка между отправками чтобы не заблокировали
-                await asyncio.sleep(0.5)
+                await asyncio.sleep(config.STATS_SEND_DELAY)
                 
             except Exception as e:
                 logger.error(f"❌ Error processing user {user.telegram_id}: {e}")
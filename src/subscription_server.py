@@ -0,0 +1,199 @@
+# subscription_server.py
+"""Встроенный HTTP-сервер подписочных ссылок.
+
+GET /sub/<token> отдает base64-список vless-ссылок пользователя. Токен — id
+пользователя, подписанный HMAC, так что подобрать чужой нельзя, а хранить
+токены в БД не нужно. Отрисованные фиды кэшируются в памяти и отдаются с ETag:
+клиентские приложения, которые опрашивают ссылку раз в несколько часов, в
+основном получают 304.
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import struct
+import time
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+from config import config
+from database import get_user, as_utc
+from functions import generate_vless_url, expiry_ms
+import serialization
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_SIZE = 16
+
+
+def _secret() -> bytes:
+    secret = config.SUBSCRIPTION_SECRET or hashlib.sha256(f"sub:{config.BOT_TOKEN}".encode()).hexdigest()
+    return secret.encode()
+
+
+def _sign(payload: bytes) -> bytes:
+    return hmac.new(_secret(), payload, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+
+def subscription_token(telegram_id: int) -> str:
+    """Непредсказуемый токен подписки пользователя"""
+    payload = struct.pack(">q", telegram_id)
+    return base64.urlsafe_b64encode(payload + _sign(payload)).decode().rstrip("=")
+
+
+def parse_token(token: str):
+    """telegram_id из токена или None, если подпись не сходится"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (ValueError, TypeError):
+        return None
+    payload, signature = raw[:8], raw[8:]
+    if len(payload) != 8 or not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    return struct.unpack(">q", payload)[0]
+
+
+def subscription_url(telegram_id: int):
+    """Публичная ссылка на подписку или None, если сервер выключен"""
+    if not config.SUBSCRIPTION_PORT:
+        return None
+    base_url = config.SUBSCRIPTION_BASE_URL or f"http://{config.XUI_HOST}:{config.SUBSCRIPTION_PORT}"
+    return f"{base_url.rstrip('/')}/sub/{subscription_token(telegram_id)}"
+
+
+class RenderedFeed:
+    """Готовый ответ для одного пользователя"""
+
+    def __init__(self, source, body: bytes, expire: int, headers: dict):
+        self.source = source
+        self.body = body
+        # Срок подписки приложение показывает из заголовка, поэтому он входит в ETag.
+        # Трафик — нет: иначе ETag менялся бы после каждого сэмпла и 304 почти не было бы
+        digest = hashlib.sha1(body)
+        digest.update(str(expire).encode())
+        self.etag = f'"{digest.hexdigest()}"'
+        self.expire = expire
+        self.headers = {**headers, "ETag": self.etag}
+        self.rendered_at = time.monotonic()
+
+    def refresh_usage(self, user):
+        """Обновить трафик в заголовке, не трогая тело и ETag"""
+        self.headers["Subscription-Userinfo"] = _userinfo(user, self.expire)
+
+
+class FeedCache:
+    """Кэш отрисованных фидов по telegram_id.
+
+    В пределах TTL ответ отдается без обращения к БД. После TTL пользователь
+    перечитывается одним запросом по индексу; если исходные данные не изменились,
+    используется тот же фид и тот же ETag.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._feeds = {}
+        self.hits = 0
+        self.renders = 0
+        self.not_modified = 0
+
+    async def get(self, telegram_id: int):
+        feed = self._feeds.get(telegram_id)
+        if feed is not None and time.monotonic() - feed.rendered_at <= self.ttl:
+            self.hits += 1
+            return feed
+
+        user = await get_user(telegram_id)
+        if user is None:
+            self._feeds.pop(telegram_id, None)
+            return None
+
+        source = (user.vless_profile_data, user.subscription_end)
+        if feed is not None and feed.source == source:
+            feed.refresh_usage(user)
+            feed.rendered_at = time.monotonic()
+            self.hits += 1
+            return feed
+
+        feed = render_feed(user, source)
+        self.renders += 1
+        self._feeds[telegram_id] = feed
+        return feed
+
+    def invalidate(self, telegram_id: int):
+        self._feeds.pop(telegram_id, None)
+
+
+def _subscription_active(user) -> bool:
+    if not user.subscription_end:
+        return False
+    return as_utc(user.subscription_end) > datetime.now(timezone.utc)
+
+
+def _userinfo(user, expire: int) -> str:
+    return (
+        f"upload={user.total_upload or 0}; download={user.total_download or 0}; "
+        f"total=0; expire={expire}"
+    )
+
+
+def render_feed(user, source) -> RenderedFeed:
+    """base64-список ссылок и служебные заголовки для клиентских приложений"""
+    urls = []
+    if user.vless_profile_data and _subscription_active(user):
+        try:
+            urls.append(generate_vless_url(serialization.loads(user.vless_profile_data)))
+        except (ValueError, KeyError) as e:
+            logger.warning(f"⚠️ Subscription feed for {user.telegram_id}: bad profile data ({e})")
+
+    body = base64.b64encode("\n".join(urls).encode()) if urls else b""
+    expire = expiry_ms(user.subscription_end) // 1000
+    headers = {
+        "Content-Type": "text/plain; charset=utf-8",
+        "Cache-Control": "no-cache",
+        "Profile-Update-Interval": str(config.SUBSCRIPTION_UPDATE_INTERVAL),
+        "Profile-Title": "base64:" + base64.b64encode(config.SUBSCRIPTION_TITLE.encode()).decode(),
+        "Subscription-Userinfo": _userinfo(user, expire),
+    }
+    return RenderedFeed(source, body, expire, headers)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+feed_cache = FeedCache(config.SUBSCRIPTION_CACHE_TTL)
+
+
+async def subscription_handler(request: web.Request):
+    telegram_id = parse_token(request.match_info["token"])
+    if telegram_id is None:
+        raise web.HTTPNotFound()
+
+    feed = await feed_cache.get(telegram_id)
+    if feed is None:
+        raise web.HTTPNotFound()
+
+    if _etag_matches(request.headers.get("If-None-Match"), feed.etag):
+        feed_cache.not_modified += 1
+        return web.Response(status=304, headers={"ETag": feed.etag, "Cache-Control": "no-cache"})
+    return web.Response(body=feed.body, headers=feed.headers)
+
+
+async def start_subscription_server():
+    """Запуск сервера подписок; возвращает runner для остановки или None, если выключен"""
+    if not config.SUBSCRIPTION_PORT:
+        logger.info("ℹ️  Subscription server disabled (SUBSCRIPTION_PORT=0)")
+        return None
+
+    app = web.Application()
+    app.router.add_get("/sub/{token}", subscription_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, config.SUBSCRIPTION_HOST, config.SUBSCRIPTION_PORT).start()
+    logger.info(f"✅ Subscription server listening on {config.SUBSCRIPTION_HOST}:{config.SUBSCRIPTION_PORT}")
+    return runner
@@ -0,0 +1,36 @@
+# conftest.py
+"""Общие настройки тестов. Запуск из src:  python -m pytest tests
+
+Тесты работают со своей временной базой: DB_PATH выставляется до импорта config/database.
+"""
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ["DB_PATH"] = os.path.join(_tmp.name, "tests.db")
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def run():
+    """Выполнить корутину в отдельном цикле событий"""
+    return asyncio.run
+
+
+@pytest.fixture
+def db(run):
+    """Пустая схема перед каждым тестом"""
+    async def reset():
+        async with database.engine.begin() as conn:
+            await conn.run_sync(database.Base.metadata.drop_all)
+            await conn.run_sync(database.Base.metadata.create_all)
+        # Соединения пула привязаны к циклу, в котором созданы
+        await database.engine.dispose()
+    run(reset())
+    database.user_cache.clear()
+    yield database
+    run(database.engine.dispose())
@@ -0,0 +1,57 @@
+# test_checker_deprovision.py
+"""Истекший пользователь, чьего клиента в панели уже нет, отключается с первого прохода"""
+from datetime import datetime, timedelta
+
+import app
+from benchmarks.xui_standin import XUIStandIn
+from config import XUINode
+from database import User
+from functions import XUIAPI
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+
+
+def test_already_deleted_client_is_deprovisioned(run, db, monkeypatch):
+    async def scenario():
+        standin = XUIStandIn(clients=1)
+        url = await standin.start()
+        api = XUIAPI(XUINode(name="test", url=url, host="127.0.0.1", inbounds=[1]))
+        present = (await api.get_inbound_snapshot(1, max_age=0)).clients[0]
+
+        async def delete_clients(profiles):
+            return await api.delete_clients([(p.get("email"), p.get("client_id")) for p in profiles], 1)
+        monkeypatch.setattr(app, "delete_clients", delete_clients)
+
+        ended = datetime.utcnow() - timedelta(minutes=1)
+        async with db.engine.begin() as conn:
+            await conn.execute(User.__table__.insert(), [
+                {"telegram_id": 1, "subscription_end": ended, "notified_24h": True, "notified_2h": True,
+                 "vless_profile_data": '{"email":"%s"}' % present["email"], "client_email": present["email"],
+                 "client_uuid": present["id"]},
+                # Клиента уже удалили из панели вручную
+                {"telegram_id": 2, "subscription_end": ended, "notified_24h": True, "notified_2h": True,
+                 "vless_profile_data": '{"email":"user_2_gone"}', "client_email": "user_2_gone",
+                 "client_uuid": "00000000-0000-0000-0000-000000000000"},
+            ])
+
+        bot = FakeBot()
+        checker = app.SubscriptionChecker(bot)
+        try:
+            await checker._seed()
+            await checker._process_due(checker.scheduler.pop_due())
+        finally:
+            await api.close()
+            await standin.stop()
+
+        assert sorted(bot.sent) == [1, 2]
+        assert len(checker.scheduler) == 0  # повторять нечего
+        for telegram_id in (1, 2):
+            assert (await db.get_user(telegram_id)).vless_profile_data is None
+
+    run(scenario())
@@ -0,0 +1,34 @@
+# test_circuit_breaker.py
+"""Пробный запрос half_open освобождается при любом исходе"""
+import asyncio
+import time
+
+import pytest
+
+from config import XUINode
+from functions import XUIAPI
+from xui_transport import CircuitBreaker
+
+
+@pytest.mark.parametrize("error, state", [
+    (UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte"), CircuitBreaker.OPEN),
+    (asyncio.CancelledError(), CircuitBreaker.HALF_OPEN),
+])
+def test_half_open_trial_is_released(run, monkeypatch, error, state):
+    async def scenario():
+        api = XUIAPI(XUINode(name="test", url="http://127.0.0.1:9", host="127.0.0.1", inbounds=[1]))
+        breaker = api.breaker
+        breaker._state = CircuitBreaker.OPEN
+        breaker.opened_at = time.monotonic() - breaker.reset_timeout - 1
+
+        async def send(*args, **kwargs):
+            raise error
+        monkeypatch.setattr(api, "_send", send)
+        try:
+            with pytest.raises(type(error)):
+                await api._request("GET", "api/inbounds/get/1")
+            return breaker.state, breaker._trial_in_flight
+        finally:
+            await api.close()
+
+    assert run(scenario()) == (state, False)
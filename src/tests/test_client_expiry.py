@@ -0,0 +1,41 @@
+# test_client_expiry.py
+"""Продление включает клиента, которого панель выключила по истечении срока"""
+import time
+
+from benchmarks.xui_standin import XUIStandIn
+from config import XUINode
+from functions import XUIAPI, client_with_expiry
+
+HOUR_MS = 3600 * 1000
+
+
+def test_future_expiry_enables_client():
+    client = {"id": "x", "email": "user_1_x", "expiryTime": 0, "enable": False}
+    future = int(time.time() * 1000) + HOUR_MS
+    assert client_with_expiry(client, future) == {**client, "expiryTime": future, "enable": True}
+
+
+def test_past_expiry_keeps_enable_flag():
+    client = {"id": "x", "email": "user_1_x", "expiryTime": 0, "enable": False}
+    past = int(time.time() * 1000) - HOUR_MS
+    assert client_with_expiry(client, past)["enable"] is False
+    assert client_with_expiry({**client, "expiryTime": past}, past) is None
+
+
+def test_renewal_reenables_disabled_client(run):
+    async def scenario():
+        standin = XUIStandIn(clients=1)
+        url = await standin.start()
+        api = XUIAPI(XUINode(name="test", url=url, host="127.0.0.1", inbounds=[1]))
+        try:
+            client = (await api.get_inbound_snapshot(1, max_age=0)).clients[0]
+            now_ms = int(time.time() * 1000)
+            # Так клиента оставляет панель после истечения expiryTime
+            await api.update_client(1, {**client, "expiryTime": now_ms - HOUR_MS, "enable": False})
+            assert await api.set_client_expiry(1, client["email"], now_ms + HOUR_MS)
+            return (await api.get_inbound_snapshot(1, max_age=0, allow_stale=False)).find(client["email"])
+        finally:
+            await api.close()
+            await standin.stop()
+
+    assert run(scenario())["enable"] is True
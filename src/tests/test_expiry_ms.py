@@ -0,0 +1,44 @@
+# test_expiry_ms.py
+"""expiryTime клиента, checker и фид читают срок подписки из БД одинаково (UTC)"""
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+import pytz
+
+import app
+import subscription_server
+from functions import expiry_ms
+
+
+def test_naive_is_utc():
+    end = datetime(2026, 1, 1, 12, 0)
+    assert expiry_ms(end) == int(end.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def test_aware_keeps_its_zone():
+    end = pytz.timezone("Europe/Moscow").localize(datetime(2026, 1, 1, 15, 0))
+    assert expiry_ms(end) == expiry_ms(datetime(2026, 1, 1, 12, 0))
+
+
+def test_extended_subscription_expires_on_time(run, db):
+    async def scenario():
+        await db.create_user(1, "Test")
+        extension = await db.extend_subscription(1, 3600)
+        return extension.subscription_end
+
+    end = run(scenario())
+    # Продление идет от конца трехдневного пробного периода
+    expected = (time.time() + timedelta(days=3, hours=1).total_seconds()) * 1000
+    assert abs(expiry_ms(end) - expected) < 5000
+
+
+def test_checker_and_feed_agree_with_panel_expiry():
+    end = datetime.utcnow() + timedelta(hours=1)
+    # Все уведомления уже отправлены — следующий дедлайн checker'а сам срок
+    assert app.next_check_at(end, True, True) * 1000 == pytest.approx(expiry_ms(end), abs=1)
+    assert subscription_server._subscription_active(SimpleNamespace(subscription_end=end))
+    assert not subscription_server._subscription_active(
+        SimpleNamespace(subscription_end=end - timedelta(hours=2))
+    )
@@ -0,0 +1,60 @@
+# test_migrations.py
+"""Онлайн-миграции не затирают профиль, записанный хендлером посреди пакета"""
+import json
+
+import migrations
+from database import User
+
+
+class InterleavedConn:
+    """Соединение пакета, после первого запроса которого выполняется чужая запись"""
+
+    def __init__(self, conn, write):
+        self._conn = conn
+        self._write = write
+
+    async def execute(self, *args, **kwargs):
+        result = await self._conn.execute(*args, **kwargs)
+        if self._write:
+            write, self._write = self._write, None
+            await write()
+        return result
+
+
+async def _insert_profile(db, profile_data):
+    await db.create_user(1, "Test")
+    async with db.engine.begin() as conn:
+        await conn.execute(
+            User.__table__.update().where(User.__table__.c.telegram_id == 1)
+            .values(vless_profile_data=json.dumps(profile_data, indent=2))
+        )
+
+
+async def _run_batch(db, batch, write):
+    async with db.engine.begin() as conn:
+        await batch(InterleavedConn(conn, write), 0, 100)
+    db.user_cache.clear()
+    return await db.get_user(1)
+
+
+def test_compact_keeps_concurrent_profile_write(run, db):
+    async def scenario():
+        await _insert_profile(db, {"email": "user_1_old", "client_id": "old"})
+        new_profile = {"email": "user_1_new", "client_id": "new"}
+        user = await _run_batch(db, migrations._compact_profile_json,
+                                lambda: db.update_user_profile(1, new_profile))
+        assert json.loads(user.vless_profile_data) == new_profile
+
+    run(scenario())
+
+
+def test_backfill_keeps_concurrent_profile_write(run, db):
+    async def scenario():
+        await _insert_profile(db, {"email": "user_1_old", "client_id": "old"})
+        new_profile = {"email": "user_1_new", "client_id": "new"}
+        user = await _run_batch(db, migrations._backfill_profile_columns,
+                                lambda: db.update_user_profile(1, new_profile))
+        assert json.loads(user.vless_profile_data) == new_profile
+        assert (user.client_email, user.client_uuid) == ("user_1_new", "new")
+
+    run(scenario())
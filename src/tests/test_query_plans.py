@@ -0,0 +1,10 @@
+# test_query_plans.py
+"""Фоновые запросы к users идут по индексам (тот же разбор, что benchmarks/check_query_plans)"""
+from benchmarks import check_query_plans
+
+
+def test_background_queries_do_not_scan_users(run, db):
+    plans = run(check_query_plans.collect_plans(users=3000))
+    assert plans
+    scans = [(name, detail) for name, detail, full_scan in plans if full_scan]
+    assert scans == []
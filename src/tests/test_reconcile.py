@@ -0,0 +1,76 @@
+# test_reconcile.py
+"""Сверка: отчет для админа и исправления по данным, изменившимся после чтения"""
+import re
+from datetime import datetime, timedelta
+
+import reconcile
+from database import User
+
+
+def test_aborted_summary_is_valid_markdown(run):
+    report = reconcile.ReconcileReport()
+    report.orphans = [(None, 1, f"user_{i}_x", None) for i in range(11)]
+    run(reconcile.apply_fixes(report))
+    assert report.aborted
+    # Вне `кода` в Markdown Telegram непарный _ ломает разбор сообщения
+    text = re.sub(r"`[^`]*`", "", report.summary())
+    assert "_" not in text and "`" not in text
+
+
+async def _expired_user(db, telegram_id: int, raw: str):
+    await db.create_user(telegram_id, "Test")
+    async with db.engine.begin() as conn:
+        await conn.execute(
+            User.__table__.update().where(User.__table__.c.telegram_id == telegram_id).values(
+                subscription_end=datetime.utcnow() - timedelta(days=1), vless_profile_data=raw
+            )
+        )
+    return (await db.get_user(telegram_id)).id
+
+
+def test_expired_ghost_renewed_after_report_is_kept(run, db):
+    async def scenario():
+        raw = '{"email":"user_1_old"}'
+        renewed = await _expired_user(db, 1, raw)
+        reprofiled = await _expired_user(db, 2, '{"email":"user_2_old"}')
+        untouched = await _expired_user(db, 3, '{"email":"user_3_old"}')
+
+        report = reconcile.ReconcileReport()
+        report.expired_ghosts = [(renewed, raw), (reprofiled, '{"email":"user_2_old"}'),
+                                 (untouched, '{"email":"user_3_old"}')]
+        # Между чтением и исправлением: продление и новый профиль
+        await db.extend_subscription(1, 3600)
+        await db.update_user_profile(2, {"email": "user_2_new"})
+
+        await reconcile.apply_fixes(report)
+        db.user_cache.clear()
+        profiles = [(await db.get_user(i)).vless_profile_data for i in (1, 2, 3)]
+        return report.applied["Очищено профилей"], profiles
+
+    cleared, profiles = run(scenario())
+    assert cleared == 1
+    assert profiles[0] == '{"email":"user_1_old"}'
+    assert '"user_2_new"' in profiles[1]
+    assert profiles[2] is None
+
+
+def test_expired_live_renewed_after_report_is_not_deleted(run, db, monkeypatch):
+    deleted = []
+
+    async def delete_grouped(entries):
+        deleted.extend(entries)
+        return {entry[2]: True for entry in entries}
+    monkeypatch.setattr(reconcile, "_delete_grouped", delete_grouped)
+
+    async def scenario():
+        raw = '{"email":"user_1_old"}'
+        user_id = await _expired_user(db, 1, raw)
+        report = reconcile.ReconcileReport()
+        report.expired_live = [(user_id, {"email": "user_1_old", "client_id": "old"}, raw)]
+        await db.extend_subscription(1, 3600)
+        await reconcile.apply_fixes(report)
+        db.user_cache.clear()
+        return (await db.get_user(1)).vless_profile_data
+
+    assert run(scenario()) == '{"email":"user_1_old"}'
+    assert deleted == []
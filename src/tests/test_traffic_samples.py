@@ -0,0 +1,34 @@
+# test_traffic_samples.py
+"""Первое наблюдение счетчиков панели — база, а не трафик за интервал"""
+import migrations
+
+GB = 1024 ** 3
+
+
+async def _user_with_profile(db, telegram_id: int, email: str):
+    await db.create_user(telegram_id, "Test")
+    await db.update_user_profile(telegram_id, {"email": email})
+    return (await db.get_user(telegram_id)).id
+
+
+def test_first_sample_only_stores_baseline(run, db):
+    async def scenario():
+        user_id = await _user_with_profile(db, 1, "user_1_x")
+        seen_before = await _user_with_profile(db, 2, "user_2_x")
+        await db.record_traffic_samples(900, {"user_2_x": {"upload": 0, "download": 0}})
+        await db.record_traffic_samples(1000, {"user_2_x": {"upload": 5, "download": 5}})
+        # Перед развертыванием: у всех 0, сэмплы есть только у уже учтенного пользователя
+        async with db.engine.begin() as conn:
+            await conn.run_sync(migrations._reset_traffic_baseline)
+
+        await db.record_traffic_samples(2000, {"user_1_x": {"upload": 10 * GB, "download": 20 * GB},
+                                               "user_2_x": {"upload": 7, "download": 5}})
+        first = await db.get_traffic_usage(0, user_id)
+        await db.record_traffic_samples(3000, {"user_1_x": {"upload": 10 * GB + 100, "download": 20 * GB}})
+        second = await db.get_traffic_usage(0, user_id)
+        return first, second, await db.get_traffic_usage(0, seen_before)
+
+    first, second, seen_before = run(scenario())
+    assert first == {"upload": 0, "download": 0}
+    assert second == {"upload": 100, "download": 0}
+    assert seen_before == {"upload": 7, "download": 5}
@@ -0,0 +1,61 @@
+# test_users_page.py
+"""Постраничный список не теряет пользователей с одинаковым сроком окончания"""
+from datetime import datetime, timedelta
+
+import migrations
+from database import User
+
+USERS = 60
+PAGE = 25
+
+
+async def _insert_users(db):
+    async with db.engine.begin() as conn:
+        await conn.execute(User.__table__.insert(), [
+            {"telegram_id": i, "full_name": f"user {i}", "vless_profile_data": "{}"}
+            for i in range(1, USERS + 1)
+        ])
+
+
+async def _collect(db, backward: bool):
+    seen, cursor = [], None
+    for _ in range(USERS // PAGE + 2):  # сломанный курсор зацикливается на одной странице
+        rows, has_more = await db.get_users_page("active", cursor, backward=backward, limit=PAGE)
+        seen.extend(row.telegram_id for row in rows)
+        if not has_more:
+            break
+        edge = rows[0] if backward else rows[-1]
+        cursor = (edge.subscription_end, edge.id)
+    return seen
+
+
+def _assert_full(run, db):
+    forward = run(_collect(db, backward=False))
+    backward = run(_collect(db, backward=True))
+    assert sorted(forward) == list(range(1, USERS + 1))
+    assert sorted(backward) == list(range(1, USERS + 1))
+
+
+def test_same_end_written_by_sql(run, db):
+    async def prepare():
+        await _insert_users(db)
+        # Один срок на всех, вычисленный в SQL, как при продлении подписки
+        end = datetime.utcnow().replace(microsecond=0)
+        async with db.engine.begin() as conn:
+            await conn.execute(User.__table__.update().values(
+                subscription_end=db._sql_datetime(end, "+1 days")
+            ))
+    run(prepare())
+    _assert_full(run, db)
+
+
+def test_legacy_whole_second_end(run, db):
+    async def prepare():
+        await _insert_users(db)
+        end = (datetime.utcnow() + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+        async with db.engine.begin() as conn:
+            # Так срок записывал прежний func.datetime
+            await conn.exec_driver_sql("UPDATE users SET subscription_end = ?", (end,))
+            await conn.run_sync(migrations._normalize_subscription_end)
+    run(prepare())
+    _assert_full(run, db)
@@ -0,0 +1,56 @@
+# test_xui_delete.py
+"""Удаление клиента, которого в панели уже нет, считается успешным"""
+import pytest
+
+from benchmarks.xui_standin import XUIStandIn
+from config import XUINode, config
+from functions import XUIAPI
+
+
+async def _delete(per_client_api: bool, clients: list, present: int):
+    standin = XUIStandIn(clients=present, per_client_api=per_client_api)
+    url = await standin.start()
+    api = XUIAPI(XUINode(name="test", url=url, host="127.0.0.1", inbounds=[1]))
+    try:
+        snapshot = await api.get_inbound_snapshot(1, max_age=0)
+        existing = [(c["email"], c["id"]) for c in snapshot.clients]
+        results = await api.delete_clients(existing + clients, 1)
+        left = await api.get_inbound_snapshot(1, max_age=0, allow_stale=False)
+        return results, len(left.clients)
+    finally:
+        await api.close()
+        await standin.stop()
+
+
+ABSENT = [("user_1_gone", None), ("user_2_gone", "00000000-0000-0000-0000-000000000000")]
+
+
+@pytest.mark.parametrize("per_client_api", [True, False])
+def test_absent_clients_are_removed(run, per_client_api):
+    results, left = run(_delete(per_client_api, ABSENT, present=2))
+    assert len(results) == 4 and all(results.values())
+    assert left == 0
+
+
+def test_absent_clients_above_rewrite_threshold(run, monkeypatch):
+    # Крупная пачка идет одной перезаписью инбаунда даже при наличии delClient
+    monkeypatch.setattr(config, "XUI_REWRITE_THRESHOLD", 1)
+    results, left = run(_delete(True, ABSENT, present=3))
+    assert all(results.values()) and len(results) == 5
+    assert left == 0
+
+
+@pytest.mark.parametrize("per_client_api", [True, False])
+def test_delete_single_absent_client(run, per_client_api):
+    # Так удаляет хендлер /connect: по одному клиенту через очередь записей
+    async def scenario():
+        standin = XUIStandIn(clients=1, per_client_api=per_client_api)
+        url = await standin.start()
+        api = XUIAPI(XUINode(name="test", url=url, host="127.0.0.1", inbounds=[1]))
+        try:
+            return await api.delete_client(*ABSENT[1], 1)
+        finally:
+            await api.close()
+            await standin.stop()
+
+    assert run(scenario()) is True
@@ -0,0 +1,74 @@
+# test_xui_queue.py
+"""Очередь записей инбаунда: порядок операций и результаты при сбое записи"""
+import asyncio
+
+import pytest
+
+from config import XUINode
+from functions import XUIAPI
+from xui_queue import InboundMutationQueue
+
+
+class FakeAPI:
+    """Запоминает вызовы apply_mutations; fail_after — сколько операций успеть до исключения"""
+
+    def __init__(self, fail_after: int = None):
+        self.calls = []
+        self.fail_after = fail_after
+
+    async def apply_mutations(self, inbound_id, add=(), remove=(), update=(), results=None):
+        self.calls.append(([c["email"] for c in add], [email for email, _ in remove]))
+        ops = [("add", c["email"]) for c in add] + [("remove", email) for email, _ in remove]
+        for i, key in enumerate(ops):
+            if i == self.fail_after:
+                raise RuntimeError("panel went away")
+            results[key] = True
+        return results
+
+
+async def _submit(api, *ops):
+    queue = InboundMutationQueue(api, 1, window=0.01)
+    futures = [
+        asyncio.ensure_future(queue.add({"email": email}) if op == "add" else queue.remove(email))
+        for op, email in ops
+    ]
+    return await asyncio.gather(*futures)
+
+
+def test_add_then_remove_is_cancelled(run):
+    api = FakeAPI()
+    assert run(_submit(api, ("add", "a"), ("remove", "a"))) == [True, True]
+    assert api.calls == []
+
+
+def test_remove_then_add_is_applied_in_order(run):
+    api = FakeAPI()
+    assert run(_submit(api, ("remove", "a"), ("add", "a"), ("add", "b"))) == [True, True, True]
+    assert api.calls == [([], ["a"]), (["a", "b"], [])]
+
+
+def test_failed_write_keeps_applied_results(run):
+    api = FakeAPI(fail_after=1)
+    assert run(_submit(api, ("add", "a"), ("add", "b"))) == [True, False]
+
+
+@pytest.mark.parametrize("per_client_api", [True, False])
+def test_apply_mutations_invalidates_cache_on_error(run, monkeypatch, per_client_api):
+    async def broken(*args, **kwargs):
+        raise RuntimeError("panel went away")
+
+    async def scenario():
+        api = XUIAPI(XUINode(name="test", url="http://127.0.0.1:9", host="127.0.0.1", inbounds=[1]))
+        api.per_client_api = per_client_api
+        invalidated = []
+        monkeypatch.setattr(api.inbound_cache, "invalidate", invalidated.append)
+        monkeypatch.setattr(api, "_apply_per_client", broken)
+        monkeypatch.setattr(api, "_rewrite_clients", broken)
+        try:
+            with pytest.raises(RuntimeError):
+                await api.apply_mutations(1, remove=[("a", None)])
+        finally:
+            await api.close()
+        return invalidated
+
+    assert run(scenario()) == [1]
@@ -0,0 +1,49 @@
+# traffic_sampler.py
+import asyncio
+import logging
+import time
+from config import config
+from database import record_traffic_samples, downsample_traffic_samples, purge_traffic_samples
+from functions import get_all_client_traffics
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+
+async def sample_traffic():
+    """Снять счетчики всех клиентов одним запросом и сохранить дельты"""
+    traffics = await get_all_client_traffics(max_age=0)
+    if traffics is None:
+        logger.warning("⚠️ Traffic sample skipped: panel unavailable")
+        return 0
+
+    interval = config.TRAFFIC_SAMPLE_INTERVAL
+    ts = int(time.time()) // interval * interval
+    saved = await record_traffic_samples(ts, traffics)
+    logger.debug(f"⚙️ Traffic sample {ts}: {saved} users with traffic")
+    return saved
+
+
+async def compact_traffic_samples():
+    """Склейка старых сэмплов в суточные и удаление данных старше срока хранения"""
+    now = int(time.time())
+    merged = await downsample_traffic_samples(now - config.TRAFFIC_RAW_RETENTION_DAYS * DAY, DAY)
+    purged = await purge_traffic_samples(now - config.TRAFFIC_RETENTION_DAYS * DAY)
+    if merged or purged:
+        logger.info(f"🧹 Traffic samples compacted: {merged} daily buckets, {purged} purged")
+
+
+async def traffic_sampler_task():
+    """Фоновая задача: сэмпл трафика раз в интервал, компактизация раз в сутки"""
+    last_compaction = 0
+    while True:
+        try:
+            await sample_traffic()
+            if time.time() - last_compaction >= DAY:
+                await compact_traffic_samples()
+                last_compaction = time.time()
+        except Exception as e:
+            logger.error(f"❌ Traffic sampler error: {e}")
+
+        await asyncio.sleep(config.TRAFFIC_SAMPLE_INTERVAL)
@@ -0,0 +1,72 @@
+# user_cache.py
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """LRU-кэш снимков пользователей с TTL для горячих хендлеров (/start, меню, подключение).
+
+    Хранит отсоединенные от сессии объекты User по telegram_id. Все записи в
+    database.py сбрасывают затронутые ключи через invalidate()/clear(). Чтение,
+    начатое до записи, не кладет в кэш старый снимок: put() сверяет поколение,
+    взятое через generation до запроса к БД.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # telegram_id -> (снимок, время загрузки)
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl > 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, telegram_id: int):
+        entry = self._entries.get(telegram_id)
+        if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+            self._entries.move_to_end(telegram_id)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            del self._entries[telegram_id]
+        self.misses += 1
+        return None
+
+    def put(self, telegram_id: int, user, generation: int):
+        """Положить снимок, если с момента generation ничего не сбрасывалось"""
+        if not self.enabled or user is None or generation != self._generation:
+            return
+        self._entries[telegram_id] = (user, time.monotonic())
+        self._entries.move_to_end(telegram_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *telegram_ids: int):
+        self._generation += 1
+        self.invalidations += 1
+        for telegram_id in telegram_ids:
+            self._entries.pop(telegram_id, None)
+
+    def clear(self):
+        """Сброс всего кэша — для массовых UPDATE/DELETE"""
+        self._generation += 1
+        self.invalidations += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "invalidations": self.invalidations,
+        }
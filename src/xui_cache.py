@@ -0,0 +1,113 @@
+# xui_cache.py
+import asyncio
+import serialization
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class InboundSnapshot:
+    """Разобранный снимок инбаунда: settings парсится один раз на всех читателей"""
+
+    def __init__(self, inbound: dict):
+        self.inbound = inbound
+        self.fetched_at = time.monotonic()
+        self.settings = serialization.loads(inbound.get("settings") or "{}")
+        self.clients = self.settings.get("clients", [])
+        self.clients_by_email = {c.get("email"): c for c in self.clients}
+        self._traffic = None
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    def find(self, email: str):
+        return self.clients_by_email.get(email)
+
+    @property
+    def traffic_by_email(self) -> dict:
+        """Трафик всех клиентов из clientStats: {email: {"upload", "download"}}"""
+        if self._traffic is None:
+            self._traffic = {
+                stat.get("email"): {
+                    "upload": stat.get("up", 0),
+                    "download": stat.get("down", 0)
+                }
+                for stat in self.inbound.get("clientStats") or []
+            }
+        return self._traffic
+
+
+class InboundCache:
+    """TTL-кэш снимков инбаундов с single-flight загрузкой.
+
+    Параллельные читатели одного инбаунда ждут один и тот же запрос к панели.
+    Наши собственные записи сбрасывают снимок через invalidate().
+    Последний удачный снимок хранится отдельно и отдается читателям,
+    если панель недоступна (allow_stale).
+    """
+
+    def __init__(self, fetch, ttl: float):
+        self._fetch = fetch  # async (inbound_id) -> dict | None
+        self.ttl = ttl
+        self._snapshots = {}
+        self._inflight = {}
+        self._generation = {}
+        self._last_good = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale_served = 0
+
+    async def get(self, inbound_id: int, max_age: float = None, allow_stale: bool = True):
+        """Снимок не старше max_age секунд (по умолчанию — TTL кэша).
+
+        При недоступной панели и allow_stale=True возвращается последний удачный снимок.
+        Для перезаписи инбаунда устаревший снимок недопустим — там allow_stale=False.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        snapshot = self._snapshots.get(inbound_id)
+        if snapshot is not None and snapshot.age <= max_age:
+            self.hits += 1
+            return snapshot
+
+        self.misses += 1
+        task = self._inflight.get(inbound_id)
+        if task is None:
+            task = asyncio.create_task(self._load(inbound_id))
+            self._inflight[inbound_id] = task
+        snapshot = await asyncio.shield(task)
+        if snapshot is None and allow_stale:
+            snapshot = self._last_good.get(inbound_id)
+            if snapshot is not None:
+                self.stale_served += 1
+                logger.warning(
+                    f"⚠️ Inbound {inbound_id} unavailable, serving snapshot {int(snapshot.age)}s old"
+                )
+        return snapshot
+
+    async def _load(self, inbound_id: int):
+        generation = self._generation.get(inbound_id, 0)
+        try:
+            inbound = await self._fetch(inbound_id)
+            if not inbound:
+                return None
+            snapshot = InboundSnapshot(inbound)
+            # Если за время запроса мы сами записали инбаунд, снимок уже устарел
+            if self._generation.get(inbound_id, 0) == generation:
+                self._snapshots[inbound_id] = snapshot
+            self._last_good[inbound_id] = snapshot
+            return snapshot
+        except Exception as e:
+            logger.exception(f"🛑 Inbound {inbound_id} snapshot load error: {e}")
+            return None
+        finally:
+            if self._inflight.get(inbound_id) is asyncio.current_task():
+                self._inflight.pop(inbound_id, None)
+
+    def invalidate(self, inbound_id: int):
+        """Сброс снимка после нашей записи в инбаунд"""
+        self._generation[inbound_id] = self._generation.get(inbound_id, 0) + 1
+        self._snapshots.pop(inbound_id, None)
+        # Новые читатели не должны присоединяться к запросу, начатому до записи
+        self._inflight.pop(inbound_id, None)
@@ -0,0 +1,132 @@
+# xui_queue.py
+import asyncio
+import logging
+from xui_transport import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+
+class _Write:
+    """Одна запись в панель: операции пачки, порядок которых внутри записи не важен"""
+
+    def __init__(self):
+        self.adds, self.updates, self.removes = {}, {}, {}
+        self.entries = []         # (ключ, future, готовый результат или None — ждать ответа панели)
+        self._add_entries = {}    # email -> индексы еще не отмененных добавлений в entries
+
+    def push(self, op: str, key: tuple, payload, future):
+        result = None
+        if op == "add":
+            self.adds[payload["email"]] = payload
+            self._add_entries.setdefault(payload["email"], []).append(len(self.entries))
+        elif op == "update":
+            self.updates[payload["id"]] = payload
+        elif key[1] in self.adds:
+            # Клиент создан и удален в одном окне — в панель не ходим вовсе
+            del self.adds[key[1]]
+            for i in self._add_entries.pop(key[1]):
+                self.entries[i] = (*self.entries[i][:2], True)
+            result = True
+        else:
+            self.removes[key[1]] = self.removes.get(key[1]) or payload
+        self.entries.append((key, future, result))
+
+
+class InboundMutationQueue:
+    """Очередь изменений одного инбаунда.
+
+    Записи в панель идут строго по одной (без гонок read-modify-write),
+    а добавления/удаления, пришедшие в течение короткого окна, склеиваются
+    в одну пачку и применяются одним вызовом XUIAPI.apply_mutations
+    (повторное добавление после удаления того же клиента — следующим).
+    """
+
+    def __init__(self, api, inbound_id: int, window: float):
+        self.api = api
+        self.inbound_id = inbound_id
+        self.window = window
+        self._pending = []
+        self._write_lock = asyncio.Lock()
+        self._flush_task = None
+        # Счетчики для логов: сколько операций уложилось в сколько записей
+        self.batches = 0
+        self.operations = 0
+
+    def _submit(self, op: str, key: tuple, payload):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((op, key, payload, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return future
+
+    async def add(self, client: dict) -> bool:
+        """Добавить клиента (результат — после записи пачки в панель)"""
+        return await self._submit("add", ("add", client["email"]), client)
+
+    async def update(self, client: dict) -> bool:
+        """Изменить клиента по его id"""
+        return await self._submit("update", ("update", client["id"]), client)
+
+    async def remove(self, email: str, client_id: str = None) -> bool:
+        """Удалить клиента по email (client_id экономит поиск по инбаунду)"""
+        return await self._submit("remove", ("remove", email), client_id)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        async with self._write_lock:
+            # Забираем всё, что накопилось, пока ждали окно и предыдущую запись
+            batch, self._pending = self._pending, []
+            self._flush_task = None
+            await self._apply(batch)
+
+    @staticmethod
+    def _split(batch: list) -> list:
+        """Разбить пачку на записи в панель с сохранением порядка операций.
+
+        Добавление, за которым в том же окне идет удаление, сокращается вместе с ним.
+        Добавление после удаления того же email начинает новую запись: внутри записи
+        панель получает добавления раньше удалений.
+        """
+        writes = [_Write()]
+        for op, key, payload, future in batch:
+            if op == "add" and payload["email"] in writes[-1].removes:
+                writes.append(_Write())
+            writes[-1].push(op, key, payload, future)
+        return writes
+
+    async def _apply(self, batch: list):
+        writes = self._split(batch)
+        for write in writes:
+            # Результаты, полученные до сбоя посреди записи, сохраняются
+            results = {}
+            if write.adds or write.updates or write.removes:
+                try:
+                    await self.api.apply_mutations(
+                        self.inbound_id,
+                        add=list(write.adds.values()),
+                        remove=list(write.removes.items()),
+                        update=list(write.updates.values()),
+                        results=results
+                    )
+                except CircuitOpenError as e:
+                    logger.warning(f"⚠️ Inbound {self.inbound_id} mutation batch rejected: {e}")
+                except Exception as e:
+                    logger.exception(f"🛑 Inbound {self.inbound_id} mutation batch failed: {e}")
+
+            for key, future, result in write.entries:
+                if not future.done():
+                    future.set_result(results.get(key, False) if result is None else result)
+
+        self.batches += 1
+        self.operations += len(batch)
+        if len(batch) > 1:
+            logger.info(
+                f"ℹ️  Inbound {self.inbound_id}: {len(batch)} mutations applied in {len(writes)} write(s) "
+                f"(+{sum(len(w.adds) for w in writes)} / ~{sum(len(w.updates) for w in writes)} "
+                f"/ -{sum(len(w.removes) for w in writes)})"
+            )
+
+    async def drain(self):
+        """Дождаться записи всего, что уже стоит в очереди"""
+        while self._flush_task is not None:
+            await asyncio.shield(self._flush_task)
@@ -0,0 +1,114 @@
+# xui_transport.py
+import logging
+import random
+import time
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Панель помечена недоступной — запрос не отправляется"""
+
+
+# Дедлайны запросов по эндпоинтам панели (сек)
+ENDPOINT_DEADLINES = {
+    "login": config.XUI_TIMEOUT_LOGIN,
+    "get": config.XUI_TIMEOUT_INBOUND,          # полный инбаунд, может весить мегабайты
+    "update": config.XUI_TIMEOUT_INBOUND,       # полная перезапись инбаунда
+    "addClient": config.XUI_TIMEOUT_WRITE,
+    "updateClient": config.XUI_TIMEOUT_WRITE,
+    "delClient": config.XUI_TIMEOUT_WRITE,
+    "getClientTraffics": config.XUI_TIMEOUT_READ,
+    "onlines": config.XUI_TIMEOUT_READ,
+}
+
+
+def endpoint_deadline(path: str) -> float:
+    """Дедлайн для пути вида api/inbounds/<endpoint>/..."""
+    for part in path.split('/'):
+        if part in ENDPOINT_DEADLINES:
+            return ENDPOINT_DEADLINES[part]
+    return config.XUI_TIMEOUT_READ
+
+
+def backoff_delay(attempt: int) -> float:
+    """Экспоненциальная пауза перед повтором с полным джиттером"""
+    ceiling = min(config.XUI_RETRY_MAX_DELAY, config.XUI_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    """Предохранитель узла: после серии ошибок перестает слать запросы в панель.
+
+    closed — всё работает; open — запросы сразу отклоняются до истечения reset_timeout;
+    half_open — пропускается один пробный запрос, его результат закрывает или
+    снова размыкает предохранитель.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._trial_in_flight = False
+        return self._state
+
+    def before_request(self):
+        """Проверка перед запросом: бросает CircuitOpenError, если панель считается лежащей"""
+        state = self.state
+        if state == self.OPEN:
+            raise CircuitOpenError(f"XUI node {self.name} is unavailable")
+        if state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                raise CircuitOpenError(f"XUI node {self.name} is being probed")
+            self._trial_in_flight = True
+
+    def record_success(self):
+        if self._state != self.CLOSED:
+            logger.info(f"✅ XUI node {self.name} is back, circuit closed")
+        self._state = self.CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def release_trial(self):
+        """Пробный запрос прерван без результата — следующий запрос снова может стать пробным"""
+        self._trial_in_flight = False
+
+    def record_failure(self, error=None):
+        self.failures += 1
+        self.last_error = str(error) if error else None
+        if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                logger.warning(
+                    f"⚠️ XUI node {self.name} circuit opened after {self.failures} failures: {self.last_error}"
+                )
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def describe(self) -> dict:
+        """Состояние для админ-меню"""
+        state = self.state
+        retry_in = 0
+        if state == self.OPEN:
+            retry_in = max(0, int(self.reset_timeout - (time.monotonic() - self.opened_at)))
+        return {
+            "state": state,
+            "failures": self.failures,
+            "retry_in": retry_in,
+            "last_error": self.last_error,
+        }